@@ -1,10 +1,11 @@
 from fastapi import FastAPI
 from db.crud import data_field
-from db.database import SessionLocal, engine, Base
+from db.database import SessionLocal, engine, Base, init_db
 from worldquant.service import WorldQuantService
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
+from worldquant.metrics import render, CONTENT_TYPE
 
-Base.metadata.create_all(bind=engine)
+init_db()
 wq_service = WorldQuantService()
 
 import uvicorn
@@ -27,5 +28,10 @@ async def refresh_data_fields(params):
         )
 
 
+@app.get("/metrics")
+def metrics():
+    return PlainTextResponse(render(), media_type=CONTENT_TYPE)
+
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,96 @@
+"""
+template expansion benchmark, queues a template of data field parameters with a throwaway database and a
+synthetic data_field catalog, and reports the rows/s of the expansion (formatting, validation and hashing
+of the expressions) and of the whole queue load (expansion and inserts). exits with 1 when the expansion
+is slower than `--min_rate`, so that a slower expansion does not go unnoticed.
+
+    python -m benchmark.expansion --fields 200 --min_rate 25000
+"""
+from loguru import logger
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import yaml
+
+
+TEMPLATE = {
+    'id': 0,
+    'expression': '{op}(ts_mean({field}, {days}) / {other}, {group})',
+    'parameters': {
+        'op': ['group_rank', 'group_zscore', 'group_neutralize'],
+        'field': {'type': 'data_field', 'where': {'type': 'MATRIX', 'dataset_id': 'benchmark'}, 'limit': None},
+        'days': [5, 10, 20, 60],
+        'other': {'type': 'data_field', 'where': {'type': 'MATRIX', 'dataset_id': 'benchmark'}, 'limit': 25},
+        'group': ['industry', 'subindustry'],
+    },
+}
+
+
+def fill_catalog(db, count, settings):
+    from db.crud.data_field import upsert_data_fields
+    from db.schema.data_field import DataFieldBase
+    data_fields = [
+        DataFieldBase(
+            field_name = f'benchmark_field_{i}', dataset_id = 'benchmark', type = 'MATRIX',
+            region = settings['region'], delay = settings['delay'], universe = settings['universe']
+        )
+        for i in range(count)
+    ]
+    return upsert_data_fields(db, data_fields)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='template expansion benchmark')
+    parser.add_argument('--fields', type=int, default=200, help='data fields of the catalog, the template expands to 600 rows per field')
+    parser.add_argument('--min_rate', type=float, default=0, help='exit with 1 when the expansion rate is below, in rows/s')
+    parser.add_argument('--no_validation', action='store_true', help='expand without the validator')
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stdout, format="<green>{time:HH:mm:ss}</green> | <level>{level:<8}</level> | <cyan>{message}</cyan>", level='INFO')
+
+    config = os.path.abspath('config')
+    workdir = tempfile.mkdtemp(prefix='wq_expansion_')
+    # the templates and the config are read relative to the working directory
+    os.makedirs(f'{workdir}/templates')
+    os.symlink(config, f'{workdir}/config')
+    with open(f'{workdir}/templates/benchmark.yaml', 'w') as f:
+        yaml.safe_dump({**TEMPLATE, 'parameters': {
+            **TEMPLATE['parameters'],
+            'field': {**TEMPLATE['parameters']['field'], 'limit': args.fields}
+        }}, f)
+    os.chdir(workdir)
+    # read by db.database at import time, set before importing it
+    os.environ['WORLDQUANT_DB_URL'] = f'sqlite:///{workdir}/benchmark.db'
+
+    from db.database import SessionLocal, init_db
+    from worldquant.alpha import AlphaTemplate
+    from worldquant.utils import load_config
+
+    init_db()
+    db = SessionLocal()
+    fill_catalog(db, args.fields, load_config('default_settings'))
+
+    alpha = AlphaTemplate(TEMPLATE['id'])
+    alpha.config.validation.enabled = not args.no_validation
+
+    start = time.time()
+    count = sum(1 for _ in alpha._iter_simulations())
+    expansion = time.time() - start
+    start = time.time()
+    alpha.load_simulation_queue(full = True)
+    load = time.time() - start
+
+    rate = count / expansion
+    logger.info(f'expanded {count} rows in {expansion:.2f} s, {rate:,.0f} rows/s')
+    logger.info(f'queued {count} rows in {load:.2f} s, {count / load:,.0f} rows/s, database {workdir}/benchmark.db')
+    if rate < args.min_rate:
+        logger.error(f'expansion rate {rate:,.0f} rows/s below {args.min_rate:,.0f} rows/s')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
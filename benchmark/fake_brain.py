@@ -0,0 +1,322 @@
+"""
+local stand-in of the WorldQuant BRAIN endpoints used by worldquant/api.py, so that the throughput of
+the simulation and check stages can be measured without spending quota.
+
+    python -m benchmark.fake_brain --port 8080 --progress_seconds 20 --rate_429 0.05
+    WORLDQUANT_BASE_URL=http://127.0.0.1:8080 WORLDQUANT_USERNAME=bench python main.py -s
+
+any credential is accepted. `GET /_stats` returns the timings of every simulation, used by benchmark/run.py.
+"""
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+
+import argparse
+import asyncio
+import numpy as np
+import random
+import time
+import uuid
+import uvicorn
+
+
+def add_arguments(parser):
+    group = parser.add_argument_group('fake server')
+    group.add_argument('--latency', type=float, default=0.05, help='mean response latency in seconds')
+    group.add_argument('--jitter', type=float, default=0.5, help='latency varies by +- this fraction')
+    group.add_argument('--progress_seconds', type=float, default=20, help='time a simulation stays in progress')
+    group.add_argument('--progress_poll', type=float, default=2, help='Retry-After of the progress and check polls')
+    group.add_argument('--check_seconds', type=float, default=5, help='time a check stays pending')
+    group.add_argument('--concurrent_limit', type=int, default=3, help='simulations in progress before a 429, a multi simulation counts once')
+    group.add_argument('--daily_limit', type=int, default=0, help='simulations per run before DAILY_SIMULATION_LIMIT_EXCEEDED, 0 for none')
+    group.add_argument('--rate_429', type=float, default=0, help='probability of a random 429 on any endpoint')
+    group.add_argument('--rate_401', type=float, default=0, help='probability of a 401 on the simulation post and check')
+    group.add_argument('--rate_error', type=float, default=0, help='probability that a simulation ends with ERROR')
+    group.add_argument('--retry_after', type=float, default=0, help='Retry-After of a 429, 0 to leave it out')
+    group.add_argument('--datafield_count', type=int, default=1000, help='number of fake data fields')
+    group.add_argument('--pnl_days', type=int, default=2500, help='business days of the fake pnl recordsets')
+    group.add_argument('--seed', type=int, default=0)
+    return parser
+
+
+def create_app(config):
+    app = FastAPI()
+    rng = random.Random(config.seed)
+    started = time.monotonic()
+    simulations = {}
+    alphas = {}
+    requests = {}
+
+    def now():
+        return time.monotonic() - started
+
+    async def respond(endpoint, status_code, content = None, headers = None):
+        await asyncio.sleep(max(rng.uniform(1 - config.jitter, 1 + config.jitter) * config.latency, 0))
+        requests.setdefault(endpoint, {}).setdefault(str(status_code), 0)
+        requests[endpoint][str(status_code)] += 1
+        if content is None:
+            return Response(status_code=status_code, headers=headers)
+        return JSONResponse(content=content, status_code=status_code, headers=headers)
+
+    def throttled(endpoint, detail = 'THROTTLED'):
+        headers = {'Retry-After': str(config.retry_after)} if config.retry_after else None
+        return respond(endpoint, 429, {'detail': detail}, headers)
+
+    def in_progress():
+        # a multi simulation takes a single slot
+        return sum(1 for simulation in simulations.values() if simulation['slot'] and simulation['done_at'] > now())
+
+    def new_simulation(simulation, slot = True):
+        simulate_id = uuid.uuid4().hex[:12]
+        simulations[simulate_id] = {
+            'id': simulate_id,
+            'type': simulation.get('type', 'REGULAR'),
+            'settings': simulation.get('settings', {}),
+            'regular': simulation.get('regular'),
+            'post_at': now(),
+            'done_at': now() + config.progress_seconds,
+            'seen_at': None,
+            'alpha': None,
+            'slot': slot,
+            'children': None,
+        }
+        return simulate_id
+
+    # the daily pnl of an alpha mixes this common series with its own noise so that the correlation
+    # of two alphas is about sqrt of the product of their self_correlation
+    common = np.random.default_rng(config.seed).normal(size = config.pnl_days)
+    dates = np.busday_offset(np.datetime64('2014-01-02'), np.arange(config.pnl_days), roll = 'forward')
+
+    def alpha_pnl(alpha):
+        own = np.random.default_rng(abs(hash(alpha['id'])) % 2 ** 32).normal(size = config.pnl_days)
+        weight = alpha['self_correlation']
+        daily = (np.sqrt(weight) * common + np.sqrt(1 - weight) * own) * 1000
+        return [[str(date), round(float(pnl), 2)] for date, pnl in zip(dates, np.cumsum(daily))]
+
+    def alpha_detail(alpha):
+        return {
+            'id': alpha['id'],
+            'type': alpha['type'],
+            'settings': alpha['settings'],
+            'regular': {'code': alpha['regular']},
+            'status': alpha['status'],
+            'dateCreated': alpha['date'],
+            'dateModified': alpha['date'],
+            'is': alpha['is'],
+        }
+
+    def alpha_checks(alpha):
+        metrics = alpha['is']
+        checks = [
+            ('LOW_SHARPE', metrics['sharpe'], 1.25, metrics['sharpe'] >= 1.25),
+            ('LOW_FITNESS', metrics['fitness'], 1.0, metrics['fitness'] >= 1.0),
+            ('LOW_TURNOVER', metrics['turnover'], 0.01, metrics['turnover'] >= 0.01),
+            ('HIGH_TURNOVER', metrics['turnover'], 0.7, metrics['turnover'] <= 0.7),
+            ('SELF_CORRELATION', alpha['self_correlation'], 0.7, alpha['self_correlation'] < 0.7),
+        ]
+        return [
+            {'name': name, 'value': round(value, 4), 'limit': limit, 'result': 'PASS' if passed else 'FAIL'}
+            for name, value, limit, passed in checks
+        ]
+
+    @app.post('/authentication')
+    async def authentication(request: Request):
+        if not request.headers.get('authorization'):
+            return await respond('authentication', 401, {'detail': 'Invalid credentials.'})
+        return await respond('authentication', 201, {'user': {'id': 'FAKE00'}, 'token': {'expiry': 14400}})
+
+    @app.post('/simulations')
+    async def post_simulation(request: Request):
+        simulation = await request.json()
+        # a list is a multi simulation of 2 to 10 simulations
+        batch = simulation if isinstance(simulation, list) else None
+        if batch is not None and not 2 <= len(batch) <= 10:
+            return await respond('simulations', 400, {'detail': 'a multi simulation has 2 to 10 simulations'})
+        if rng.random() < config.rate_401:
+            return await respond('simulations', 401, {'detail': 'Incorrect authentication credentials.'})
+        simulated = sum(1 for simulation in simulations.values() if simulation['children'] is None)
+        if config.daily_limit and simulated + len(batch or [None]) > config.daily_limit:
+            return await throttled('simulations', 'DAILY_SIMULATION_LIMIT_EXCEEDED')
+        if rng.random() < config.rate_429:
+            return await throttled('simulations')
+        if in_progress() >= config.concurrent_limit:
+            return await throttled('simulations', 'CONCURRENT_SIMULATION_LIMIT_EXCEEDED')
+        if batch is None:
+            simulate_id = new_simulation(simulation)
+        else:
+            simulate_id = new_simulation({})
+            simulations[simulate_id]['children'] = [new_simulation(child, slot = False) for child in batch]
+        location = f'{str(request.base_url).rstrip("/")}/simulations/{simulate_id}'
+        return await respond('simulations', 201, headers={'Location': location})
+
+    @app.get('/simulations/{simulate_id}')
+    async def get_simulation(simulate_id: str):
+        simulation = simulations.get(simulate_id)
+        if simulation is None:
+            return await respond('simulation_status', 404, {'detail': 'Not found.'})
+        if rng.random() < config.rate_429:
+            return await throttled('simulation_status')
+        if simulation['done_at'] > now():
+            progress = 1 - (simulation['done_at'] - now()) / max(config.progress_seconds, 1e-9)
+            return await respond(
+                'simulation_status', 200, {'progress': round(progress, 2)}, {'Retry-After': str(config.progress_poll)}
+            )
+        if simulation['children'] is not None:
+            simulation['seen_at'] = simulation['seen_at'] or now()
+            return await respond('simulation_status', 200, {
+                'id': simulate_id, 'type': simulation['type'], 'status': 'COMPLETE', 'children': simulation['children']
+            })
+        if simulation['seen_at'] is None:
+            simulation['seen_at'] = now()
+            if rng.random() < config.rate_error:
+                simulation['status'] = 'ERROR'
+            else:
+                simulation['status'] = 'COMPLETE'
+                simulation['alpha'] = uuid.uuid4().hex[:7].upper()
+                sharpe = rng.gauss(0, 1.2)
+                alphas[simulation['alpha']] = {
+                    'id': simulation['alpha'],
+                    'simulate_id': simulate_id,
+                    'type': simulation['type'],
+                    'settings': simulation['settings'],
+                    'regular': simulation['regular'],
+                    'status': 'UNSUBMITTED',
+                    'date': time.strftime('%Y-%m-%dT%H:%M:%S-04:00'),
+                    'self_correlation': rng.uniform(0, 1),
+                    'check_ready_at': None,
+                    'checked_at': None,
+                    'is': {
+                        'sharpe': round(sharpe, 2),
+                        'fitness': round(sharpe * 0.7 + rng.gauss(0, 0.2), 2),
+                        'turnover': round(rng.uniform(0.005, 0.8), 4),
+                        'drawdown': round(rng.uniform(0.01, 0.3), 4),
+                        'longCount': rng.randint(500, 1500),
+                        'shortCount': rng.randint(500, 1500),
+                        'returns': round(rng.gauss(0.05, 0.05), 4),
+                        'margin': round(rng.gauss(0.0005, 0.0005), 6),
+                        'pnl': rng.randint(-1000000, 5000000),
+                    },
+                }
+        result = {key: simulation[key] for key in ('id', 'type', 'settings', 'regular', 'status')}
+        if simulation['alpha']:
+            result['alpha'] = simulation['alpha']
+        else:
+            result['message'] = 'fake simulation error'
+        return await respond('simulation_status', 200, result)
+
+    @app.get('/alphas/{alpha_id}/check')
+    async def check_alpha(alpha_id: str):
+        alpha = alphas.get(alpha_id)
+        if alpha is None:
+            return await respond('check', 404, {'detail': 'Not found.'})
+        if rng.random() < config.rate_401:
+            return await respond('check', 401, {'detail': 'Incorrect authentication credentials.'})
+        if rng.random() < config.rate_429:
+            return await throttled('check')
+        if alpha['check_ready_at'] is None:
+            alpha['check_ready_at'] = now() + config.check_seconds
+        if alpha['check_ready_at'] > now():
+            return await respond('check', 200, headers={'Retry-After': str(config.progress_poll)})
+        if alpha['checked_at'] is None:
+            alpha['checked_at'] = now()
+        return await respond('check', 200, {'is': {'checks': alpha_checks(alpha)}})
+
+    @app.post('/alphas/{alpha_id}/submit')
+    async def submit_alpha(alpha_id: str):
+        alpha = alphas.get(alpha_id)
+        if alpha is None:
+            return await respond('submit', 404, {'detail': 'Not found.'})
+        if rng.random() < config.rate_429:
+            return await throttled('submit')
+        if alpha['status'] == 'ACTIVE':
+            return await respond('submit', 403, {'is': {'checks': [{'name': 'ALREADY_SUBMITTED', 'result': 'FAIL'}]}})
+        failed = [check for check in alpha_checks(alpha) if check['result'] == 'FAIL']
+        if failed:
+            return await respond('submit', 403, {'is': {'checks': failed}})
+        alpha['status'] = 'ACTIVE'
+        return await respond('submit', 201, {})
+
+    @app.get('/alphas/{alpha_id}/recordsets/pnl')
+    async def get_pnl(alpha_id: str):
+        alpha = alphas.get(alpha_id)
+        if alpha is None:
+            return await respond('pnl', 404, {'detail': 'Not found.'})
+        if rng.random() < config.rate_429:
+            return await throttled('pnl')
+        return await respond('pnl', 200, {
+            'schema': {'name': 'pnl', 'properties': [{'name': 'date', 'type': 'date'}, {'name': 'pnl', 'type': 'amount'}]},
+            'records': alpha_pnl(alpha),
+        })
+
+    @app.get('/alphas/{alpha_id}')
+    async def get_alpha(alpha_id: str):
+        alpha = alphas.get(alpha_id)
+        if alpha is None:
+            return await respond('alpha', 404, {'detail': 'Not found.'})
+        if rng.random() < config.rate_429:
+            return await throttled('alpha')
+        return await respond('alpha', 200, alpha_detail(alpha))
+
+    @app.get('/users/self/alphas')
+    async def search_alpha(request: Request, limit: int = 100, offset: int = 0):
+        if rng.random() < config.rate_429:
+            return await throttled('search_alpha')
+        # only the dateModified> and status filters are applied
+        params = request.query_params
+        results = [alpha for alpha in alphas.values() if alpha['date'] > params.get('dateModified>', '')]
+        if params.get('status'):
+            results = [alpha for alpha in results if alpha['status'] == params.get('status')]
+        page = [alpha_detail(alpha) for alpha in results[offset:offset + limit]]
+        return await respond('search_alpha', 200, {'count': len(results), 'results': page})
+
+    @app.get('/data-fields')
+    async def get_datafields(request: Request, limit: int = 50, offset: int = 0):
+        if rng.random() < config.rate_429:
+            return await throttled('data_fields')
+        params = request.query_params
+        page = [
+            {
+                'id': f'fake_field_{i}',
+                'description': f'fake data field {i}',
+                'dataset': {'id': 'fundamental6', 'name': 'Fake Fundamental'},
+                'category': {'id': 'fundamental', 'name': 'Fundamental'},
+                'subcategory': {'id': 'fundamental-fake', 'name': 'Fake'},
+                'region': params.get('region', 'USA'),
+                'delay': int(params.get('delay', 1)),
+                'universe': params.get('universe', 'TOP3000'),
+                'type': 'MATRIX',
+                'coverage': 0.9,
+                'userCount': config.datafield_count - i,
+                'alphaCount': config.datafield_count - i,
+            }
+            for i in range(offset, min(offset + limit, config.datafield_count))
+        ]
+        return await respond('data_fields', 200, {'count': config.datafield_count, 'results': page})
+
+    @app.get('/_stats')
+    async def stats():
+        return {
+            'now': now(),
+            'requests': requests,
+            'simulations': [
+                {
+                    'post_at': simulation['post_at'],
+                    'done_at': simulation['done_at'],
+                    'seen_at': simulation['seen_at'],
+                    'status': simulation.get('status'),
+                    'slot': simulation['slot'],
+                    'multi': simulation['children'] is not None,
+                    'checked_at': alphas[simulation['alpha']]['checked_at'] if simulation['alpha'] else None,
+                }
+                for simulation in simulations.values()
+            ],
+        }
+
+    return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    args = add_arguments(parser).parse_args()
+    uvicorn.run(create_app(args), host=args.host, port=args.port, log_level='warning')
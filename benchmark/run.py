@@ -0,0 +1,124 @@
+"""
+end-to-end throughput benchmark, runs the simulation stage of the real service against benchmark/fake_brain.py
+with a throwaway database and reports simulations/hour, the p50/p99 latency of the simulation lifecycle
+and the time the simulation slots stayed idle.
+
+    python -m benchmark.run --count 200 --engine async --progress_seconds 10 --rate_429 0.05
+"""
+from benchmark.fake_brain import create_app, add_arguments
+from loguru import logger
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import httpx
+import uvicorn
+
+
+def percentile(values, q):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(int(q / 100 * len(values)), len(values) - 1)]
+
+
+def start_server(args):
+    server = uvicorn.Server(uvicorn.Config(create_app(args), host='127.0.0.1', port=args.port, log_level='warning'))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, thread
+
+
+def fill_queue(db, count):
+    from db.crud.simulation_queue import insert_queue_batch
+    from worldquant.utils import load_config, canonical_settings, content_hash
+
+    settings = load_config('default_settings')
+    canonical = canonical_settings(settings)
+    rows = (
+        {
+            'regular': f'rank(ts_delta(fake_field_{i}, 5))',
+            'settings': json.dumps(settings),
+            'type': 'REGULAR',
+            'template_id': 0,
+            'expression_hash': content_hash(f'rank(ts_delta(fake_field_{i}, 5))', canonical),
+            'params': None
+        }
+        for i in range(count)
+    )
+    return insert_queue_batch(db, rows)
+
+
+def report(stats, slots, elapsed):
+    simulations = [s for s in stats['simulations'] if not s['multi']]
+    completed = [s for s in simulations if s['seen_at'] is not None]
+    lifecycle = [s['seen_at'] - s['post_at'] for s in completed]
+    checked = [s['checked_at'] - s['seen_at'] for s in completed if s['checked_at'] is not None]
+    # the simulation stage runs from the first post to the last result seen, the checks left
+    # running after it are timed on their own
+    seen = [s['seen_at'] for s in stats['simulations'] if s['seen_at'] is not None]
+    wall = max(seen) - min(s['post_at'] for s in stats['simulations']) if seen else elapsed
+    # a slot is idle when it holds no posted simulation, e.g. waiting on a 429 or on the queue,
+    # the children of a multi simulation share the slot of their parent
+    busy = sum(s['seen_at'] - s['post_at'] for s in stats['simulations'] if s['slot'] and s['seen_at'] is not None)
+    idle = max(slots * wall - busy, 0)
+
+    logger.info(f'simulations completed {len(completed)} of {len(simulations)} posted in {wall:.1f} s, run finished in {elapsed:.1f} s')
+    logger.info(f'throughput {len(completed) / max(wall, 1e-9) * 3600:.0f} simulations/hour')
+    logger.info(f'simulation latency p50 {percentile(lifecycle, 50):.2f} s, p99 {percentile(lifecycle, 99):.2f} s')
+    if checked:
+        logger.info(f'check latency p50 {percentile(checked, 50):.2f} s, p99 {percentile(checked, 99):.2f} s, {len(checked)} checked')
+    logger.info(f'idle slot time {idle:.1f} slot-s, {idle / max(slots * wall, 1e-9) * 100:.1f}% of {slots} slots')
+    for endpoint, codes in sorted(stats['requests'].items()):
+        logger.info(f'{endpoint}: {", ".join(f"{code} x {count}" for code, count in sorted(codes.items()))}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=100, help='simulations to queue')
+    parser.add_argument('--engine', choices=['thread', 'async'], default='thread', help='simulation engine')
+    parser.add_argument('--parallelism', type=int, help='overrides parallelism of config/simulation.json')
+    parser.add_argument('--max_inflight', type=int, help='overrides max_inflight of config/simulation.json')
+    parser.add_argument('--check_parallelism', type=int, help='overrides check_parallelism of config/simulation.json')
+    parser.add_argument('--multi_simulation_size', type=int, help='overrides multi_simulation_size of config/simulation.json')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--debug', action='store_true', help='enable debug mode')
+    args = add_arguments(parser).parse_args()
+
+    logger.remove()
+    logger.add(sys.stdout, format="<green>{time:HH:mm:ss}</green> | <level>{level:<8}</level> | <cyan>{message}</cyan>",
+               level="DEBUG" if args.debug else 'INFO')
+
+    workdir = tempfile.mkdtemp(prefix='wq_benchmark_')
+    # read by db.database and worldquant.api at import time, set before importing them
+    os.environ['WORLDQUANT_DB_URL'] = f'sqlite:///{workdir}/benchmark.db'
+    os.environ['WORLDQUANT_BASE_URL'] = f'http://127.0.0.1:{args.port}'
+    os.environ.setdefault('WORLDQUANT_USERNAME', 'benchmark')
+
+    from worldquant.service import WorldQuantService
+    from worldquant.engine import AsyncSimulationEngine
+
+    server, _ = start_server(args)
+    service = WorldQuantService()
+    for key in ('parallelism', 'max_inflight', 'check_parallelism', 'multi_simulation_size'):
+        if getattr(args, key) is not None:
+            setattr(service.config, key, getattr(args, key))
+    logger.info(f'queued {fill_queue(service.db, args.count)} simulations, database {workdir}/benchmark.db')
+
+    start = time.time()
+    if args.engine == 'async':
+        slots = min(service.config.max_inflight, args.concurrent_limit)
+        AsyncSimulationEngine(service).run(until_empty = True)
+    else:
+        slots = min(service.config.parallelism, args.concurrent_limit)
+        service.simulate_from_alpha_queue(until_empty = True)
+    elapsed = time.time() - start
+
+    report(httpx.get(f'http://127.0.0.1:{args.port}/_stats').json(), slots, elapsed)
+    server.should_exit = True
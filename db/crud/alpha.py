@@ -1,6 +1,7 @@
 from sqlalchemy.orm import Session
-from typing import Optional, List
-from sqlalchemy import or_
+from typing import Optional, List, Iterator
+from sqlalchemy import or_, func
+from sqlalchemy.dialects.sqlite import insert
 from db.schema.alpha import AlphaBase
 from db.model.alpha import Alpha
 
@@ -27,25 +28,80 @@ def get_alphas(
         )
     return query.offset(skip).limit(limit).all()
 
+def iter_alpha_ids(
+    db: Session,
+    status: Optional[list[str]] = [],
+    batch_size: int = 500
+) -> Iterator[str]:
+    """
+    yield the alpha_id of the matching alphas in pages keyed on id, so that no page query stays open
+    and the rows updated while iterating are neither skipped nor repeated.
+    """
+    last_id = 0
+    while True:
+        query = db.query(Alpha.id, Alpha.alpha_id).filter(Alpha.id > last_id)
+        if status:
+            query = query.filter(Alpha.status.in_(status))
+        rows = query.order_by(Alpha.id).limit(batch_size).all()
+        if not rows:
+            return
+        for row in rows:
+            yield row.alpha_id
+        last_id = rows[-1].id
+
+def get_alpha_ids(
+    db: Session,
+    status: Optional[list[str]] = [],
+    exclude = (),
+    limit: int = 100
+) -> List[str]:
+    """alpha_id of the first `limit` matching alphas, leaving out the ones of `exclude`"""
+    query = db.query(Alpha.alpha_id)
+    if status:
+        query = query.filter(Alpha.status.in_(status))
+    if exclude:
+        query = query.filter(Alpha.alpha_id.notin_(list(exclude)))
+    return [row.alpha_id for row in query.order_by(Alpha.id).limit(limit).all()]
+
 def upsert_alpha(
     db: Session,
     alpha: AlphaBase,
     refresh_status: bool = True
-) -> Optional[Alpha]:
-    db_alpha = db.query(Alpha).filter(Alpha.alpha_id == alpha.alpha_id).first()
-    if db_alpha:
-        update_data = alpha.model_dump(exclude_unset=True)
-        for key, value in update_data.items():
-            # don't set status field
-            if not refresh_status and key == 'status':
-                continue
-            setattr(db_alpha, key, value)
-        
-        db.commit()
-        db.refresh(db_alpha)
-    else:
-        create_alpha(db, alpha)
-    return db_alpha
+) -> int:
+    return upsert_alphas(db, [alpha], refresh_status)
+
+def upsert_alphas(
+    db: Session,
+    alphas: List[AlphaBase],
+    refresh_status: bool = True,
+    batch_size: int = 500
+) -> int:
+    """
+    insert or merge alphas on the unique alpha_id in one transaction. like model_dump(exclude_unset=True),
+    only the fields set on each alpha are updated, and status is left untouched unless refresh_status.
+    """
+    groups = {}
+    for alpha in alphas:
+        row = alpha.model_dump(exclude_unset=True)
+        groups.setdefault(tuple(sorted(row)), []).append(row)
+
+    for keys, rows in groups.items():
+        stmt = insert(Alpha)
+        update_keys = [key for key in keys if key != 'alpha_id' and (refresh_status or key != 'status')]
+        if update_keys:
+            stmt = stmt.on_conflict_do_update(
+                index_elements=['alpha_id'],
+                set_={
+                    **{key: stmt.excluded[key] for key in update_keys},
+                    'updated_at': func.now()
+                }
+            )
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=['alpha_id'])
+        for i in range(0, len(rows), batch_size):
+            db.execute(stmt, rows[i:i + batch_size])
+    db.commit()
+    return len(alphas)
 
 def delete_alpha(db: Session, alpha_id: str) -> bool:
     db_alpha = db.query(Alpha).filter(Alpha.alpha_id == alpha_id).first()
@@ -58,3 +114,6 @@ def delete_alpha(db: Session, alpha_id: str) -> bool:
 def get_alpha_by_alpha_id(db: Session, alpha_id: str) -> List[Alpha]:
     return db.query(Alpha).filter(Alpha.alpha_id == alpha_id).all()
 
+
+def exists_expression_hash(db: Session, expression_hash: str) -> bool:
+    return db.query(Alpha.id).filter(Alpha.expression_hash == expression_hash).first() is not None
@@ -1,9 +1,17 @@
 from sqlalchemy.orm import Session
-from sqlalchemy import and_, or_, text
+from sqlalchemy import and_, or_, text, func, literal_column
+from sqlalchemy.dialects.sqlite import insert
 from typing import Optional, List
 from db.schema.data_field import DataFieldBase, DataFieldBase
 from db.model.data_field import DataField
 
+# columns of the data_field_natural_key unique index
+NATURAL_KEY = ('field_name', 'region', 'delay', 'universe', 'type', 'dataset_id')
+# sqlite never finds a conflict on a null, the nullable columns are indexed as coalesce(column, '')
+NATURAL_KEY_INDEX = [
+    DataField.field_name if key == 'field_name' else func.coalesce(getattr(DataField, key), literal_column("''")) for key in NATURAL_KEY
+]
+
 
 def create_data_field(db: Session, data_field: DataFieldBase):
     db_data_field = DataField(**data_field.dict())
@@ -13,29 +21,28 @@ def create_data_field(db: Session, data_field: DataFieldBase):
     return db_data_field
 
 def upsert_data_field(db: Session, data_field: DataFieldBase):
-    db_data_field_list = get_data_fields_by_criteria(
-        db,
-        data_field.field_name, 
-        data_field.dataset_id,
-        data_field.category_id,
-        data_field.subcategory_id,
-        data_field.region,
-        data_field.delay,
-        data_field.universe,
-        data_field.type
-    )
-    if db_data_field_list:
-        db_data_field = db_data_field_list[0]
-        update_data = data_field.dict(exclude_unset=True)
-        for key, value in update_data.items():
-            setattr(db_data_field, key, value)
-        
-        db.commit()
-        db.refresh(db_data_field)
-    else:
-        create_data_field(db, data_field)
+    upsert_data_fields(db, [data_field])
     
 
+def upsert_data_fields(db: Session, data_fields: List[DataFieldBase], batch_size: int = 500) -> int:
+    """insert or update a page of data fields on the natural key with INSERT ... ON CONFLICT DO UPDATE"""
+    rows = [data_field.model_dump() for data_field in data_fields]
+    if not rows:
+        return 0
+    stmt = insert(DataField)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=NATURAL_KEY_INDEX,
+        set_={
+            **{key: stmt.excluded[key] for key in rows[0] if key not in NATURAL_KEY},
+            'updated_at': func.now()
+        }
+    )
+    for i in range(0, len(rows), batch_size):
+        db.execute(stmt, rows[i:i + batch_size])
+    db.commit()
+    return len(rows)
+
+
 def get_data_fields_by_criteria(
     db: Session,
     field_name: Optional[str] = None,
@@ -0,0 +1,54 @@
+from sqlalchemy.orm import Session
+from sqlalchemy import func, update
+from sqlalchemy.dialects.sqlite import insert
+from db.model.parameter_stat import ParameterStat
+
+import json
+
+
+def encode_parameter_value(value) -> str:
+    return json.dumps(value, ensure_ascii=False)
+
+def record_parameter_outcome(db: Session, template_id, params: dict, sharpe, fitness):
+    """
+    add one simulated outcome to the stats of every parameter value of a template combination,
+    returns the updated stats rows.
+    """
+    result = []
+    for name, value in params.items():
+        stmt = insert(ParameterStat).values(
+            template_id=template_id, param_name=name, param_value=encode_parameter_value(value), trials=1,
+            best_sharpe=sharpe, best_fitness=fitness, sum_sharpe=sharpe, sum_fitness=fitness
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['template_id', 'param_name', 'param_value'],
+            set_={
+                'trials': ParameterStat.trials + 1,
+                'best_sharpe': func.max(ParameterStat.best_sharpe, stmt.excluded.best_sharpe),
+                'best_fitness': func.max(ParameterStat.best_fitness, stmt.excluded.best_fitness),
+                'sum_sharpe': ParameterStat.sum_sharpe + stmt.excluded.sum_sharpe,
+                'sum_fitness': ParameterStat.sum_fitness + stmt.excluded.sum_fitness,
+                'updated_at': func.now()
+            }
+        ).returning(ParameterStat)
+        result.append(db.execute(stmt).scalar_one())
+    db.commit()
+    return result
+
+def mark_parameter_pruned(db: Session, template_id, param_name, param_value) -> bool:
+    """returns False if the value was already pruned, e.g. by another worker"""
+    result = db.execute(
+        update(ParameterStat)
+        .where(ParameterStat.template_id == template_id, ParameterStat.param_name == param_name,
+               ParameterStat.param_value == param_value, ParameterStat.pruned == False)
+        .values(pruned=True, updated_at=func.now())
+    )
+    db.commit()
+    return result.rowcount > 0
+
+def get_pruned_parameters(db: Session, template_id) -> set:
+    """(param_name, param_value) of the pruned values of a template"""
+    rows = db.query(ParameterStat.param_name, ParameterStat.param_value).filter(
+        ParameterStat.template_id == template_id, ParameterStat.pruned == True
+    ).all()
+    return {(row.param_name, row.param_value) for row in rows}
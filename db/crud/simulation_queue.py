@@ -1,16 +1,161 @@
 from sqlalchemy.orm import Session
 from sqlalchemy import text
+from itertools import islice
 
 
-def insert_queue(db: Session, regular, settings, type = 'REGULAR', template_id = 0):
-    db.execute(text(f"insert into simulation_queue (regular, settings, type, template_id) \
-    values('{regular}', '{settings}', '{type}', '{template_id}' )"))
+# a row whose expression_hash is already queued or already simulated into an alpha is skipped
+INSERT_QUEUE_SQL = "insert or ignore into simulation_queue (regular, settings, type, template_id, expression_hash, params) \
+    select :regular, :settings, :type, :template_id, :expression_hash, :params \
+    where not exists (select 1 from alpha where expression_hash = :expression_hash)"
+
+
+def insert_queue(db: Session, regular, settings, type = 'REGULAR', template_id = 0, expression_hash = None, params = None) -> int:
+    result = db.execute(text(INSERT_QUEUE_SQL), {
+        'regular': regular, 'settings': settings, 'type': type, 'template_id': template_id,
+        'expression_hash': expression_hash, 'params': params
+    })
+    db.commit()
+    return result.rowcount
+
+def insert_queue_batch(db: Session, rows, batch_size = 10000) -> int:
+    """
+    write an iterable of queue rows (dicts of regular, settings, type, template_id, expression_hash, params)
+    with executemany, `batch_size` rows at a time in a single transaction, the iterable is consumed lazily.
+    returns the number of rows inserted, duplicates of queued or simulated rows are not counted.
+    """
+    rows = iter(rows)
+    count = 0
+    # driver level executemany, skips the per row statement compilation of db.execute
+    connection = db.connection()
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            break
+        count += connection.exec_driver_sql(INSERT_QUEUE_SQL, batch).rowcount
     db.commit()
+    return count
 
 def delete_queue_by_template_id(db: Session, template_id):
-    db.execute(text(f"delete from simulation_queue where template_id = '{template_id}'"))
+    db.execute(text("delete from simulation_queue where template_id = :template_id"), {'template_id': template_id})
     db.commit()
 
 def delete_queue_by_id(db: Session, id):
-    db.execute(text(f"delete from simulation_queue where id = {id}"))
+    db.execute(text("delete from simulation_queue where id = :id"), {'id': id})
+    db.commit()
+
+def claim_queue(db: Session, worker_id, limit, lease_seconds, template_id = None, shuffle = False):
+    """
+    atomically lease up to `limit` queued rows to `worker_id` with a single UPDATE ... RETURNING,
+    rows whose lease has expired (e.g. their worker crashed) are claimed again.
+    """
+    where_condition = 'and template_id = :template_id' if template_id != None else ''
+    order_by = 'priority, random()' if shuffle else 'priority, id'
+    # the queued and the expired rows are picked apart, so that each side walks an index in order
+    result = db.execute(text(f"update simulation_queue \
+        set status = 'CLAIMED', worker_id = :worker_id, lease_expires_at = datetime('now', :lease) \
+        where id in ( \
+            select id from ( \
+                select * from (select id, priority from simulation_queue where status = 'QUEUED' {where_condition} \
+                    order by {order_by} limit :limit) \
+                union all \
+                select * from (select id, priority from simulation_queue \
+                    where status = 'CLAIMED' and lease_expires_at < datetime('now') {where_condition} \
+                    order by {order_by} limit :limit) \
+            ) order by {order_by} limit :limit \
+        ) returning id, regular, settings, type, expression_hash, template_id, params"), {
+        'worker_id': worker_id, 'lease': f'+{lease_seconds} seconds', 'limit': limit, 'template_id': template_id
+    }).all()
     db.commit()
+    return sorted(result, key = lambda row: row.id) if not shuffle else result
+
+def get_queued_template_ids(db: Session) -> list:
+    """
+    the template ids with claimable rows, with a loose index scan: each step seeks the next template_id
+    on the simulation_queue_template_id index, so the cost grows with the templates, not the rows.
+    """
+    # order by + limit 1 stops at the first match, min() would scan the rest of the range
+    claimable = "(status = 'QUEUED' or (status = 'CLAIMED' and lease_expires_at < datetime('now')))"
+    rows = db.execute(text(f"with recursive template(id) as ( \
+            select (select template_id from simulation_queue where template_id is not null and {claimable} \
+                order by template_id limit 1) \
+            union all \
+            select (select template_id from simulation_queue where template_id > template.id and {claimable} \
+                order by template_id limit 1) \
+            from template where template.id is not null \
+        ) select id from template where id is not null")).all()
+    return [row.id for row in rows]
+
+def prune_queue(db: Session, template_id, param_name, param_value, drop = True) -> int:
+    """
+    drop (or push back by one priority) the queued rows of a template whose parameter `param_name`
+    has the json encoded value `param_value`, returns the number of rows affected.
+    """
+    action = 'delete from simulation_queue' if drop else 'update simulation_queue set priority = priority + 1'
+    result = db.execute(text(f"{action} \
+        where template_id = :template_id and status = 'QUEUED' \
+        and json_extract(params, :path) = json_extract(:param_value, '$')"), {
+        'template_id': template_id, 'path': f'$."{param_name}"', 'param_value': param_value
+    })
+    db.commit()
+    return result.rowcount
+
+def iter_queued_rows(db: Session, template_id = None, batch_size = 1000):
+    """yield the QUEUED rows in pages of `batch_size` by id, a page can be changed before the next one is read"""
+    where_condition = 'and template_id = :template_id' if template_id != None else ''
+    last_id = 0
+    while True:
+        rows = db.execute(text(f"select id, regular, settings, type, template_id from simulation_queue \
+            where status = 'QUEUED' and id > :last_id {where_condition} order by id limit :limit"), {
+            'last_id': last_id, 'template_id': template_id, 'limit': batch_size
+        }).all()
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1].id
+
+def delete_queue_by_ids(db: Session, ids) -> int:
+    """delete the rows of `ids` still QUEUED, returns the number of rows deleted"""
+    if not ids:
+        return 0
+    result = db.connection().exec_driver_sql(
+        "delete from simulation_queue where id = :id and status = 'QUEUED'", [{'id': id} for id in ids]
+    )
+    db.commit()
+    return result.rowcount
+
+def push_back_queue(db: Session, priorities) -> int:
+    """raise the priority of queued rows to at least the given one, `priorities` maps ids to priorities"""
+    if not priorities:
+        return 0
+    result = db.connection().exec_driver_sql(
+        "update simulation_queue set priority = max(priority, :priority) where id = :id and status = 'QUEUED'",
+        [{'id': id, 'priority': priority} for id, priority in priorities.items()]
+    )
+    db.commit()
+    return result.rowcount
+
+def renew_lease(db: Session, worker_id, lease_seconds):
+    db.execute(text("update simulation_queue set lease_expires_at = datetime('now', :lease) \
+        where status = 'CLAIMED' and worker_id = :worker_id"), {'worker_id': worker_id, 'lease': f'+{lease_seconds} seconds'})
+    db.commit()
+
+def release_queue(db: Session, worker_id, id = None):
+    """put the rows claimed by `worker_id` (or only the row `id`) back to the queue"""
+    where_condition = 'and id = :id' if id != None else ''
+    db.execute(text(f"update simulation_queue set status = 'QUEUED', worker_id = null, lease_expires_at = null \
+        where status = 'CLAIMED' and worker_id = :worker_id {where_condition}"), {'worker_id': worker_id, 'id': id})
+    db.commit()
+
+def release_queue_by_ids(db: Session, worker_id, ids):
+    """put the rows of `ids` claimed by `worker_id` back to the queue"""
+    if not ids:
+        return
+    db.connection().exec_driver_sql(
+        "update simulation_queue set status = 'QUEUED', worker_id = null, lease_expires_at = null \
+        where id = :id and status = 'CLAIMED' and worker_id = :worker_id", [{'id': id, 'worker_id': worker_id} for id in ids]
+    )
+    db.commit()
+
+def count_queue_by_status(db: Session) -> dict:
+    rows = db.execute(text("select status, count(*) as cnt from simulation_queue group by status")).all()
+    return {row.status: row.cnt for row in rows}
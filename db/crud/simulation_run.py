@@ -0,0 +1,44 @@
+from sqlalchemy.orm import Session
+from sqlalchemy import func, case, update
+from datetime import datetime, timezone
+from db.model.simulation_run import SimulationRun
+
+
+def utc_now():
+    """naive utc timestamp with microseconds, comparable with the CURRENT_TIMESTAMP of sqlite"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def create_simulation_run(db: Session, **fields) -> int:
+    run = SimulationRun(created_at=utc_now(), **fields)
+    db.add(run)
+    db.commit()
+    return run.id
+
+def update_simulation_run(db: Session, run_id, **fields):
+    db.execute(update(SimulationRun).where(SimulationRun.id == run_id).values(**fields, updated_at=func.now()))
+    db.commit()
+
+def update_simulation_run_by_alpha_id(db: Session, alpha_id, **fields):
+    """update the latest run which produced `alpha_id`"""
+    latest = db.query(func.max(SimulationRun.id)).filter(SimulationRun.alpha_id == alpha_id).scalar_subquery()
+    db.execute(update(SimulationRun).where(SimulationRun.id == latest).values(**fields, updated_at=func.now()))
+    db.commit()
+
+def get_simulation_run_stats(db: Session, start, end = None, template_id = None):
+    """runs created in [start, end) per template: attempts, results, and the mean seconds to submit and to complete"""
+    seconds = lambda a, b: (func.julianday(b) - func.julianday(a)) * 86400
+    query = db.query(
+        SimulationRun.template_id,
+        func.count().label('runs'),
+        func.sum(case((SimulationRun.status.in_(['COMPLETE', 'WARNING']), 1), else_=0)).label('completed'),
+        func.sum(case((SimulationRun.check_status == 'PASS', 1), else_=0)).label('passed'),
+        func.sum(case((SimulationRun.status.in_(['ERROR', 'FAIL', 'REJECTED']), 1), else_=0)).label('failed'),
+        func.sum(case((SimulationRun.status == 'INVALID', 1), else_=0)).label('invalid'),
+        func.avg(seconds(SimulationRun.created_at, SimulationRun.submitted_at)).label('submit_seconds'),
+        func.avg(seconds(SimulationRun.submitted_at, SimulationRun.completed_at)).label('progress_seconds'),
+    ).filter(SimulationRun.created_at >= start)
+    if end is not None:
+        query = query.filter(SimulationRun.created_at < end)
+    if template_id is not None:
+        query = query.filter(SimulationRun.template_id == template_id)
+    return query.group_by(SimulationRun.template_id).order_by(SimulationRun.template_id).all()
@@ -0,0 +1,19 @@
+from sqlalchemy.orm import Session
+from sqlalchemy import func
+from sqlalchemy.dialects.sqlite import insert
+from typing import Optional
+from db.model.sync_state import SyncState
+
+
+def get_watermark(db: Session, sync_key: str) -> Optional[str]:
+    state = db.query(SyncState).filter(SyncState.sync_key == sync_key).first()
+    return state.watermark if state else None
+
+def set_watermark(db: Session, sync_key: str, watermark: str):
+    stmt = insert(SyncState).values(sync_key=sync_key, watermark=watermark)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['sync_key'],
+        set_={'watermark': stmt.excluded.watermark, 'updated_at': func.now()}
+    )
+    db.execute(stmt)
+    db.commit()
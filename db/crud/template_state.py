@@ -0,0 +1,22 @@
+from sqlalchemy.orm import Session
+from sqlalchemy import func
+from sqlalchemy.dialects.sqlite import insert
+from typing import Optional
+from db.model.template_state import TemplateState
+
+
+def get_template_state(db: Session, template_id) -> Optional[TemplateState]:
+    return db.query(TemplateState).filter(TemplateState.template_id == template_id).first()
+
+def upsert_template_state(db: Session, template_id, file, template_hash, parameters, parameters_hash, combinations):
+    values = {
+        'file': file, 'template_hash': template_hash, 'parameters': parameters,
+        'parameters_hash': parameters_hash, 'combinations': combinations
+    }
+    stmt = insert(TemplateState).values(template_id=template_id, **values)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['template_id'],
+        set_={**{key: stmt.excluded[key] for key in values}, 'updated_at': func.now()}
+    )
+    db.execute(stmt)
+    db.commit()
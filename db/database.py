@@ -2,7 +2,9 @@ from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import scoped_session, sessionmaker
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///db/worldquant.db"
+import os
+
+SQLALCHEMY_DATABASE_URL = os.environ.get('WORLDQUANT_DB_URL', "sqlite:///db/worldquant.db")
 
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False, "timeout": 30}
@@ -10,3 +12,16 @@ engine = create_engine(
 SessionLocal = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=engine))
 
 Base = declarative_base()
+
+
+def init_db():
+    """
+    create the missing tables of the models, then apply the numbered migrations of db/migrations.py,
+    which upgrade the tables of a database created by an older db/schema.sql in place. a column or
+    index added to one of the existing tables goes in a new migration, not only in the model.
+    """
+    from db.migrations import migrate
+    from db.model import alpha, data_field, parameter_stat, simulation_queue, simulation_run, sync_state, template_state  # noqa: F401, register the models to Base.metadata
+
+    Base.metadata.create_all(bind=engine)
+    migrate(engine)
@@ -0,0 +1,134 @@
+"""
+numbered schema migrations, applied in order by init_db once the missing tables of the models are
+created. every change to the tables of the original db/schema.sql, columns, indexes and the data
+fixes they need, is a migration, so that `PRAGMA user_version` describes the schema. each migration
+runs with the version bump in one transaction, so a failed migration leaves the database at the
+previous version. a step is a sql statement or a function of the connection.
+
+db/schema.sql includes every migration and sets the matching user_version, keep both in step.
+the steps are idempotent (`if not exists`) so that a database upgraded by hand is not a problem.
+"""
+from loguru import logger
+from sqlalchemy import text
+
+
+def add_column(table, column, ddl):
+    """step adding a column unless it exists, sqlite has no `add column if not exists`"""
+    def step(conn):
+        columns = {row.name for row in conn.execute(text(f"pragma table_info({table})"))}
+        if column not in columns:
+            conn.execute(text(f"alter table {table} add column {column} {ddl}"))
+    return step
+
+
+def unique_index(name, table, columns):
+    """steps creating a unique index, the duplicated rows are removed first keeping the latest one"""
+    # rows with a null key never conflict
+    not_null = ' and '.join(f'{column.strip()} is not null' for column in columns.split(','))
+    return [
+        f"delete from {table} where {not_null} and id not in \
+        (select max(id) from {table} where {not_null} group by {columns})",
+        f"create unique index if not exists {name} on {table} ({columns})",
+    ]
+
+
+def rehash_expressions(conn):
+    """
+    hash every alpha and queued simulation again with the canonical form of worldquant/utils.py,
+    a change of the canonical form needs a new migration running this step. a queued row hashing
+    the same as another one is removed, unless a worker holds it.
+    """
+    from worldquant.utils import simulation_hash, settings_from_columns
+    import json
+
+    conn.execute(text("update alpha set expression_hash = null"))
+    conn.execute(text("update simulation_queue set expression_hash = null"))
+    rows = conn.execute(text("select * from alpha where expression is not null")).all()
+    if rows:
+        conn.execute(text("update alpha set expression_hash = :expression_hash where id = :id"), [
+            {'id': row.id, 'expression_hash': simulation_hash(row.expression, settings_from_columns(row))}
+            for row in rows
+        ])
+    rows = conn.execute(text("select id, regular, settings from simulation_queue")).all()
+    if rows:
+        # a queued duplicate violates the unique index and keeps a null hash
+        conn.execute(text("update or ignore simulation_queue set expression_hash = :expression_hash where id = :id"), [
+            {'id': row.id, 'expression_hash': simulation_hash(row.regular, json.loads(row.settings))}
+            for row in rows
+        ])
+        conn.execute(text("delete from simulation_queue where expression_hash is null and status = 'QUEUED'"))
+        logger.info(f'hashed {len(rows)} queued simulations')
+
+
+MIGRATIONS = [
+    (1, 'content hash, lease and priority columns, unique keys', [
+        add_column('alpha', 'expression_hash', 'varchar(40)'),
+        add_column('alpha', 'template_id', 'integer'),
+        add_column('alpha', 'params', 'json'),
+        add_column('simulation_queue', 'expression_hash', 'varchar(40)'),
+        add_column('simulation_queue', 'params', 'json'),
+        add_column('simulation_queue', 'priority', "integer default '0'"),
+        add_column('simulation_queue', 'status', "varchar(10) default 'QUEUED'"),
+        add_column('simulation_queue', 'worker_id', 'varchar(100)'),
+        add_column('simulation_queue', 'lease_expires_at', 'timestamp'),
+        # upsert of the synced alphas and of the data fields
+        *unique_index('alpha_alpha_id', 'alpha', 'alpha_id'),
+        *unique_index('data_field_natural_key', 'data_field', 'field_name, region, delay, universe, type, dataset_id'),
+        # a simulation is queued once
+        *unique_index('simulation_queue_expression_hash', 'simulation_queue', 'expression_hash'),
+        "create index if not exists alpha_expression_hash on alpha (expression_hash)",
+        "create index if not exists simulation_queue_status on simulation_queue (status, id)",
+        "create index if not exists simulation_queue_priority on simulation_queue (status, priority, id)",
+    ]),
+    (2, 'indexes of the hot queries', [
+        # status filters of the check stage and the keyset paging of iter_alpha_ids
+        "create index if not exists alpha_status on alpha (status, id)",
+        # submission candidates ordered by sharpe, the negative direction scan
+        "create index if not exists alpha_status_sharpe on alpha (status, sharpe)",
+        "create index if not exists alpha_sharpe_fitness on alpha (sharpe, fitness)",
+        # claim, prune and delete of one template, lease renew and release of one worker
+        "create index if not exists simulation_queue_template_id on simulation_queue (template_id, status, priority, id)",
+        "create index if not exists simulation_queue_worker_id on simulation_queue (worker_id, status)",
+        # data field criteria of the templates
+        "create index if not exists data_field_dataset_id on data_field (dataset_id, type, region, delay, universe)",
+        "create index if not exists data_field_category_id on data_field (category_id, subcategory_id)",
+        "analyze",
+    ]),
+    (3, 'expression hashes of the canonical form 2', [
+        rehash_expressions,
+        # the version of the canonical form used to be kept with the sync watermarks
+        "delete from sync_state where sync_key = 'expression_hash_version'",
+    ]),
+    (4, 'data field natural key on the nullable columns', [
+        # sqlite takes nulls as distinct, a field with a null dataset_id or type was inserted again on every refresh
+        "drop index if exists data_field_natural_key",
+        "delete from data_field where id not in (select max(id) from data_field group by field_name, \
+        coalesce(region, ''), coalesce(delay, ''), coalesce(universe, ''), coalesce(type, ''), coalesce(dataset_id, ''))",
+        "create unique index if not exists data_field_natural_key on data_field (field_name, \
+        coalesce(region, ''), coalesce(delay, ''), coalesce(universe, ''), coalesce(type, ''), coalesce(dataset_id, ''))",
+    ]),
+]
+
+
+def get_version(conn):
+    return conn.execute(text("pragma user_version")).scalar()
+
+
+def migrate(engine):
+    """apply the pending migrations, returns the version of the database"""
+    with engine.connect() as conn:
+        version = get_version(conn)
+    for number, description, statements in MIGRATIONS:
+        if number <= version:
+            continue
+        with engine.begin() as conn:
+            for statement in statements:
+                if callable(statement):
+                    statement(conn)
+                else:
+                    conn.execute(text(statement))
+            # pragma does not take bound parameters
+            conn.execute(text(f"pragma user_version = {int(number)}"))
+        logger.info(f'database migrated to version {number}, {description}')
+        version = number
+    return version
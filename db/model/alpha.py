@@ -1,10 +1,11 @@
-from sqlalchemy import Column, Integer, String, Text, Numeric, TIMESTAMP, Boolean, Float
+from sqlalchemy import Column, Integer, String, Text, Numeric, TIMESTAMP, Boolean, Float, JSON
 from sqlalchemy.sql import func
 from db.database import Base
 
 
 class Alpha(Base):
     __tablename__ = "alpha"
+    # the columns added to the original schema and the indexes of the table are created by db/migrations.py
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     alpha_id = Column(String(10))
@@ -36,5 +37,8 @@ class Alpha(Base):
     returns = Column(Float)
     margin = Column(Float)
     pnl = Column(Float)
+    expression_hash = Column(String(40))
+    template_id = Column(Integer)
+    params = Column(JSON)
     created_at = Column(TIMESTAMP, server_default=func.now())
     updated_at = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now())
@@ -4,6 +4,7 @@ from db.database import Base
 
 class DataField(Base):
     __tablename__ = "data_field"
+    # the columns added to the original schema and the indexes of the table are created by db/migrations.py
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     field_name = Column(String(100))
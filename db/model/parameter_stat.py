@@ -0,0 +1,25 @@
+from sqlalchemy import Column, Integer, String, Text, Float, Boolean, TIMESTAMP, Index
+from sqlalchemy.sql import func
+from db.database import Base
+
+
+class ParameterStat(Base):
+    __tablename__ = "parameter_stat"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    template_id = Column(Integer)
+    param_name = Column(String(100))
+    # json encoded value of the template parameter
+    param_value = Column(Text)
+    trials = Column(Integer, server_default='0')
+    best_sharpe = Column(Float)
+    best_fitness = Column(Float)
+    sum_sharpe = Column(Float)
+    sum_fitness = Column(Float)
+    pruned = Column(Boolean, server_default='0')
+    created_at = Column(TIMESTAMP, server_default=func.now())
+    updated_at = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        Index('parameter_stat_natural_key', 'template_id', 'param_name', 'param_value', unique=True),
+    )
@@ -0,0 +1,25 @@
+from sqlalchemy import Column, Integer, String, Text, TIMESTAMP, JSON
+from sqlalchemy.sql import func
+from db.database import Base
+
+
+class SimulationQueue(Base):
+    __tablename__ = "simulation_queue"
+    # the columns added to the original schema and the indexes of the table are created by db/migrations.py
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    template_id = Column(Integer)
+    regular = Column(Text)
+    settings = Column(JSON)
+    type = Column(String(10))
+    expression_hash = Column(String(40))
+    # values of the multi valued template parameters of this combination
+    params = Column(JSON)
+    # rows are claimed by ascending priority, a pruned parameter value pushes its rows back
+    priority = Column(Integer, server_default='0')
+    # QUEUED, or CLAIMED by worker_id until lease_expires_at
+    status = Column(String(10), server_default='QUEUED')
+    worker_id = Column(String(100))
+    lease_expires_at = Column(TIMESTAMP)
+    created_at = Column(TIMESTAMP, server_default=func.now())
+    updated_at = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now())
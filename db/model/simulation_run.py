@@ -0,0 +1,30 @@
+from sqlalchemy import Column, Integer, String, Text, TIMESTAMP, Index
+from sqlalchemy.sql import func
+from db.database import Base
+
+
+class SimulationRun(Base):
+    __tablename__ = "simulation_run"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    template_id = Column(Integer)
+    expression_hash = Column(String(40))
+    regular = Column(Text)
+    worker_id = Column(String(100))
+    simulate_id = Column(String(50))
+    alpha_id = Column(String(10))
+    # SUBMITTING, RUNNING, then the result of the simulation: COMPLETE, WARNING, ERROR, FAIL or REJECTED
+    status = Column(String(20))
+    check_status = Column(String(20))
+    error = Column(Text)
+    submitted_at = Column(TIMESTAMP)
+    completed_at = Column(TIMESTAMP)
+    checked_at = Column(TIMESTAMP)
+    created_at = Column(TIMESTAMP, server_default=func.now())
+    updated_at = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        Index('simulation_run_created_at', 'created_at'),
+        Index('simulation_run_template_id', 'template_id', 'created_at'),
+        Index('simulation_run_alpha_id', 'alpha_id'),
+    )
@@ -0,0 +1,12 @@
+from sqlalchemy import Column, String, TIMESTAMP
+from sqlalchemy.sql import func
+from db.database import Base
+
+
+class SyncState(Base):
+    __tablename__ = "sync_state"
+
+    sync_key = Column(String(200), primary_key=True)
+    watermark = Column(String(40))
+    created_at = Column(TIMESTAMP, server_default=func.now())
+    updated_at = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now())
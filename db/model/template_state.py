@@ -0,0 +1,19 @@
+from sqlalchemy import Column, Integer, String, JSON, TIMESTAMP
+from sqlalchemy.sql import func
+from db.database import Base
+
+
+class TemplateState(Base):
+    """the last expansion of a template into the queue, compared with on the next one to enqueue only the delta"""
+    __tablename__ = "template_state"
+
+    template_id = Column(Integer, primary_key=True)
+    file = Column(String(200))
+    # sha1 of the expression and the canonical settings
+    template_hash = Column(String(40))
+    # the resolved value lists of the parameters, data_field queries included
+    parameters = Column(JSON)
+    parameters_hash = Column(String(40))
+    combinations = Column(Integer)
+    created_at = Column(TIMESTAMP, server_default=func.now())
+    updated_at = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now())
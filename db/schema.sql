@@ -1,3 +1,6 @@
+-- the version of the last migration of db/migrations.py included below
+PRAGMA user_version = 4;
+
 create table alpha
 (
     id integer PRIMARY KEY AUTOINCREMENT,
@@ -30,10 +33,23 @@ create table alpha
     returns float,
     margin float,
     pnl float,
+    expression_hash varchar(40),
+    template_id integer,
+    params json,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+CREATE UNIQUE INDEX alpha_alpha_id ON alpha (alpha_id);
+
+CREATE INDEX alpha_expression_hash ON alpha (expression_hash);
+
+CREATE INDEX alpha_status ON alpha (status, id);
+
+CREATE INDEX alpha_status_sharpe ON alpha (status, sharpe);
+
+CREATE INDEX alpha_sharpe_fitness ON alpha (sharpe, fitness);
+
 CREATE TRIGGER update_alpha_timestamp
 AFTER UPDATE ON alpha
 FOR EACH ROW
@@ -63,6 +79,12 @@ create table data_field
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+CREATE UNIQUE INDEX data_field_natural_key ON data_field (field_name, coalesce(region, ''), coalesce(delay, ''), coalesce(universe, ''), coalesce(type, ''), coalesce(dataset_id, ''));
+
+CREATE INDEX data_field_dataset_id ON data_field (dataset_id, type, region, delay, universe);
+
+CREATE INDEX data_field_category_id ON data_field (category_id, subcategory_id);
+
 CREATE TRIGGER update_data_field_timestamp
 AFTER UPDATE ON data_field
 FOR EACH ROW
@@ -77,13 +99,124 @@ create table simulation_queue
     regular text,
     settings json,
     type varchar(10),
+    expression_hash varchar(40),
+    params json,
+    priority integer DEFAULT '0',
+    status varchar(10) DEFAULT 'QUEUED',
+    worker_id varchar(100),
+    lease_expires_at TIMESTAMP,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+CREATE INDEX simulation_queue_status ON simulation_queue (status, id);
+
+CREATE UNIQUE INDEX simulation_queue_expression_hash ON simulation_queue (expression_hash);
+
+CREATE INDEX simulation_queue_priority ON simulation_queue (status, priority, id);
+
+CREATE INDEX simulation_queue_template_id ON simulation_queue (template_id, status, priority, id);
+
+CREATE INDEX simulation_queue_worker_id ON simulation_queue (worker_id, status);
+
 CREATE TRIGGER update_simulation_queue_timestamp
 AFTER UPDATE ON simulation_queue
 FOR EACH ROW
 BEGIN
     UPDATE simulation_queue SET updated_at = CURRENT_TIMESTAMP WHERE id = OLD.id;
 END;
+
+
+create table sync_state
+(
+    sync_key varchar(200) PRIMARY KEY,
+    watermark varchar(40),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TRIGGER update_sync_state_timestamp
+AFTER UPDATE ON sync_state
+FOR EACH ROW
+BEGIN
+    UPDATE sync_state SET updated_at = CURRENT_TIMESTAMP WHERE sync_key = OLD.sync_key;
+END;
+
+
+create table parameter_stat
+(
+    id integer PRIMARY KEY AUTOINCREMENT,
+    template_id integer,
+    param_name varchar(100),
+    param_value text,
+    trials integer DEFAULT '0',
+    best_sharpe float,
+    best_fitness float,
+    sum_sharpe float,
+    sum_fitness float,
+    pruned boolean DEFAULT '0',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE UNIQUE INDEX parameter_stat_natural_key ON parameter_stat (template_id, param_name, param_value);
+
+CREATE TRIGGER update_parameter_stat_timestamp
+AFTER UPDATE ON parameter_stat
+FOR EACH ROW
+BEGIN
+    UPDATE parameter_stat SET updated_at = CURRENT_TIMESTAMP WHERE id = OLD.id;
+END;
+
+
+create table simulation_run
+(
+    id integer PRIMARY KEY AUTOINCREMENT,
+    template_id integer,
+    expression_hash varchar(40),
+    regular text,
+    worker_id varchar(100),
+    simulate_id varchar(50),
+    alpha_id varchar(10),
+    status varchar(20),
+    check_status varchar(20),
+    error text,
+    submitted_at TIMESTAMP,
+    completed_at TIMESTAMP,
+    checked_at TIMESTAMP,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX simulation_run_created_at ON simulation_run (created_at);
+
+CREATE INDEX simulation_run_template_id ON simulation_run (template_id, created_at);
+
+CREATE INDEX simulation_run_alpha_id ON simulation_run (alpha_id);
+
+CREATE TRIGGER update_simulation_run_timestamp
+AFTER UPDATE ON simulation_run
+FOR EACH ROW
+BEGIN
+    UPDATE simulation_run SET updated_at = CURRENT_TIMESTAMP WHERE id = OLD.id;
+END;
+
+
+create table template_state
+(
+    template_id integer PRIMARY KEY,
+    file varchar(200),
+    template_hash varchar(40),
+    parameters json,
+    parameters_hash varchar(40),
+    combinations integer,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TRIGGER update_template_state_timestamp
+AFTER UPDATE ON template_state
+FOR EACH ROW
+BEGIN
+    UPDATE template_state SET updated_at = CURRENT_TIMESTAMP WHERE template_id = OLD.template_id;
+END;
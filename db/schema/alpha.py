@@ -1,6 +1,6 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, TypeAdapter
 from datetime import datetime
-from typing import Optional
+from typing import Optional, List
 
 
 class AlphaBase(BaseModel):
@@ -33,6 +33,12 @@ class AlphaBase(BaseModel):
     returns: Optional[float] = None
     margin: Optional[float] = None
     pnl: Optional[float] = None
+    expression_hash: Optional[str] = None
+    template_id: Optional[int] = None
+    params: Optional[dict] = None
+
+
+AlphaBaseList = TypeAdapter(List[AlphaBase])
 
 
 class Alpha(AlphaBase):
@@ -1,6 +1,6 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, TypeAdapter
 from datetime import datetime
-from typing import Optional
+from typing import Optional, List
 
 
 class DataFieldBase(BaseModel):
@@ -21,6 +21,9 @@ class DataFieldBase(BaseModel):
     alpha_count: Optional[int] = None
 
 
+DataFieldBaseList = TypeAdapter(List[DataFieldBase])
+
+
 class DataField(DataFieldBase):
     id: int
     created_at: datetime
@@ -1,5 +1,7 @@
 from worldquant.service import WorldQuantService
 from worldquant.alpha import AlphaTemplate
+from worldquant.engine import AsyncSimulationEngine
+from worldquant.metrics import start_metrics_server
 from loguru import logger
 import sys
 import argparse
@@ -13,17 +15,25 @@ if __name__ == '__main__':
     parser.add_argument('--start_date', help='start date')
     parser.add_argument('--end_date', help='end date')
     parser.add_argument('--status', help='status')
+    parser.add_argument('--full', action='store_true', help='full resync or template expansion instead of the incremental one')
 
     parser.add_argument('--simulation_status', '-p', action='store_true', help='print simulation status')
     parser.add_argument('--simulation_queue', '-q', help='load simulation_queue from template')
     parser.add_argument('--append', action='store_true', help='append simulation_queue')
+    parser.add_argument('--sample', type=int, help='queue a sample of this size instead of every combination')
+    parser.add_argument('--sampling', choices=['uniform', 'stratified', 'lhs'], help='sampling mode of --sample, uniform by default')
+    parser.add_argument('--seed', type=int, help='random seed of --sample')
+    parser.add_argument('--prescreen', nargs='?', const = True, help='backtest the queued alphas locally and drop or push back the hopeless ones')
     parser.add_argument('--shuffle', action='store_true', help='shuffle simulation_queue')
     parser.add_argument('--stats', action='store_true',  help='print stats')
+    parser.add_argument('--engine', choices=['thread', 'async'], default='thread', help='simulation engine')
+    parser.add_argument('--until_empty', action='store_true', help='stop the simulation once the queue is empty')
 
     parser.add_argument('--check', '-c', nargs='?', const = True, help='refresh alpha checks for completed simulations')
     parser.add_argument('--simulation', '-s', nargs='?', const = True, help='start simulation')
     parser.add_argument('--submit', '-S', nargs='?', const = True, help='find and submit alpha, or specify the alpha_id')
     parser.add_argument('--debug', action='store_true', help='enable debug mode')
+    parser.add_argument('--metrics_port', type=int, help='serve prometheus metrics at http://0.0.0.0:port/metrics')
     
     # parser.add_argument('--check_negative', '-n', nargs='?', const = True, help='check negative alpha')
     
@@ -38,19 +48,26 @@ if __name__ == '__main__':
     )
     
     service = WorldQuantService()
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
 
     if args.data_fields:
         service.refresh_datafields()
     
     if args.refresh_alphas:
-        service.refresh_alphas(start_date = args.start_date, end_date=args.end_date, status = args.status)
+        service.refresh_alphas(start_date = args.start_date, end_date=args.end_date, status = args.status, full = args.full)
 
     if args.simulation_status:
         service.print_simulation_status()
     
     if args.simulation_queue:
         at = AlphaTemplate(args.simulation_queue)
-        at.load_simulation_queue(append = args.append)
+        at.load_simulation_queue(
+            append = args.append, full = args.full, sample_size = args.sample, sampling = args.sampling, seed = args.seed
+        )
+
+    if args.prescreen:
+        service.prescreen_queue(template_id = None if args.prescreen == True else args.prescreen)
 
     if args.simulation:
         kwargs = {}
@@ -58,7 +75,11 @@ if __name__ == '__main__':
             kwargs["template_id"] = args.simulation
         kwargs["shuffle"] = args.shuffle
         kwargs["stats"] = args.stats
-        service.simulate_from_alpha_queue(**kwargs)
+        kwargs["until_empty"] = args.until_empty
+        if args.engine == 'async':
+            AsyncSimulationEngine(service).run(**kwargs)
+        else:
+            service.simulate_from_alpha_queue(**kwargs)
 
     if args.check:
         if args.check == True:
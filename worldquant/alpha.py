@@ -2,14 +2,46 @@ import os
 import yaml
 import re
 import json
+import hashlib
 
 from loguru import logger
 from itertools import product
+from math import prod
 
 from db.crud.data_field import get_data_fields_by_criteria
-from db.crud.simulation_queue import insert_queue, delete_queue_by_template_id
+from db.crud.simulation_queue import insert_queue_batch, delete_queue_by_template_id, prune_queue
+from db.crud.parameter_stat import get_pruned_parameters, encode_parameter_value
+from db.crud.template_state import get_template_state, upsert_template_state
 from db.database import SessionLocal
-from worldquant.utils import load_config
+from worldquant.utils import load_config, dict_to_namespace, canonical_settings, content_hash, canonical_hash
+from worldquant.expression import ExpressionTemplate, ExpressionError, parse, canonical_node, normalize
+from worldquant.sampling import ParameterSpace, sample
+from worldquant.validator import get_validator
+from worldquant.metrics import EXPRESSION_REJECTIONS
+
+
+# path of a template file -> (mtime, parsed yaml)
+_TEMPLATE_CACHE = {}
+
+def load_templates(directory = 'templates'):
+    """the yaml templates keyed by their id as a string, a file is parsed again only once it is modified"""
+    templates = {}
+    for file in sorted(os.listdir(directory)):
+        if not re.match(r'(.*)\.yaml', file):
+            continue
+        path = os.path.join(directory, file)
+        mtime = os.path.getmtime(path)
+        cached = _TEMPLATE_CACHE.get(path)
+        if cached is None or cached[0] != mtime:
+            with open(path, 'r') as f:
+                cached = (mtime, yaml.safe_load(f) or {})
+            _TEMPLATE_CACHE[path] = cached
+        templates[str(cached[1].get('id'))] = (file, cached[1])
+    return templates
+
+
+def _hash(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
 
 
 class AlphaTemplate():
@@ -18,33 +50,35 @@ class AlphaTemplate():
         self.template_expression = ''
         self.template_parameters = {}
         self.template_settings = {}
+        self.template_sampling = {}
         self.default_settings = load_config('default_settings')
+        self.config = dict_to_namespace(load_config('simulation'))
         self.settings = {}
         self.parameters = {}
+        self.file = None
+        # reason -> (count, first message) of the combinations rejected by the validator
+        self.rejections = {}
 
         self.db = SessionLocal()
         self._read_template(template_id)
 
 
     def _read_template(self, template_id):
-        template = {}
-        for file in os.listdir('templates'):
-            m = re.match(r'(.*)\.yaml', file)
-            if not m:
-                continue
-            with open(f'templates/{file}', 'r') as f:
-                template = yaml.safe_load(f)
-                if str(template.get('id')) == template_id:
-                    logger.debug(f'found template {file}')
-                    self.template_id = template_id
-                    self.template_expression = template.get('expression')
-                    self.template_parameters = template.get('parameters')
-                    self.template_settings = template.get('settings', {})
-                    self.settings = {
-                        **self.default_settings,
-                        **(self.template_settings if self.template_settings else {})
-                    }
-                    self._get_parameters()
+        found = load_templates().get(str(template_id))
+        if found:
+            file, template = found
+            logger.debug(f'found template {file}')
+            self.file = file
+            self.template_id = template_id
+            self.template_expression = template.get('expression')
+            self.template_parameters = template.get('parameters')
+            self.template_settings = template.get('settings', {})
+            self.template_sampling = template.get('sampling') or {}
+            self.settings = {
+                **self.default_settings,
+                **(self.template_settings if self.template_settings else {})
+            }
+            self._get_parameters()
         if self.template_id == None:
             logger.warning(f'template_id {template_id} not found')
 
@@ -72,19 +106,171 @@ class AlphaTemplate():
                 self.parameters[key] = value_list
 
 
-    def load_simulation_queue(self, template_id = None, append = False):
+    def load_simulation_queue(self, template_id = None, append = False, full = False, sample_size = None, sampling = None, seed = None):
+        """
+        queue the combinations of the template. the expansion is recorded in template_state, when only
+        parameter lists changed since, e.g. new data fields, only the new combinations are queued and
+        the queued ones of the removed values are dropped. a changed expression or settings, or `full`,
+        re-queues the template from scratch. `append` queues every combination on top of the queue.
+
+        with `sample_size`, or `sampling.size` in the template, only a sample of the combinations is
+        queued on top of the queue, see load_sample.
+        """
         if template_id == None:
             self._read_template(template_id)
         if self.template_id == None:
             logger.warning(f'template not loaded')
             return
-        if not append:
+        sample_size = sample_size or self.template_sampling.get('size')
+        if sample_size:
+            return self.load_sample(
+                sample_size, sampling or self.template_sampling.get('mode', 'uniform'),
+                seed if seed is not None else self.template_sampling.get('seed'), self.template_sampling.get('stratify')
+            )
+        template_hash = _hash({'expression': self.template_expression, 'settings': canonical_settings(self.settings)})
+        parameters_hash = _hash(self.parameters)
+        total = prod(len(values) for values in self.parameters.values())
+        state = None if append or full else get_template_state(self.db, self.template_id)
+
+        combos = None
+        if state is not None and state.template_hash == template_hash and self._is_delta_possible(state.parameters):
+            if state.parameters_hash == parameters_hash:
+                logger.info(f'template {self.template_id} unchanged since its last expansion, nothing to queue')
+                return
+            combos, total = self._delta_combinations(state.parameters)
+            self._drop_removed_values(state.parameters)
+        elif not append:
             delete_queue_by_template_id(self.db, self.template_id)
             logger.debug(f'deleted template_id {self.template_id} in the queue')
-        keys = self.parameters.keys()
-        values = self.parameters.values()
-        params_list = [dict(zip(keys, combo)) for combo in product(*values)]
-        for params in params_list:
-            expression = self.template_expression.format(**params).strip()
-            insert_queue(self.db, expression, json.dumps(self.settings), template_id = self.template_id)
-        logger.info(f'add {len(params_list)} alphas to the queue')
+        count = insert_queue_batch(self.db, self._iter_simulations(combos), batch_size = self.config.queue_batch_size)
+        logger.info(f'add {count} alphas to the queue, skipped {total - count} already queued, simulated, pruned or invalid')
+        self._report_rejections()
+        upsert_template_state(
+            self.db, self.template_id, self.file, template_hash, self.parameters, parameters_hash,
+            prod(len(values) for values in self.parameters.values())
+        )
+
+
+    def load_sample(self, size, mode = 'uniform', seed = None, stratify = None):
+        """
+        queue `size` combinations drawn from the product of the parameters without materializing it,
+        `mode` is uniform, stratified (evenly over the values of the parameter `stratify`) or lhs
+        (latin hypercube). the same seed draws the same sample, another one a new slice, the queued
+        or simulated combinations are skipped. the sample is not recorded in template_state.
+        """
+        space = ParameterSpace(self.parameters)
+        kwargs = {'key': stratify} if mode == 'stratified' else {}
+        indices = sample(space, size, mode, seed, **kwargs)
+        combos = (space[index] for index in indices)
+        count = insert_queue_batch(self.db, self._iter_simulations(combos), batch_size = self.config.queue_batch_size)
+        logger.info(
+            f'add {count} alphas to the queue from a {mode} sample of {min(size, space.size)} out of {space.size} '
+            f'combinations, seed {seed}'
+        )
+        self._report_rejections()
+        return count
+
+
+    def _report_rejections(self):
+        """log and count by reason the combinations the validator kept out of the queue"""
+        if not self.rejections:
+            return
+        for reason, (count, _) in self.rejections.items():
+            EXPRESSION_REJECTIONS.inc(count, template_id = self.template_id, reason = reason, stage = 'queue')
+        counts = ', '.join(f'{reason} {count}' for reason, (count, _) in self.rejections.items())
+        logger.warning(f'template {self.template_id}: {sum(count for count, _ in self.rejections.values())} invalid expressions not queued, {counts}')
+        for reason, (_, message) in self.rejections.items():
+            logger.warning(f'template {self.template_id}: {reason}, e.g. {message}')
+
+
+    def _is_delta_possible(self, previous):
+        """
+        the same parameters, and no removed value of a single valued one, as its queued rows
+        cannot be told apart from the kept ones
+        """
+        if list(previous) != list(self.parameters):
+            return False
+        for key, values in previous.items():
+            current = {encode_parameter_value(value) for value in self.parameters[key]}
+            if len(values) < 2 and any(encode_parameter_value(value) not in current for value in values):
+                return False
+        return True
+
+
+    def _delta_combinations(self, previous):
+        """
+        the combinations of the current parameter lists missing from the `previous` ones, with their count.
+        a new combination has a first parameter holding a new value, grouping them by that parameter
+        gives disjoint products: the values kept before it, the new values at it, any value after it.
+        """
+        keys = list(self.parameters)
+        kept = []
+        added = []
+        for key in keys:
+            before = {encode_parameter_value(value) for value in previous[key]}
+            kept.append([value for value in self.parameters[key] if encode_parameter_value(value) in before])
+            added.append([value for value in self.parameters[key] if encode_parameter_value(value) not in before])
+        groups = [kept[:i] + [added[i]] + [self.parameters[key] for key in keys[i + 1:]] for i in range(len(keys))]
+        total = sum(prod(len(values) for values in group) for group in groups)
+        changes = ', '.join(f'{key} +{len(added[i])}' for i, key in enumerate(keys) if added[i])
+        logger.info(f'template {self.template_id} changed, {total} new combinations {changes}')
+        return (combo for group in groups for combo in product(*group)), total
+
+
+    def _drop_removed_values(self, previous):
+        """drop the queued combinations of the values no longer in a parameter list"""
+        for key, values in previous.items():
+            # params of the queued rows only hold the parameters which had several values
+            if len(values) < 2:
+                continue
+            current = {encode_parameter_value(value) for value in self.parameters[key]}
+            for value in values:
+                encoded = encode_parameter_value(value)
+                if encoded not in current:
+                    count = prune_queue(self.db, self.template_id, key, encoded, drop = True)
+                    logger.info(f'{key}={value} removed from template {self.template_id}, dropped {count} queued alphas')
+
+
+    def _iter_simulations(self, combos = None):
+        keys = list(self.parameters.keys())
+        settings = json.dumps(self.settings)
+        canonical = canonical_settings(self.settings)
+        # only the parameters with several values are tracked for pruning
+        tracked = [key for key in keys if len(self.parameters[key]) > 1]
+        pruned = get_pruned_parameters(self.db, self.template_id)
+        validator = None
+        if self.config.validation.enabled:
+            validator = get_validator(self.db, self.settings, self.config.validation.catalog_ttl)
+        self.rejections = {}
+        # each expansion is parsed once, its AST is both validated and hashed
+        template = ExpressionTemplate(self.template_expression)
+        if combos is None:
+            combos = product(*self.parameters.values())
+        for combo in combos:
+            values = dict(zip(keys, combo))
+            if pruned and any((key, encode_parameter_value(values[key])) in pruned for key in tracked):
+                continue
+            expression = self.template_expression.format(**values).strip()
+            tree, canonical_expression = template.expand(values)
+            error = None
+            if tree is None:
+                try:
+                    tree = parse(expression)
+                    canonical_expression = canonical_node(normalize(tree))
+                except ExpressionError as e:
+                    error = ('syntax', str(e))
+            if validator and not error:
+                error = validator.validate_tree(tree)
+            # without a validator the expressions which do not parse are queued all the same
+            if validator and error:
+                count, message = self.rejections.get(error[0], (0, error[1]))
+                self.rejections[error[0]] = (count + 1, message)
+                continue
+            yield {
+                'regular': expression,
+                'settings': settings,
+                'type': 'REGULAR',
+                'template_id': self.template_id,
+                'expression_hash': content_hash(expression, canonical) if tree is None else canonical_hash(canonical_expression, canonical),
+                'params': json.dumps({key: values[key] for key in tracked})
+            }
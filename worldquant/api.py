@@ -1,60 +1,383 @@
+import httpx
 import requests
 from requests.auth import HTTPBasicAuth
 from loguru import logger
-from worldquant.utils import add_params_to_url, load_config
+from worldquant.utils import add_params_to_url, load_config, load_credential, get_base_url
+from worldquant.metrics import API_RESPONSES
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
+
+import asyncio
+import threading
+import time
+
+
+# requests per second of each endpoint class, overridden by `rate_limits` in config/simulation.json
+DEFAULT_RATE_LIMITS = {
+    'simulations': {'rate': 1, 'burst': 5, 'min_rate': 0.05, 'max_rate': 5},
+    'alpha_reads': {'rate': 5, 'burst': 10, 'min_rate': 0.2, 'max_rate': 20},
+    'checks': {'rate': 1, 'burst': 3, 'min_rate': 0.05, 'max_rate': 5},
+    'submits': {'rate': 0.2, 'burst': 1, 'min_rate': 0.01, 'max_rate': 1},
+}
+
+
+# endpoint class, i.e. rate limit, of each api call
+ENDPOINT_CLASSES = {
+    'post_simulation': 'simulations',
+    'get_simulation_status': 'alpha_reads',
+    'get_alpha': 'alpha_reads',
+    'get_pnl': 'alpha_reads',
+    'search_alpha': 'alpha_reads',
+    'get_datafields': 'alpha_reads',
+    'check_alpha': 'checks',
+    'submit_alpha': 'submits',
+}
+
+
+class RateLimiter():
+    """
+    token bucket of one endpoint class, shared by every thread and coroutine of the process.
+    a caller reserves a token and sleeps until it is due, so concurrent callers are spread out
+    at `rate` instead of retrying together. the rate adapts to the platform: it creeps up on
+    success, slower once close to the rate of the last 429, and is cut back on a 429, the bucket
+    is then paused for the `Retry-After` of the response.
+    """
+    def __init__(self, name, rate, burst, min_rate, max_rate, increase = 0.05, decrease = 0.7):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.ceiling = None
+        self.throttled_cnt = 0
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+
+    def _reserve(self):
+        with self.lock:
+            now = time.monotonic()
+            if now > self.updated:
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+            # a negative balance queues the caller behind the earlier reservations
+            self.tokens -= 1
+            delay = self.updated - now
+            if self.tokens < 0:
+                delay += -self.tokens / self.rate
+            return delay
+
+
+    def _pause_left(self):
+        return self.paused_until - time.monotonic()
+
+
+    def acquire(self):
+        time.sleep(max(self._reserve(), 0))
+        while self._pause_left() > 0:
+            time.sleep(self._pause_left())
+
+
+    async def acquire_async(self):
+        await asyncio.sleep(max(self._reserve(), 0))
+        while self._pause_left() > 0:
+            await asyncio.sleep(self._pause_left())
+
+
+    def pause(self, seconds):
+        with self.lock:
+            now = time.monotonic()
+            if now + seconds > self.paused_until:
+                self.paused_until = now + seconds
+                # nothing refills while paused
+                self.tokens = min(self.tokens, 0)
+                self.updated = max(self.updated, self.paused_until)
+
+
+    def observe(self, response):
+        """adapt the rate to the status of a response"""
+        if response.status_code == 429:
+            retry_after = _retry_after(response)
+            if _response_detail(response) == 'DAILY_SIMULATION_LIMIT_EXCEEDED':
+                # a quota, not a rate, the rate is left as it is
+                self.pause(retry_after or 10 * 60)
+                return
+            with self.lock:
+                # the 429s of requests already in flight during a pause are counted once
+                if time.monotonic() >= self.paused_until:
+                    self.ceiling = self.rate
+                    self.rate = max(self.min_rate, self.rate * self.decrease)
+                    self.throttled_cnt += 1
+            self.pause(retry_after or 1 / self.rate)
+        elif response.status_code < 400:
+            with self.lock:
+                # additive increase of about `increase` per second, ten times slower near the ceiling
+                step = self.increase / self.rate
+                if self.ceiling is not None and self.rate >= self.ceiling * 0.9:
+                    step /= 10
+                self.rate = min(self.max_rate, self.rate + step)
+
+
+def _retry_after(response):
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+def _response_detail(response):
+    try:
+        return response.json().get('detail')
+    except Exception:
+        return None
+
+
+_LIMITERS = {}
+_LIMITERS_LOCK = threading.Lock()
+
+def get_limiter(endpoint):
+    """the process wide limiter of an endpoint class"""
+    with _LIMITERS_LOCK:
+        if endpoint not in _LIMITERS:
+            limits = load_config('simulation').get('rate_limits', {})
+            _LIMITERS[endpoint] = RateLimiter(endpoint, **{**DEFAULT_RATE_LIMITS[endpoint], **limits.get(endpoint, {})})
+        return _LIMITERS[endpoint]
 
 
 class WorldQuantSession():
     def __init__(self):
-        self.base_url = 'https://api.worldquantbrain.com'
+        self.base_url = get_base_url()
         self.session = None
+        # bumped by every sign in, a 401 of an older generation was already signed in again by another thread
+        self.generation = 0
+        self.sign_in_lock = threading.Lock()
         self._sign_in()
         
 
-    def _sign_in(self):
+    def _sign_in(self, generation = None):
+        """sign in again, unless `generation`, the one a 401 came from, was already replaced by another thread"""
+        with self.sign_in_lock:
+            if generation is not None and generation != self.generation:
+                return self.session
+            return self._authenticate()
+
+
+    def _authenticate(self):
         sess = requests.Session()
-        cred = load_config('credential')
+        cred = load_credential()
         sess.auth = HTTPBasicAuth(cred['username'], cred['password'])
         response = sess.post(f'{self.base_url}/authentication')
         if response.status_code == 201:
-            logger.info(f'login status code {response.status_code}, user {response.json().get('user').get('id')}')
+            logger.info(f'login status code {response.status_code}, user {response.json().get("user").get("id")}')
             self.session = sess
+            self.generation += 1
             return sess
         else:
             logger.error(f'fail to login status code {response.status_code}, {response.text}')
             exit()
+
+
+    def _request(self, operation, method, url, **kwargs):
+        """
+        send a request within the budget of its endpoint class, a 429 is waited out and retried.
+        the response carries the `generation` of the session it was sent with, pass it to `_sign_in` on a 401.
+        """
+        endpoint = ENDPOINT_CLASSES[operation]
+        limiter = get_limiter(endpoint)
+        while True:
+            limiter.acquire()
+            generation = self.generation
+            response = self.session.request(method, url, **kwargs)
+            response.generation = generation
+            limiter.observe(response)
+            API_RESPONSES.inc(endpoint = operation, code = response.status_code)
+            if response.status_code != 429:
+                return response
+            logger.warning(f'{endpoint} throttled, {response.text}, rate {limiter.rate:.2f}/s')
         
 
+    def get_pages(self, fetch, limit, fan_out = 4, retries = 3, failed_offsets = None):
+        """
+        sweep an offset paginated endpoint, `fetch(limit, offset)` returns the response of one page.
+        pages after the first one are fetched concurrently by up to `fan_out` threads and the
+        `results` of each page are yielded as soon as it arrives, so at most one window of pages
+        is held in memory. a failed page is retried on its own without restarting the sweep,
+        the offsets of the pages given up are appended to `failed_offsets` if it is provided.
+        """
+        first = self._get_page(fetch, limit, 0, retries)
+        if first is None:
+            if failed_offsets is not None:
+                failed_offsets.append(0)
+            return
+        count = first.get('count', 0)
+        logger.debug(f'found {count} results, fetching {limit} per page with fan out {fan_out}')
+        yield first.get('results', [])
+
+        offsets = iter(range(limit, count, limit))
+        with ThreadPoolExecutor(max_workers = fan_out) as executor:
+            pending = {
+                executor.submit(self._get_offset_page, fetch, limit, offset, retries) for offset in islice(offsets, fan_out)
+            }
+            while pending:
+                done, pending = wait(pending, return_when = FIRST_COMPLETED)
+                for future in done:
+                    offset = next(offsets, None)
+                    if offset is not None:
+                        pending.add(executor.submit(self._get_offset_page, fetch, limit, offset, retries))
+                    page, page_offset = future.result()
+                    if page is not None:
+                        yield page.get('results', [])
+                    elif failed_offsets is not None:
+                        failed_offsets.append(page_offset)
+
+
+    def _get_offset_page(self, fetch, limit, offset, retries):
+        return self._get_page(fetch, limit, offset, retries), offset
+
+
+    def _get_page(self, fetch, limit, offset, retries):
+        for attempt in range(retries + 1):
+            try:
+                response = fetch(limit = limit, offset = offset)
+                if response.status_code == 200:
+                    return response.json()
+                logger.warning(f'fail to fetch page at offset {offset}, {response.status_code}, {response.text}')
+                if response.status_code == 401:
+                    self._sign_in(response.generation)
+            except requests.RequestException as e:
+                logger.warning(f'fail to fetch page at offset {offset}, {e}')
+            if attempt < retries:
+                time.sleep(min(5 * 2 ** attempt, 60))
+        logger.error(f'give up the page at offset {offset} after {retries} retries')
+        return None
+
+
     def get_datafields(self, params, limit = 50, offset = 0):
         url = add_params_to_url(f'{self.base_url}/data-fields?limit={limit}&offset={offset}', params)
-        return self.session.get(url)
+        return self._request('get_datafields', 'GET', url)
     
 
     def get_simulation_status(self, simulate_id):
         url = f'{self.base_url}/simulations/{simulate_id}'
-        return self.session.get(url)
+        return self._request('get_simulation_status', 'GET', url)
 
 
     def submit_alpha(self, alpha_id):
         url = f"{self.base_url}/alphas/{alpha_id}/submit"
-        return self.session.post( url, json={}, timeout=(10, 30))
+        return self._request('submit_alpha', 'POST', url, json={}, timeout=(10, 30))
     
 
     def check_alpha(self, alpha_id):
         url = f"{self.base_url}/alphas/{alpha_id}/check"
-        return self.session.get(url)
+        return self._request('check_alpha', 'GET', url)
     
 
     def get_alpha(self, alpha_id):
         url = f"{self.base_url}/alphas/{alpha_id}"
-        return self.session.get(url)
+        return self._request('get_alpha', 'GET', url)
     
 
+    def get_pnl(self, alpha_id):
+        """daily cumulative pnl recordset, an empty 200 with Retry-After while it is computed"""
+        url = f"{self.base_url}/alphas/{alpha_id}/recordsets/pnl"
+        return self._request('get_pnl', 'GET', url)
+
+
     def search_alpha(self, params, limit = 100, offset = 0):
         url = add_params_to_url(f"{self.base_url}/users/self/alphas?limit={limit}&offset={offset}", params)
-        return self.session.get(url)
+        return self._request('search_alpha', 'GET', url)
     
 
     def post_simulation(self, simulation):
         url = f'{self.base_url}/simulations'
-        return self.session.post(url, json=simulation)
+        return self._request('post_simulation', 'POST', url, json=simulation)
+
+
+class AsyncWorldQuantSession():
+    """
+    asyncio counterpart of WorldQuantSession, one client is shared by every coroutine of the event loop.
+    call `await sign_in()` before using it and `await close()` when done.
+    """
+    def __init__(self, max_connections = 100):
+        self.base_url = get_base_url()
+        self.session = None
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self.timeout = httpx.Timeout(30, connect=10)
+        self.generation = 0
+        self.sign_in_lock = None
+
+
+    async def sign_in(self, generation = None):
+        """
+        sign in again on the shared client, its cookie jar is updated in place so the coroutines in flight
+        keep a usable client. only one coroutine signs in at a time, the ones whose 401 came from an older
+        `generation` wait for the new session instead of signing in themselves.
+        """
+        if self.sign_in_lock is None:
+            self.sign_in_lock = asyncio.Lock()
+        async with self.sign_in_lock:
+            if generation is not None and generation != self.generation:
+                return self.session
+            if self.session is None:
+                cred = load_credential()
+                self.session = httpx.AsyncClient(
+                    auth=httpx.BasicAuth(cred['username'], cred['password']),
+                    limits=self.limits,
+                    timeout=self.timeout
+                )
+            response = await self.session.post(f'{self.base_url}/authentication')
+            if response.status_code == 201:
+                logger.info(f'login status code {response.status_code}, user {response.json().get("user").get("id")}')
+                self.generation += 1
+                return self.session
+            else:
+                logger.error(f'fail to login status code {response.status_code}, {response.text}')
+                await self.close()
+                exit()
+
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.aclose()
+            self.session = None
+        # the lock belongs to the event loop of the run, a new run gets a new one
+        self.sign_in_lock = None
+
+
+    async def _request(self, operation, method, url, **kwargs):
+        endpoint = ENDPOINT_CLASSES[operation]
+        limiter = get_limiter(endpoint)
+        while True:
+            await limiter.acquire_async()
+            generation = self.generation
+            response = await self.session.request(method, url, **kwargs)
+            response.generation = generation
+            limiter.observe(response)
+            API_RESPONSES.inc(endpoint = operation, code = response.status_code)
+            if response.status_code != 429:
+                return response
+            logger.warning(f'{endpoint} throttled, {response.text}, rate {limiter.rate:.2f}/s')
+
+
+    async def get_simulation_status(self, simulate_id):
+        url = f'{self.base_url}/simulations/{simulate_id}'
+        return await self._request('get_simulation_status', 'GET', url)
+
+
+    async def check_alpha(self, alpha_id):
+        url = f"{self.base_url}/alphas/{alpha_id}/check"
+        return await self._request('check_alpha', 'GET', url)
+
+
+    async def get_alpha(self, alpha_id):
+        url = f"{self.base_url}/alphas/{alpha_id}"
+        return await self._request('get_alpha', 'GET', url)
+
+
+    async def post_simulation(self, simulation):
+        url = f'{self.base_url}/simulations'
+        return await self._request('post_simulation', 'POST', url, json=simulation)
@@ -0,0 +1,651 @@
+"""
+local vectorized backtest of FASTEXPR expressions, a cheap approximation of a simulation used to
+pre-screen the queued expressions before they cost remote quota.
+
+the dataset is a directory of .npy matrices of the same shape, dates by instruments, memory-mapped:
+    returns.npy     daily returns of the instruments, required
+    <field>.npy     one matrix per data field, named after the field
+    <group>.npy     non negative integer codes of the groups, e.g. sector.npy, industry.npy, subindustry.npy
+    universe.npy    optional, True where the instrument is in the universe at the date
+row t of a field holds the value known at the close of day t, row t of returns the return from the
+close of day t - 1 to the close of day t.
+
+the operators work on whole matrices, vectorized over the instruments, the time series ones loop at
+most over the days of their window. the simulation applies the decay, neutralization, truncation and
+delay of the settings, nanHandling, pasteurization and unitHandling are ignored.
+"""
+from worldquant.expression import parse, ExpressionError
+
+import os
+import threading
+import warnings
+import numpy as np
+
+
+class BacktestError(ValueError):
+    pass
+
+
+class Dataset():
+    def __init__(self, path, cache_size = 32):
+        self.path = path
+        if not os.path.exists(os.path.join(path, 'returns.npy')):
+            raise BacktestError(f'no returns.npy in {path}')
+        self.lock = threading.Lock()
+        # field name -> read only memmap in the dtype of its file, the oldest loaded field is evicted first
+        self.cache = {}
+        self.cache_size = cache_size
+        self.shape = None
+        self.returns = self.field('returns')
+        self.shape = self.returns.shape
+        universe = os.path.join(path, 'universe.npy')
+        self.universe = np.load(universe, mmap_mode = 'r') if os.path.exists(universe) else None
+        if self.universe is not None and self.universe.dtype != bool:
+            self.universe = self.universe != 0
+
+
+    def field(self, name):
+        with self.lock:
+            matrix = self.cache.get(name)
+            if matrix is not None:
+                return matrix
+        file = os.path.join(self.path, f'{name}.npy')
+        if not os.path.exists(file):
+            raise BacktestError(f'no local data for {name}')
+        # the pages of the file are read on use and shared by the processes mapping it, a field stored
+        # in another dtype than float64 is cast by `values` per expression, never held cast in the cache
+        matrix = np.load(file, mmap_mode = 'r')
+        if self.shape is not None and matrix.shape != self.shape:
+            raise BacktestError(f'{name} is {matrix.shape}, expected {self.shape}')
+        with self.lock:
+            if len(self.cache) >= self.cache_size:
+                self.cache.pop(next(iter(self.cache)))
+            self.cache[name] = matrix
+        return matrix
+
+
+    def values(self, name):
+        """the field as float64, the memmap itself for a float64 file, else a copy owned by the caller"""
+        return np.asarray(self.field(name), dtype = np.float64)
+
+
+def _matrix(x):
+    if np.ndim(x) != 2:
+        raise BacktestError('expected a data field or an expression of data fields')
+    return x
+
+
+def _window(d):
+    if np.ndim(d) or int(d) < 1:
+        raise BacktestError(f'expected a number of days, got {d}')
+    return int(d)
+
+
+def _shift(x, d):
+    """x delayed by d days, NaN for the first d days"""
+    out = np.full_like(x, np.nan)
+    if d < len(x):
+        out[d:] = x[:len(x) - d]
+    return out
+
+
+def _rolling_sum(x, d):
+    """sum and count of the defined values of the last d days, NaN before the first full window"""
+    valid = ~np.isnan(x)
+    total = np.cumsum(np.where(valid, x, 0), axis = 0)
+    count = np.cumsum(valid, axis = 0).astype(np.float64)
+    total[d:] = total[d:] - total[:-d]
+    count[d:] = count[d:] - count[:-d]
+    total[:d - 1] = np.nan
+    total[count == 0] = np.nan
+    return total, count
+
+
+def _rolling_extreme(x, d, function):
+    out = x.copy()
+    for k in range(1, d):
+        out = function(out, _shift(x, k))
+    out[:d - 1] = np.nan
+    return out
+
+
+def _finite(x):
+    return np.where(np.isfinite(x), x, np.nan)
+
+
+# arithmetic
+
+def add(*args, filter = False):
+    return sum(np.nan_to_num(arg, nan = 0) if filter else arg for arg in args)
+
+
+def multiply(*args, filter = False):
+    out = 1
+    for arg in args:
+        out = out * (np.nan_to_num(arg, nan = 1) if filter else arg)
+    return out
+
+
+def subtract(x, y, filter = False):
+    return np.nan_to_num(x, nan = 0) - np.nan_to_num(y, nan = 0) if filter else x - y
+
+
+def divide(x, y):
+    return _finite(np.divide(x, y))
+
+
+def power(x, y):
+    return _finite(np.power(x, y))
+
+
+def signed_power(x, y):
+    return _finite(np.sign(x) * np.power(np.abs(x), y))
+
+
+def log(x):
+    return _finite(np.log(np.where(x > 0, x, np.nan)))
+
+
+def sqrt(x):
+    return np.sqrt(np.where(x >= 0, x, np.nan))
+
+
+def inverse(x):
+    return divide(1, x)
+
+
+def maximum(*args):
+    out = args[0]
+    for arg in args[1:]:
+        out = np.maximum(out, arg)
+    return out
+
+
+def minimum(*args):
+    out = args[0]
+    for arg in args[1:]:
+        out = np.minimum(out, arg)
+    return out
+
+
+# logical, NaN compares as false
+
+def _logical(x):
+    return np.asarray(x, dtype = np.float64)
+
+
+def if_else(condition, x, y):
+    return np.where(np.asarray(condition) > 0, x, y)
+
+
+# cross sectional, over the instruments of each date
+
+def rank(x, rate = 2):
+    x = _matrix(x)
+    valid = ~np.isnan(x)
+    order = np.argsort(np.where(valid, x, np.inf), axis = 1, kind = 'stable')
+    ranks = np.empty_like(x)
+    np.put_along_axis(ranks, order, np.arange(x.shape[1], dtype = np.float64)[None, :], axis = 1)
+    count = valid.sum(axis = 1, keepdims = True)
+    out = np.where(count > 1, ranks / np.maximum(count - 1, 1), 0.5)
+    out[~valid] = np.nan
+    return out
+
+
+def zscore(x):
+    x = _matrix(x)
+    return _finite((x - np.nanmean(x, axis = 1, keepdims = True)) / np.nanstd(x, axis = 1, keepdims = True))
+
+
+def normalize(x, useStd = False, limit = 0.0):
+    x = _matrix(x)
+    out = x - np.nanmean(x, axis = 1, keepdims = True)
+    if useStd:
+        out = _finite(out / np.nanstd(x, axis = 1, keepdims = True))
+    if limit:
+        out = np.clip(out, -limit, limit)
+    return out
+
+
+def scale(x, scale = 1, longscale = 1, shortscale = 1):
+    x = _matrix(x)
+    return _finite(x / np.nansum(np.abs(x), axis = 1, keepdims = True) * scale)
+
+
+def winsorize(x, std = 4):
+    x = _matrix(x)
+    mean = np.nanmean(x, axis = 1, keepdims = True)
+    deviation = np.nanstd(x, axis = 1, keepdims = True)
+    return np.clip(x, mean - std * deviation, mean + std * deviation)
+
+
+# group, over the instruments of each (date, group)
+
+def _group_keys(group, shape):
+    """dense key of the (date, group) of every cell, -1 where the group is undefined, and the number of keys"""
+    group = np.broadcast_to(group, shape)
+    valid = ~np.isnan(group)
+    codes = group[valid]
+    if len(codes) and (codes.min() < 0 or codes.max() >= 1 << 16 or np.any(codes != np.floor(codes))):
+        codes = np.unique(codes, return_inverse = True)[1]
+    codes = codes.astype(np.int64)
+    size = int(codes.max()) + 1 if len(codes) else 0
+    keys = np.full(shape, -1, dtype = np.int64)
+    keys[valid] = np.broadcast_to(np.arange(shape[0])[:, None], shape)[valid] * size + codes
+    return keys, shape[0] * size
+
+
+def _group_sums(x, keys, size, weights = None):
+    valid = ~np.isnan(x) & (keys >= 0)
+    k = keys[valid]
+    w = np.ones(len(k)) if weights is None else np.nan_to_num(np.broadcast_to(weights, x.shape)[valid])
+    count = np.bincount(k, weights = w, minlength = size)
+    total = np.bincount(k, weights = w * x[valid], minlength = size)
+    squares = np.bincount(k, weights = w * x[valid] ** 2, minlength = size)
+    return count, total, squares
+
+
+def _take(values, keys):
+    out = np.full(keys.shape, np.nan)
+    defined = keys >= 0
+    out[defined] = values[keys[defined]]
+    return out
+
+
+def group_mean(x, weight, group):
+    x = _matrix(x)
+    keys, size = _group_keys(group, x.shape)
+    count, total, _ = _group_sums(x, keys, size, weight)
+    return _take(_finite(total / count), keys)
+
+
+def group_neutralize(x, group):
+    x = _matrix(x)
+    keys, size = _group_keys(group, x.shape)
+    count, total, _ = _group_sums(x, keys, size)
+    return x - _take(_finite(total / count), keys)
+
+
+def group_zscore(x, group):
+    x = _matrix(x)
+    keys, size = _group_keys(group, x.shape)
+    count, total, squares = _group_sums(x, keys, size)
+    mean = _finite(total / count)
+    deviation = np.sqrt(np.maximum(_finite(squares / count) - mean ** 2, 0))
+    return _finite((x - _take(mean, keys)) / _take(deviation, keys))
+
+
+def group_rank(x, group):
+    x = _matrix(x)
+    keys, size = _group_keys(group, x.shape)
+    valid = ~np.isnan(x) & (keys >= 0)
+    k = keys[valid]
+    order = np.lexsort((x[valid], k))
+    count = np.bincount(k, minlength = size)
+    start = np.cumsum(count) - count
+    ranks = np.empty(len(k))
+    ranks[order] = np.arange(len(k)) - start[k[order]]
+    members = count[k]
+    out = np.full(x.shape, np.nan)
+    out[valid] = np.where(members > 1, ranks / np.maximum(members - 1, 1), 0.5)
+    return out
+
+
+def group_scale(x, group):
+    x = _matrix(x)
+    keys, size = _group_keys(group, x.shape)
+    valid = ~np.isnan(x) & (keys >= 0)
+    low = np.full(size, np.inf)
+    high = np.full(size, -np.inf)
+    np.minimum.at(low, keys[valid], x[valid])
+    np.maximum.at(high, keys[valid], x[valid])
+    low, high = _take(low, keys), _take(high, keys)
+    return _finite((x - low) / (high - low))
+
+
+# time series, over the last d days of each instrument
+
+def ts_delay(x, d):
+    return _shift(_matrix(x), _window(d) if d else 0)
+
+
+def ts_delta(x, d):
+    return x - ts_delay(x, d)
+
+
+def ts_sum(x, d):
+    return _rolling_sum(_matrix(x), _window(d))[0]
+
+
+def ts_mean(x, d):
+    total, count = _rolling_sum(_matrix(x), _window(d))
+    return total / np.maximum(count, 1)
+
+
+def ts_std_dev(x, d):
+    mean = ts_mean(x, d)
+    return np.sqrt(np.maximum(ts_mean(x ** 2, d) - mean ** 2, 0))
+
+
+def ts_zscore(x, d):
+    return _finite((x - ts_mean(x, d)) / ts_std_dev(x, d))
+
+
+def ts_av_diff(x, d):
+    return x - ts_mean(x, d)
+
+
+def ts_count_nans(x, d):
+    d = _window(d)
+    out = d - _rolling_sum(_matrix(x), d)[1]
+    out[:d - 1] = np.nan
+    return out
+
+
+def ts_product(x, d):
+    d = _window(d)
+    out = _matrix(x).copy()
+    for k in range(1, d):
+        out = out * _shift(x, k)
+    return out
+
+
+def ts_decay_linear(x, d, dense = False):
+    """weighted mean of the last d days, d for today down to 1 for the oldest day"""
+    x, d = _matrix(x), _window(d)
+    valid = ~np.isnan(x)
+    values = np.where(valid, x, 0)
+    days = np.arange(len(x), dtype = np.float64)[:, None]
+
+    def window(c):
+        out = c.copy()
+        out[d:] = c[d:] - c[:-d]
+        return out
+    # the weight of day j in the window ending at t is j - (t - d), from two prefix sums
+    start = days - d
+    total = window(np.cumsum(values * days, axis = 0)) - start * window(np.cumsum(values, axis = 0))
+    weights = window(np.cumsum(valid * days, axis = 0)) - start * window(np.cumsum(valid, axis = 0, dtype = np.float64))
+    return _finite(total / np.where(weights > 0.5, weights, np.nan))
+
+
+def ts_rank(x, d, constant = 0):
+    x, d = _matrix(x), _window(d)
+    below = np.zeros_like(x)
+    count = np.zeros_like(x)
+    for k in range(1, d):
+        past = _shift(x, k)
+        below += (past < x) + 0.5 * (past == x)
+        count += ~np.isnan(past)
+    out = np.where(count > 0, below / np.maximum(count, 1), 0.5) + constant
+    out[np.isnan(x)] = np.nan
+    out[:d - 1] = np.nan
+    return out
+
+
+def ts_scale(x, d, constant = 0):
+    d = _window(d)
+    low = _rolling_extreme(_matrix(x), d, np.fmin)
+    high = _rolling_extreme(x, d, np.fmax)
+    return _finite((x - low) / (high - low)) + constant
+
+
+def _ts_arg_extreme(x, d, better):
+    x, d = _matrix(x), _window(d)
+    best = x.copy()
+    out = np.where(np.isnan(x), np.nan, 0)
+    for k in range(1, d):
+        past = _shift(x, k)
+        replace = better(past, best) | (np.isnan(best) & ~np.isnan(past))
+        best = np.where(replace, past, best)
+        out = np.where(replace, k, out)
+    out[:d - 1] = np.nan
+    return out
+
+
+def ts_arg_max(x, d):
+    return _ts_arg_extreme(x, d, np.greater)
+
+
+def ts_arg_min(x, d):
+    return _ts_arg_extreme(x, d, np.less)
+
+
+def ts_backfill(x, lookback = 252, k = 1, ignore = 'NAN'):
+    """the last defined value of the last `lookback` days"""
+    x, lookback = _matrix(x), _window(lookback)
+    days = np.arange(len(x))[:, None]
+    last = np.maximum.accumulate(np.where(~np.isnan(x), days, -1), axis = 0)
+    out = np.take_along_axis(x, np.maximum(last, 0), axis = 0)
+    out[(last < 0) | (days - last >= lookback)] = np.nan
+    return out
+
+
+def days_from_last_change(x):
+    x = _matrix(x)
+    days = np.arange(len(x))[:, None]
+    previous = _shift(x, 1)
+    changed = ~((x == previous) | (np.isnan(x) & np.isnan(previous)))
+    return days - np.maximum.accumulate(np.where(changed, days, 0), axis = 0)
+
+
+def _ts_moments(x, y, d):
+    x, y, d = _matrix(x), _matrix(y), _window(d)
+    valid = ~np.isnan(x) & ~np.isnan(y)
+    x, y = np.where(valid, x, np.nan), np.where(valid, y, np.nan)
+    mean_x, mean_y = ts_mean(x, d), ts_mean(y, d)
+    covariance = ts_mean(x * y, d) - mean_x * mean_y
+    return covariance, ts_mean(x ** 2, d) - mean_x ** 2, ts_mean(y ** 2, d) - mean_y ** 2
+
+
+def ts_corr(x, y, d):
+    covariance, variance_x, variance_y = _ts_moments(x, y, d)
+    return _finite(covariance / np.sqrt(variance_x * variance_y))
+
+
+def ts_covariance(y, x, d):
+    return _ts_moments(x, y, d)[0]
+
+
+# transformational
+
+def trade_when(x, y, z):
+    """y when x > 0, NaN when z > 0, the previous value otherwise"""
+    shape = np.broadcast_shapes(np.shape(x), np.shape(y), np.shape(z))
+    if len(shape) != 2:
+        raise BacktestError('trade_when expects data fields')
+    x, y, z = (np.broadcast_to(value, shape) for value in (x, y, z))
+    out = np.empty(shape)
+    previous = np.full(shape[1], np.nan)
+    for t in range(shape[0]):
+        previous = np.where(z[t] > 0, np.nan, np.where(x[t] > 0, y[t], previous))
+        out[t] = previous
+    return out
+
+
+def bucket(x, range = None, buckets = None):
+    x = _matrix(x)
+    if buckets:
+        edges = np.array([float(value) for value in buckets.split(',')])
+    elif range:
+        start, end, step = (float(value) for value in range.split(','))
+        edges = np.arange(start, end + step / 2, step)
+    else:
+        raise BacktestError('bucket expects range or buckets')
+    return np.where(np.isnan(x), np.nan, np.digitize(x, edges))
+
+
+OPERATORS = {
+    'add': add,
+    'subtract': subtract,
+    'multiply': multiply,
+    'divide': divide,
+    'power': power,
+    'signed_power': signed_power,
+    'abs': np.abs,
+    'sign': np.sign,
+    'log': log,
+    'sqrt': sqrt,
+    'inverse': inverse,
+    'reverse': np.negative,
+    'max': maximum,
+    'min': minimum,
+    'densify': lambda x: x,
+    'less': lambda x, y: _logical(np.less(x, y)),
+    'less_equal': lambda x, y: _logical(np.less_equal(x, y)),
+    'greater': lambda x, y: _logical(np.greater(x, y)),
+    'greater_equal': lambda x, y: _logical(np.greater_equal(x, y)),
+    'equal': lambda x, y: _logical(np.equal(x, y)),
+    'not_equal': lambda x, y: _logical(np.not_equal(x, y)),
+    'and': lambda x, y: _logical((np.asarray(x) > 0) & (np.asarray(y) > 0)),
+    'or': lambda x, y: _logical((np.asarray(x) > 0) | (np.asarray(y) > 0)),
+    'not': lambda x: _logical(~(np.asarray(x) > 0)),
+    'is_nan': lambda x: _logical(np.isnan(x)),
+    'if_else': if_else,
+    'rank': rank,
+    'zscore': zscore,
+    'normalize': normalize,
+    'scale': scale,
+    'winsorize': winsorize,
+    'group_mean': group_mean,
+    'group_neutralize': group_neutralize,
+    'group_zscore': group_zscore,
+    'group_rank': group_rank,
+    'group_scale': group_scale,
+    'ts_delay': ts_delay,
+    'ts_delta': ts_delta,
+    'ts_sum': ts_sum,
+    'ts_mean': ts_mean,
+    'ts_std_dev': ts_std_dev,
+    'ts_zscore': ts_zscore,
+    'ts_av_diff': ts_av_diff,
+    'ts_count_nans': ts_count_nans,
+    'ts_product': ts_product,
+    'ts_decay_linear': ts_decay_linear,
+    'ts_rank': ts_rank,
+    'ts_scale': ts_scale,
+    'ts_arg_max': ts_arg_max,
+    'ts_arg_min': ts_arg_min,
+    'ts_backfill': ts_backfill,
+    'days_from_last_change': days_from_last_change,
+    'ts_corr': ts_corr,
+    'ts_covariance': ts_covariance,
+    'trade_when': trade_when,
+    'bucket': bucket,
+}
+
+
+def performance(positions, returns):
+    """
+    metrics of the daily positions (weights of a unit gross book) held from the close of day t to the
+    close of day t + 1, over the days with positions. returns and drawdown are on half the book, like
+    the booksize of the platform.
+    """
+    held = positions[:-1]
+    gross = np.abs(held).sum(axis = 1)
+    active = np.flatnonzero(gross > 0)
+    if len(active) < 2:
+        raise BacktestError('no position taken')
+    days = slice(active[0], None)
+    pnl = np.nansum(held * returns[1:], axis = 1)[days]
+    turnover = np.abs(np.diff(positions, axis = 0)).sum(axis = 1)[days]
+    deviation = pnl.std()
+    sharpe = float(pnl.mean() / deviation * np.sqrt(252)) if deviation > 0 else 0.0
+    annual_returns = float(pnl.mean() * 252 * 2)
+    mean_turnover = float(turnover.mean())
+    cumulative = np.cumsum(pnl * 2)
+    return {
+        'sharpe': sharpe,
+        'fitness': sharpe * float(np.sqrt(abs(annual_returns) / max(mean_turnover, 0.125))),
+        'turnover': mean_turnover,
+        'returns': annual_returns,
+        'drawdown': float(np.max(np.maximum.accumulate(np.maximum(cumulative, 0)) - cumulative)),
+        'long_count': float((held[days] > 0).sum(axis = 1).mean()),
+        'short_count': float((held[days] < 0).sum(axis = 1).mean()),
+        'days': len(pnl),
+    }
+
+
+class Backtester():
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+
+    def evaluate(self, expression):
+        """the alpha matrix of the expression, dates by instruments"""
+        try:
+            tree = parse(expression)
+        except ExpressionError as e:
+            raise BacktestError(str(e))
+        local_values = {}
+        value = None
+        with np.errstate(all = 'ignore'), warnings.catch_warnings():
+            # all NaN dates in the nan* reductions
+            warnings.simplefilter('ignore', RuntimeWarning)
+            for statement in tree[1]:
+                if statement[0] == 'assign':
+                    local_values[statement[1]] = self._evaluate(statement[2], local_values)
+                else:
+                    value = self._evaluate(statement, local_values)
+        if np.ndim(value) != 2:
+            raise BacktestError('the expression does not depend on any data field')
+        return np.asarray(value, dtype = np.float64)
+
+
+    def _evaluate(self, node, local_values):
+        kind = node[0]
+        if kind == 'num':
+            return float(node[1])
+        if kind == 'str':
+            return node[1]
+        if kind == 'var':
+            name = node[1]
+            if name in local_values:
+                return local_values[name]
+            if name in ('true', 'false'):
+                return name == 'true'
+            return self.dataset.values(name)
+        _, name, args, kwargs = node
+        function = OPERATORS.get(name)
+        if function is None:
+            raise BacktestError(f'{name} is not supported by the local backtest')
+        values = [self._evaluate(arg, local_values) for arg in args]
+        options = {key: self._evaluate(value, local_values) for key, value in kwargs}
+        try:
+            return function(*values, **options)
+        except TypeError as e:
+            raise BacktestError(f'{name}: {e}')
+
+
+    def _neutralize(self, alpha, neutralization):
+        neutralization = (neutralization or 'NONE').upper()
+        if neutralization == 'NONE':
+            return alpha
+        group = neutralization.lower()
+        if neutralization != 'MARKET' and os.path.exists(os.path.join(self.dataset.path, f'{group}.npy')):
+            return group_neutralize(alpha, self.dataset.values(group))
+        # MARKET, and the groups without local data
+        return alpha - np.nanmean(alpha, axis = 1, keepdims = True)
+
+
+    def simulate(self, expression, settings = None):
+        """approximate sharpe, fitness, turnover, returns, ... of the expression with the simulation settings"""
+        settings = settings or {}
+        alpha = self.evaluate(expression)
+        with np.errstate(all = 'ignore'), warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            if self.dataset.universe is not None:
+                alpha = np.where(self.dataset.universe, alpha, np.nan)
+            decay = int(settings.get('decay') or 0)
+            if decay > 1:
+                alpha = ts_decay_linear(alpha, decay)
+            alpha = self._neutralize(alpha, settings.get('neutralization'))
+            weights = np.nan_to_num(alpha, nan = 0, posinf = 0, neginf = 0)
+            truncation = float(settings.get('truncation') or 0)
+            for _ in range(2 if 0 < truncation < 1 else 1):
+                gross = np.abs(weights).sum(axis = 1, keepdims = True)
+                weights = np.divide(weights, gross, out = np.zeros_like(weights), where = gross > 0)
+                if 0 < truncation < 1:
+                    weights = np.clip(weights, -truncation, truncation)
+            # the positions of day t are built from the data of day t - delay
+            positions = np.nan_to_num(_shift(weights, int(settings.get('delay') or 0)), nan = 0)
+            return performance(positions, self.dataset.returns)
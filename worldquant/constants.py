@@ -9,6 +9,28 @@ CHECK_METRIC_MAPPING = {
     'SELF_CORRELATION': 'self_correlation',
 }
 
+# simulation settings keys and the alpha table columns storing them
+SETTINGS_COLUMN_MAPPING = {
+    'instrumentType': 'instrument_type',
+    'region': 'region',
+    'universe': 'universe',
+    'delay': 'delay',
+    'decay': 'decay',
+    'neutralization': 'neutralization',
+    'truncation': 'truncation',
+    'pasteurization': 'pasteurization',
+    'unitHandling': 'unit_handling',
+    'nanHandling': 'nan_handling',
+    'maxTrade': 'max_trade',
+    'language': 'language',
+    'visualization': 'visualization',
+}
+
+# platform defaults of the settings which are optional in a simulation request
+SETTINGS_DEFAULTS = {
+    'maxTrade': 'OFF',
+}
+
 class Status(Enum):
     PENDING = 'PENDING'
     WAITING = 'WAITING'
@@ -20,3 +42,4 @@ class Status(Enum):
     COMPLETE = 'COMPLETE'
     WARNING = 'WARNING'
     UNSUBMITTED = 'UNSUBMITTED'
+    DISCARDED = 'DISCARDED'
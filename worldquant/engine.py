@@ -0,0 +1,228 @@
+from worldquant.api import AsyncWorldQuantSession
+from worldquant.constants import Status
+from worldquant.metrics import CHECK_SECONDS, SIMULATIONS_INFLIGHT, CHECKS_INFLIGHT
+
+from db.crud.simulation_queue import delete_queue_by_id, renew_lease, release_queue
+from db.crud.simulation_run import utc_now
+
+from loguru import logger
+
+import asyncio
+import threading
+import time
+
+
+class AsyncSimulationEngine():
+    """
+    run the simulation stage (submit, poll progress) of every queued alpha and the check stage
+    as coroutines on a single event loop, instead of one OS thread per in-flight simulation.
+    the number of in-flight simulations is capped by `max_inflight` in config/simulation.json,
+    beyond that the platform itself pushes back with 429.
+    """
+    def __init__(self, service):
+        self.service = service
+        self.config = service.config
+        self.db = service.db
+        self.worker_id = service.worker_id
+        self.max_inflight = getattr(self.config, 'max_inflight', 100)
+        self.session = AsyncWorldQuantSession(max_connections=self.max_inflight)
+        self.session_time = time.time()
+
+
+    def run(self, template_id = None, shuffle = False, stats = False, until_empty = False):
+        asyncio.run(self.simulate_from_alpha_queue(template_id, shuffle, stats, until_empty))
+
+
+    async def simulate_from_alpha_queue(self, template_id = None, shuffle = False, stats = False, until_empty = False):
+        if template_id != None:
+            template_info = f'template {template_id}'
+        else:
+            template_info = 'all alphas from the queue'
+        logger.info(f"start to simulate {template_info} with async engine, max inflight {self.max_inflight}, batch size {self.service.batch_size}, shuffle {shuffle}, worker {self.worker_id}")
+
+        if stats:
+            stop_event = threading.Event()
+            t = threading.Thread(target = self.service.periodic_print, args = (stop_event, ) )
+            t.daemon = True
+            t.start()
+
+        await self.session.sign_in()
+        check_task = None
+        check_stop = asyncio.Event()
+        if self.config.check_parallelism > 0:
+            check_task = asyncio.create_task(self.check_from_alpha_queue(check_stop))
+        # task -> number of simulations it runs, a multi simulation counts each of its children
+        inflight = {}
+        lease_time = time.time()
+        try:
+            while True:
+                if time.time() - 3600 > self.session_time:
+                    await self.session.sign_in()
+                    self.session_time = time.time()
+                if time.time() - self.config.lease_seconds / 3 > lease_time:
+                    renew_lease(self.db, self.worker_id, self.config.lease_seconds)
+                    lease_time = time.time()
+
+                free = self.max_inflight - sum(inflight.values())
+                if free > 0:
+                    # at most `free` rows, however they are grouped into multi simulations
+                    for rows in self.service._group_batches(self.service._claim(self.db, free, template_id, shuffle)):
+                        task = asyncio.create_task(self.process_rows(rows))
+                        inflight[task] = len(rows)
+                        task.add_done_callback(lambda task: inflight.pop(task, None))
+                if not inflight:
+                    if until_empty:
+                        logger.info("no alpha found in the queue, stop")
+                        if check_task:
+                            # same as the thread engine, the checks in progress are finished, the remaining UNSUBMITTED alphas are left to `-c`
+                            check_stop.set()
+                            await check_task
+                        break
+                    logger.info("no alpha found in the queue, wait for 1 min")
+                    await asyncio.sleep(60)
+                    continue
+                await asyncio.wait(inflight, timeout = 60, return_when = asyncio.FIRST_COMPLETED)
+        finally:
+            for task in list(inflight):
+                task.cancel()
+            await asyncio.gather(*inflight, return_exceptions=True)
+            if check_task:
+                check_task.cancel()
+                await asyncio.gather(check_task, return_exceptions=True)
+            await self.session.close()
+            release_queue(self.db, self.worker_id)
+            if stats:
+                stop_event.set()
+
+
+    async def check_from_alpha_queue(self, stop):
+        """check stage of the async engine, once `stop` is set no new check is started and the ones in progress are awaited"""
+        logger.info(f'start to check simulated alphas, parallelism {self.config.check_parallelism}')
+        inflight = {}
+        try:
+            while not stop.is_set():
+                # the query runs on its own session in a worker thread, off the event loop
+                for alpha_id in await asyncio.to_thread(self.service._alpha_ids_to_check, set(inflight)):
+                    task = asyncio.create_task(self.check_one_alpha(alpha_id))
+                    inflight[alpha_id] = task
+                    task.add_done_callback(lambda _, alpha_id = alpha_id: inflight.pop(alpha_id, None))
+                try:
+                    await asyncio.wait_for(stop.wait(), timeout = 10)
+                except asyncio.TimeoutError:
+                    pass
+            await asyncio.gather(*inflight.values(), return_exceptions=True)
+        finally:
+            for task in inflight.values():
+                task.cancel()
+
+
+    async def process_rows(self, rows):
+        pending = []
+        try:
+            for row in rows:
+                queue_id, expression_hash, simulation, origin = self.service._queue_row_to_simulation(row)
+                if self.service._is_simulated(self.db, expression_hash):
+                    logger.info(f'skip {simulation["regular"]}, already simulated')
+                    delete_queue_by_id(self.db, queue_id)
+                    continue
+                if self.service._is_invalid(self.db, simulation, expression_hash, origin):
+                    delete_queue_by_id(self.db, queue_id)
+                    continue
+                run_id = self.service._start_run(self.db, simulation, expression_hash, origin)
+                pending.append((queue_id, simulation, origin, run_id))
+            if len(pending) == 1:
+                _, simulation, origin, run_id = pending[0]
+                await self.simulate_one(simulation, origin, run_id)
+            elif pending:
+                _, simulations, origins, run_ids = zip(*pending)
+                await self.simulate_batch(list(simulations), list(origins), list(run_ids))
+        except Exception as e:
+            logger.error(f"task failed: {e}")
+            for queue_id, _, _, run_id in pending:
+                self.service._update_run(self.db, run_id, status = Status.ERROR.value, error = str(e), completed_at = utc_now())
+                release_queue(self.db, self.worker_id, queue_id)
+            return
+        for queue_id, *_ in pending:
+            delete_queue_by_id(self.db, queue_id)
+
+
+    async def simulate_one(self, simulation, origin = None, run_id = None):
+        logger.debug(f'start to simulate alpha: {simulation.get("regular")}')
+        with SIMULATIONS_INFLIGHT.track_inprogress():
+            alpha_ids = await self._run_steps(self.service._simulation_steps(self.db, [simulation], [origin], [run_id], multi = False))
+            return alpha_ids[0] if alpha_ids else None
+
+
+    async def simulate_batch(self, simulations, origins, run_ids):
+        """multi simulation counterpart of WorldQuantService.simulate_batch"""
+        logger.debug(f'start to simulate {len(simulations)} alphas in one multi simulation')
+        with SIMULATIONS_INFLIGHT.track_inprogress(len(simulations)):
+            return await self._run_steps(self.service._simulation_steps(self.db, simulations, origins, run_ids, multi = True))
+
+
+    async def _run_steps(self, steps):
+        """async counterpart of WorldQuantService._run_steps, the steps themselves are shared"""
+        response = None
+        while True:
+            try:
+                action, argument = steps.send(response)
+            except StopIteration as stop:
+                return stop.value
+            response = None
+            if action == 'post':
+                response = await self.session.post_simulation(argument)
+            elif action == 'poll':
+                response = await self.session.get_simulation_status(argument)
+            elif action == 'sign_in':
+                await self.session.sign_in(argument.generation)
+            else:
+                await asyncio.sleep(argument)
+
+
+    async def _check_alpha(self, alpha_id):
+        try:
+            ac_response = await self.session.check_alpha(alpha_id)
+            status = self.service._check_response_status(alpha_id, ac_response)
+            if status == Status.EXPIRED.value:
+                await self.session.sign_in(ac_response.generation)
+            if status:
+                return status
+            check_status, alpha_check_dict = self.service._parse_alpha_checks(alpha_id, ac_response.json())
+        except Exception as e:
+            logger.error(f'fail to check alpha {e}')
+            return Status.ERROR.value
+
+        while True:
+            alpha_response = await self.session.get_alpha(alpha_id)
+            if alpha_response.status_code == 200:
+                break
+            else:
+                logger.warning(
+                    f'fail to call get_alpha api, {alpha_response.status_code}, wait for 5 s and try again')
+                await asyncio.sleep(5)
+
+        self.service._save_alpha_check(self.db, alpha_id, check_status, alpha_check_dict, alpha_response.json())
+        return check_status
+
+
+    async def check_one_alpha(self, alpha_id):
+        backoff = self.service.check_backoff
+        start_time = time.time()
+        overdue_polls = 0
+        with CHECKS_INFLIGHT.track_inprogress():
+            while True:
+                status = await self._check_alpha(alpha_id)
+                logger.info(f'alpha_id {alpha_id}, check status {status}')
+                elapsed = time.time() - start_time
+                if status == Status.PENDING.value:
+                    wait_sec = backoff.next_wait(elapsed, overdue_polls)
+                    if elapsed >= backoff.expected:
+                        overdue_polls += 1
+                elif status in (Status.WAITING.value, Status.ERROR.value, Status.EXPIRED.value):
+                    wait_sec = self.config.check_scheduler.retry_wait
+                else:
+                    backoff.observe(elapsed)
+                    CHECK_SECONDS.observe(elapsed)
+                    return status
+                logger.info(f'alpha_id {alpha_id} wait for {wait_sec:.0f} s')
+                await asyncio.sleep(wait_sec)
@@ -0,0 +1,561 @@
+"""
+FASTEXPR parser and canonicalizer.
+
+expressions are parsed into a tuple based AST:
+    ('num', value) ('str', text) ('var', name)
+    ('call', name, args, kwargs)  args is a tuple of nodes, kwargs a tuple of (name, node)
+    ('assign', name, node)        a `name = expr` statement
+    ('prog', statements)
+
+the canonical form rewrites the infix operators to their function names, turns `-x` into
+`multiply(-1, x)`, flattens and sorts the arguments of the commutative operators, folds the
+numeric constants of add/multiply and drops the keyword arguments equal to the defaults of
+config/operators.json, so cosmetically different expressions share one canonical string.
+"""
+from functools import lru_cache
+from string import Formatter
+import re
+
+
+class ExpressionError(ValueError):
+    pass
+
+
+NAME_PATTERN = re.compile(r'[A-Za-z_][A-Za-z0-9_.]*')
+TOKEN_PATTERN = re.compile(r'''
+    \s*(?:
+        (?P<num>\d+\.?\d*(?:[eE][-+]?\d+)?|\.\d+(?:[eE][-+]?\d+)?)
+      | (?P<name>[A-Za-z_][A-Za-z0-9_.]*)
+      | (?P<str>"[^"]*"|'[^']*')
+      | (?P<op><=|>=|==|!=|&&|\|\||[-+*/<>!?:(),;=^])
+    )''', re.VERBOSE)
+
+INFIX_OPERATORS = {
+    '+': 'add',
+    '-': 'subtract',
+    '*': 'multiply',
+    '/': 'divide',
+    '^': 'power',
+    '<': 'less',
+    '<=': 'less_equal',
+    '>': 'greater',
+    '>=': 'greater_equal',
+    '==': 'equal',
+    '!=': 'not_equal',
+    '&&': 'and',
+    '||': 'or',
+}
+
+# binding power of the infix operators, higher binds tighter
+PRECEDENCE = {
+    '||': 1,
+    '&&': 2,
+    '==': 3, '!=': 3,
+    '<': 4, '<=': 4, '>': 4, '>=': 4,
+    '+': 5, '-': 5,
+    '*': 6, '/': 6,
+    '^': 8,
+}
+UNARY_PRECEDENCE = 7
+
+COMMUTATIVE = {'add', 'multiply', 'min', 'max', 'and', 'or', 'equal', 'not_equal'}
+ASSOCIATIVE = {'add', 'multiply', 'min', 'max'}
+# the operators normalize rewrites, by flattening or folding their arguments
+REWRITTEN = ASSOCIATIVE | {'reverse'}
+
+
+def tokenize(expression):
+    tokens = []
+    position = 0
+    for m in TOKEN_PATTERN.finditer(expression):
+        if m.start() != position:
+            break
+        position = m.end()
+        kind = m.lastgroup
+        tokens.append((kind, m.group(kind)))
+    if expression[position:].strip():
+        raise ExpressionError(f'unexpected character at {position}: {expression[position:position + 20]!r}')
+    return tokens
+
+
+class Parser():
+    def __init__(self, expression):
+        # the end of the input is a (None, None) token, take() never moves past it
+        self.tokens = tokenize(expression) + [(None, None)]
+        self.position = 0
+
+
+    def peek(self):
+        return self.tokens[self.position]
+
+
+    def take(self, value = None):
+        token = self.peek()
+        if token[0] is None or (value is not None and token[1] != value):
+            raise ExpressionError(f'expected {value or "a token"} at token {self.position}, got {token[1]!r}')
+        self.position += 1
+        return token
+
+
+    def parse(self):
+        statements = []
+        while self.peek()[0] is not None:
+            if self.peek()[1] == ';':
+                self.take()
+                continue
+            statements.append(self.statement())
+            if self.peek()[0] is not None:
+                self.take(';')
+        if not statements:
+            raise ExpressionError('empty expression')
+        return ('prog', tuple(statements))
+
+
+    def statement(self):
+        kind, value = self.peek()
+        if kind == 'name' and self.tokens[self.position + 1][1] == '=':
+            self.position += 2
+            return ('assign', value, self.expression())
+        return self.expression()
+
+
+    def expression(self, min_precedence = 0):
+        left = self.unary()
+        while True:
+            kind, value = self.peek()
+            if kind != 'op':
+                break
+            if value == '?' and min_precedence == 0:
+                self.take()
+                when_true = self.expression()
+                self.take(':')
+                when_false = self.expression()
+                left = ('call', 'if_else', (left, when_true, when_false), ())
+                continue
+            precedence = PRECEDENCE.get(value)
+            if precedence is None or precedence <= min_precedence:
+                break
+            self.take()
+            # ^ is right associative
+            right = self.expression(precedence - 1 if value == '^' else precedence)
+            left = ('call', INFIX_OPERATORS[value], (left, right), ())
+        return left
+
+
+    def unary(self):
+        kind, value = self.peek()
+        if kind == 'op' and value in ('-', '+', '!'):
+            self.take()
+            operand = self.expression(UNARY_PRECEDENCE)
+            if value == '+':
+                return operand
+            if value == '!':
+                return ('call', 'not', (operand, ), ())
+            return ('call', 'reverse', (operand, ), ())
+        return self.primary()
+
+
+    def primary(self):
+        kind, value = self.take()
+        if kind == 'num':
+            number = float(value)
+            return ('num', int(number) if number.is_integer() and abs(number) < 1e15 else number)
+        if kind == 'str':
+            return ('str', value[1:-1])
+        if kind == 'name':
+            if self.peek()[1] == '(':
+                return self.call(value)
+            lowered = value.lower()
+            if lowered in ('true', 'false'):
+                return ('var', lowered)
+            return ('var', value)
+        if value == '(':
+            node = self.expression()
+            self.take(')')
+            return node
+        raise ExpressionError(f'unexpected {value!r} at token {self.position - 1}')
+
+
+    def call(self, name):
+        self.take('(')
+        args = []
+        kwargs = []
+        if self.peek()[1] != ')':
+            while True:
+                kind, value = self.peek()
+                if kind == 'name' and self.tokens[self.position + 1][1] == '=':
+                    self.position += 2
+                    kwargs.append((value, self.expression()))
+                else:
+                    args.append(self.expression())
+                if self.peek()[1] != ',':
+                    break
+                self.take(',')
+        self.take(')')
+        return ('call', name, tuple(args), tuple(kwargs))
+
+
+def parse(expression):
+    return Parser(expression).parse()
+
+
+def parse_primary(text):
+    """the AST of a text made of one primary (a name, a number, a string, a call or a parenthesized expression), else None"""
+    try:
+        parser = Parser(text)
+        node = parser.primary()
+    except ExpressionError:
+        return None
+    return node if parser.peek()[0] is None else None
+
+
+class ExpressionTemplate():
+    """
+    a str.format template of an expression parsed once, the AST of an expansion is the one of the template
+    with the AST of each parameter value in place of its placeholder, so that the expansions of a template
+    are not parsed one by one. a value is substituted only when it is one primary, which binds like its
+    placeholder whatever surrounds it, `expand(values)` is (None, None) for the other values and for the
+    templates whose placeholders are not whole names (parse the formatted expression then).
+
+    the canonical string of an expansion is put together from the canonical strings of the values as long
+    as normalize leaves the calls holding a placeholder in place, i.e. none of them is in REWRITTEN, else
+    it is the one of the substituted AST.
+    """
+    def __init__(self, template):
+        self.names = []
+        self.skeleton = None
+        # parameter value -> its AST and canonical string, None for the ones not substituted
+        self.values = {}
+        try:
+            fields = list(Formatter().parse(template))
+        except ValueError:
+            return
+        for _, name, spec, conversion in fields:
+            if name is None:
+                continue
+            if not name.isidentifier() or spec or conversion:
+                return
+            if name not in self.names:
+                self.names.append(name)
+        self.placeholders = {name: f'__param_{i}__' for i, name in enumerate(self.names)}
+        text = template.format(**self.placeholders)
+        try:
+            tokens = tokenize(text)
+            skeleton = parse(text)
+        except ExpressionError:
+            return
+        names = [value for kind, value in tokens if kind == 'name']
+        # a placeholder glued to other characters, in a string, a keyword or an assignment is never substituted
+        if any(names.count(placeholder) != text.count(placeholder) for placeholder in self.placeholders.values()):
+            return
+        self.by_placeholder = {placeholder: name for name, placeholder in self.placeholders.items()}
+        # the nodes holding a placeholder, and the placeholders called as an operator
+        self.substituted = set()
+        self.called = set()
+        # a placeholder both called and used as a value is left to the parser
+        if self._index(skeleton) and not any(('var', placeholder) in self.substituted for placeholder in self.called):
+            self.skeleton = skeleton
+            self.build = self._builder(skeleton)
+            self.canonical = self._canonical_builder(skeleton)
+
+
+    def _index(self, node):
+        """collect the nodes holding a placeholder, False if one of them cannot be substituted"""
+        kind = node[0]
+        if kind == 'prog':
+            children = node[1]
+        elif kind == 'assign':
+            if node[1] in self.by_placeholder:
+                return False
+            children = (node[2], )
+        elif kind == 'call':
+            if any(key in self.by_placeholder for key, _ in node[3]):
+                return False
+            children = node[2] + tuple(value for _, value in node[3])
+        else:
+            if kind == 'var' and node[1] in self.by_placeholder:
+                self.substituted.add(node)
+            return True
+        ok = all(self._index(child) for child in children)
+        if kind == 'call' and node[1] in self.by_placeholder:
+            self.called.add(node[1])
+            self.substituted.add(node)
+        elif any(child in self.substituted for child in children):
+            self.substituted.add(node)
+        return ok
+
+
+    def expand(self, values):
+        """the AST and the canonical string of the template formatted with `values`, (None, None) when it has to be parsed from the text"""
+        if self.skeleton is None:
+            return None, None
+        nodes = {}
+        strings = {}
+        for name, placeholder in self.placeholders.items():
+            text = format(values[name])
+            if placeholder in self.called:
+                # an operator name, as written
+                text = text.strip()
+                if not NAME_PATTERN.fullmatch(text):
+                    return None, None
+                nodes[placeholder] = strings[placeholder] = text
+                continue
+            value = self.values.get(text, False)
+            if value is False:
+                node = parse_primary(text)
+                value = None if node is None else (node, canonical_node(normalize(node)))
+                self.values[text] = value
+            if value is None:
+                return None, None
+            nodes[placeholder], strings[placeholder] = value
+        tree = self.build(nodes)
+        if self.canonical is None or any(strings[placeholder] in REWRITTEN for placeholder in self.called):
+            return tree, canonical_node(normalize(tree))
+        return tree, self.canonical(strings)
+
+
+    def _builder(self, node):
+        """a function of the substituted nodes building `node`, the nodes without a placeholder are shared"""
+        if node not in self.substituted:
+            return lambda nodes: node
+        kind = node[0]
+        if kind == 'var':
+            placeholder = node[1]
+            return lambda nodes: nodes[placeholder]
+        if kind == 'prog':
+            statements = [self._builder(child) for child in node[1]]
+            return lambda nodes: ('prog', tuple([statement(nodes) for statement in statements]))
+        if kind == 'assign':
+            name, value = node[1], self._builder(node[2])
+            return lambda nodes: ('assign', name, value(nodes))
+        _, name, args, kwargs = node
+        args = [self._builder(arg) for arg in args]
+        kwargs = [(key, self._builder(value)) for key, value in kwargs]
+        if name in self.by_placeholder:
+            return lambda nodes: (
+                'call', nodes[name], tuple([arg(nodes) for arg in args]), tuple([(key, value(nodes)) for key, value in kwargs])
+            )
+        return lambda nodes: (
+            'call', name, tuple([arg(nodes) for arg in args]), tuple([(key, value(nodes)) for key, value in kwargs])
+        )
+
+
+    def _canonical_builder(self, node):
+        """
+        a function of the canonical strings of the values giving the one of `node` as canonical_node(normalize(node))
+        would, None when a call of the template is one normalize rewrites
+        """
+        if node not in self.substituted:
+            canonical = canonical_node(normalize(node))
+            return lambda strings: canonical
+        kind = node[0]
+        if kind == 'var':
+            placeholder = node[1]
+            return lambda strings: strings[placeholder]
+        if kind == 'prog':
+            statements = [self._canonical_builder(child) for child in node[1]]
+            if not all(statements):
+                return None
+            return lambda strings: ';'.join([statement(strings) for statement in statements])
+        if kind == 'assign':
+            name, value = node[1], self._canonical_builder(node[2])
+            if value is None:
+                return None
+            return lambda strings: f'{name}={value(strings)}'
+        _, name, args, kwargs = node
+        # the order of the keyword arguments of a same key depends on their AST
+        if name in REWRITTEN or len({key for key, _ in kwargs}) < len(kwargs):
+            return None
+        args = [self._canonical_builder(arg) for arg in args]
+        kwargs = sorted((key, self._canonical_builder(value)) for key, value in kwargs)
+        if not all(args) or not all(value for _, value in kwargs):
+            return None
+        if name not in self.by_placeholder and name not in COMMUTATIVE and not kwargs:
+            return lambda strings: f'{name}({",".join([arg(strings) for arg in args])})'
+        operators = get_operators()
+        def call(strings):
+            operator_name = strings.get(name, name)
+            parts = [arg(strings) for arg in args]
+            if operator_name in COMMUTATIVE:
+                parts.sort()
+            if kwargs:
+                operator = operators.get(operator_name)
+                defaults = operator.defaults if operator is not None else {}
+                for key, value in kwargs:
+                    part = value(strings)
+                    if operator is None or defaults.get(key) != part:
+                        parts.append(f'{key}={part}')
+            return f'{operator_name}({",".join(parts)})'
+        return call
+
+
+class Operator():
+    def __init__(self, name, params, defaults, variadic):
+        self.name = name
+        self.params = params
+        self.defaults = defaults
+        # add/multiply/min/max accept any number of inputs from 2 on
+        self.variadic = variadic or name in ASSOCIATIVE
+        self.min_args = len(params)
+        self.max_args = None if self.variadic else len(params)
+
+
+    def __repr__(self):
+        return f'Operator({self.name}, {self.params}, {self.defaults}, variadic={self.variadic})'
+
+
+def _split_arguments(text):
+    """split on the top level commas, outside of parentheses and quotes"""
+    parts = []
+    depth = 0
+    quote = None
+    start = 0
+    for i, char in enumerate(text):
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in '"\'':
+            quote = char
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            parts.append(text[start:i])
+            start = i + 1
+    parts.append(text[start:])
+    return [part.strip() for part in parts]
+
+
+def _parse_definition(name, definition):
+    """
+    the signature of an operator from the definition of config/operators.json,
+    e.g. `ts_rank(x, d, constant = 0)` or `multiply(x ,y, ... , filter=false), x * y`
+    """
+    m = re.match(rf'\s*{re.escape(name)}\s*\(', definition or '')
+    if not m:
+        return None
+    depth = 1
+    end = m.end()
+    while end < len(definition) and depth:
+        depth += {'(': 1, ')': -1}.get(definition[end], 0)
+        end += 1
+    params = []
+    defaults = {}
+    variadic = False
+    for part in _split_arguments(definition[m.end():end - 1]):
+        if '..' in part:
+            variadic = True
+            part = part.replace('.', '').strip()
+        if not part:
+            continue
+        key, _, value = part.partition('=')
+        if value and re.fullmatch(r'\s*[A-Za-z_]\w*\s*', key):
+            try:
+                defaults[key.strip()] = canonical_node(parse(value)[1][0])
+            except ExpressionError:
+                defaults[key.strip()] = None
+        else:
+            params.append(part.replace(' ', ''))
+    return Operator(name, params, defaults, variadic)
+
+
+_OPERATORS = None
+
+def get_operators():
+    """operator signatures keyed by name, loaded from config/operators.json"""
+    global _OPERATORS
+    if _OPERATORS is None:
+        from worldquant.utils import load_config
+
+        operators = {}
+        for item in load_config('operators'):
+            operator = _parse_definition(item['name'], item.get('definition'))
+            if operator is None:
+                # infix only definitions like `input1 < input2`
+                operator = Operator(item['name'], ['input1', 'input2'], {}, False)
+            operators[item['name']] = operator
+        operators.setdefault('reverse', Operator('reverse', ['x'], {}, False))
+        operators.setdefault('if_else', Operator('if_else', ['input1', 'input2', 'input3'], {}, False))
+        _OPERATORS = operators
+    return _OPERATORS
+
+
+def _format_number(value):
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        value = int(value)
+    return repr(value)
+
+
+def canonical_node(node):
+    """the canonical string of an AST node"""
+    kind = node[0]
+    if kind == 'num':
+        return _format_number(node[1])
+    if kind == 'str':
+        return f'"{node[1]}"'
+    if kind == 'var':
+        return node[1]
+    if kind == 'assign':
+        return f'{node[1]}={canonical_node(node[2])}'
+    if kind == 'prog':
+        return ';'.join(canonical_node(statement) for statement in node[1])
+    _, name, args, kwargs = node
+    parts = [canonical_node(arg) for arg in args]
+    if name in COMMUTATIVE:
+        parts.sort()
+    parts += [f'{key}={canonical_node(value)}' for key, value in sorted(kwargs)]
+    return f'{name}({",".join(parts)})'
+
+
+def normalize(node):
+    """rewrite an AST into its canonical shape"""
+    kind = node[0]
+    if kind == 'prog':
+        return ('prog', tuple(normalize(statement) for statement in node[1]))
+    if kind == 'assign':
+        return ('assign', node[1], normalize(node[2]))
+    if kind != 'call':
+        return node
+
+    _, name, args, kwargs = node
+    args = [normalize(arg) for arg in args]
+    kwargs = tuple((key, normalize(value)) for key, value in kwargs)
+
+    operator = get_operators().get(name)
+    if operator is not None and kwargs:
+        kwargs = tuple(
+            (key, value) for key, value in kwargs if operator.defaults.get(key) != canonical_node(value)
+        )
+
+    if name == 'reverse' and not kwargs:
+        # -x is multiply(-1, x)
+        name, args = 'multiply', [('num', -1), args[0]]
+
+    if name in ASSOCIATIVE and not kwargs:
+        flat = []
+        for arg in args:
+            if arg[0] == 'call' and arg[1] == name and not arg[3]:
+                flat.extend(arg[2])
+            else:
+                flat.append(arg)
+        args = flat
+
+        if name in ('add', 'multiply'):
+            numbers = [arg[1] for arg in args if arg[0] == 'num']
+            if len(numbers) > 1 or (numbers and numbers[0] == (0 if name == 'add' else 1)):
+                constant = 0 if name == 'add' else 1
+                for number in numbers:
+                    constant = constant + number if name == 'add' else constant * number
+                args = [arg for arg in args if arg[0] != 'num']
+                if constant != (0 if name == 'add' else 1) or not args:
+                    args.insert(0, ('num', constant))
+        if len(args) == 1:
+            return args[0]
+    return ('call', name, tuple(args), kwargs)
+
+
+@lru_cache(maxsize = 100000)
+def canonicalize(expression):
+    """the canonical string of a FASTEXPR expression, raises ExpressionError if it does not parse"""
+    return canonical_node(normalize(parse(expression)))
@@ -0,0 +1,241 @@
+"""
+thread-safe, process-wide metrics of the simulation pipeline, rendered in the prometheus text format
+by `render()`, which is served at /metrics by app/main.py and by `start_metrics_server` for the CLI.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from contextlib import contextmanager
+from loguru import logger
+
+import math
+import threading
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# seconds, from a fast api call to a slow simulation or check
+DEFAULT_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+def _label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(key, extra = ()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric():
+    kind = None
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.lock = threading.Lock()
+        self.values = {}
+
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, value) for key, value in self.values.items()]
+
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        for name, key, value in self.samples():
+            lines.append(f'{name}{_format_labels(key)} {_format_value(value)}')
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount = 1, **labels):
+        key = _label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(_label_key(labels), 0)
+
+
+    def sum(self, **labels):
+        """total of the series matching the given labels"""
+        match = set(_label_key(labels))
+        with self.lock:
+            return sum(value for key, value in self.values.items() if match <= set(key))
+
+
+class Gauge(Metric):
+    """a gauge is either set by the code or read from `function` at render time"""
+    kind = 'gauge'
+
+    def __init__(self, name, description):
+        super().__init__(name, description)
+        self.function = None
+
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[_label_key(labels)] = value
+
+
+    def inc(self, amount = 1, **labels):
+        key = _label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+    def dec(self, amount = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(_label_key(labels), 0)
+
+
+    @contextmanager
+    def track_inprogress(self, amount = 1, **labels):
+        self.inc(amount, **labels)
+        try:
+            yield
+        finally:
+            self.dec(amount, **labels)
+
+
+    def set_function(self, function):
+        """`function()` returns a list of (labels, value)"""
+        self.function = function
+
+
+    def samples(self):
+        if self.function is None:
+            return super().samples()
+        try:
+            return [(self.name, _label_key(labels), value) for labels, value in self.function()]
+        except Exception as e:
+            logger.warning(f'fail to read gauge {self.name}, {e}')
+            return []
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, buckets = DEFAULT_BUCKETS):
+        super().__init__(name, description)
+        self.buckets = tuple(sorted(buckets)) + (math.inf, )
+
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value)
+
+
+    def quantile(self, q, **labels):
+        """upper bound of the bucket holding the q quantile, None without observations"""
+        with self.lock:
+            counts, _ = self.values.get(_label_key(labels), ([0] * len(self.buckets), 0))
+        if not counts[-1]:
+            return None
+        for bound, count in zip(self.buckets, counts):
+            if count >= q * counts[-1]:
+                return bound
+
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self.values.items()]
+        for key, counts, total in values:
+            for bound, count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{_format_labels(key, [("le", _format_value(bound))])} {count}')
+            lines.append(f'{self.name}_sum{_format_labels(key)} {_format_value(float(total))}')
+            lines.append(f'{self.name}_count{_format_labels(key)} {counts[-1]}')
+        return lines
+
+
+class Registry():
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+
+    def register(self, metric):
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return '\n'.join(line for metric in metrics for line in metric.render()) + '\n'
+
+
+REGISTRY = Registry()
+
+API_RESPONSES = REGISTRY.register(Counter('wq_api_responses_total', 'responses of the platform api by endpoint and status code'))
+SIMULATION_SUBMIT_SECONDS = REGISTRY.register(Histogram(
+    'wq_simulation_submit_seconds', 'time to get a simulation accepted, including the waits on the rate limit'
+))
+SIMULATION_PROGRESS_SECONDS = REGISTRY.register(Histogram(
+    'wq_simulation_progress_seconds', 'time from the accepted simulation to its result'
+))
+CHECK_SECONDS = REGISTRY.register(Histogram('wq_check_seconds', 'time to get the final check result of an alpha'))
+SIMULATIONS = REGISTRY.register(Counter('wq_simulations_total', 'finished simulations by status'))
+SIMULATIONS_INFLIGHT = REGISTRY.register(Gauge('wq_simulations_inflight', 'simulations being submitted or polled'))
+CHECKS_INFLIGHT = REGISTRY.register(Gauge('wq_checks_inflight', 'alpha checks in progress'))
+CHECKS = REGISTRY.register(Counter('wq_checks_total', 'alpha check results by template and status'))
+QUEUE_DEPTH = REGISTRY.register(Gauge('wq_queue_depth', 'rows of simulation_queue by status'))
+EXPRESSION_REJECTIONS = REGISTRY.register(Counter(
+    'wq_expression_rejections_total', 'expressions rejected by the static validator by template, reason and stage'
+))
+
+
+def render():
+    return REGISTRY.render()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port, host = '0.0.0.0'):
+    """serve /metrics from a daemon thread"""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+    logger.info(f'serving metrics at http://{host}:{port}/metrics')
+    return server
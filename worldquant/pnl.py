@@ -0,0 +1,146 @@
+"""
+on-disk store of the daily PnL of alphas and the local estimate of their self correlation.
+
+the daily PnL of every alpha is a float32 row of a memory-mapped matrix laid out on one business
+day axis starting at `BASE_DATE`, missing days are NaN, so the correlation of a candidate with all the
+alphas of a set is a few vectorized reductions over the rows. `index.json` maps the alpha ids to
+their rows.
+"""
+from loguru import logger
+
+import json
+import os
+import threading
+import numpy as np
+
+
+BASE_DATE = np.datetime64('2005-01-03')
+# about 27 years of business days from BASE_DATE, 28 KB per alpha
+DAYS = 7000
+
+
+def day_index(dates):
+    """business day number of ISO dates since BASE_DATE, weekend dates roll back to the Friday"""
+    return np.busday_count(BASE_DATE, np.asarray(dates, dtype = 'datetime64[D]') + 1) - 1
+
+
+def parse_pnl_recordset(recordset):
+    """dates and cumulative pnl of the records of /alphas/{id}/recordsets/pnl"""
+    names = [prop.get('name') for prop in recordset.get('schema', {}).get('properties', [])]
+    date_column = names.index('date') if 'date' in names else 0
+    pnl_column = names.index('pnl') if 'pnl' in names else 1
+    records = [record for record in recordset.get('records', []) if record[pnl_column] is not None]
+    return [record[date_column] for record in records], [float(record[pnl_column]) for record in records]
+
+
+def max_correlation(candidate, matrix, min_overlap = 200):
+    """
+    pearson correlation of the `candidate` daily pnl with every row of `matrix`, over the days where
+    both are defined. returns the correlations, NaN for the rows overlapping less than `min_overlap` days.
+    """
+    mask = ~np.isnan(matrix) & ~np.isnan(candidate)
+    x = np.where(mask, candidate, 0).astype(np.float64)
+    y = np.where(mask, matrix, 0).astype(np.float64)
+    n = mask.sum(axis = 1)
+    sum_x = x.sum(axis = 1)
+    sum_y = y.sum(axis = 1)
+    covariance = n * (x * y).sum(axis = 1) - sum_x * sum_y
+    variance = (n * (x * x).sum(axis = 1) - sum_x ** 2) * (n * (y * y).sum(axis = 1) - sum_y ** 2)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        correlation = covariance / np.sqrt(variance)
+    correlation[(n < min_overlap) | ~(variance > 0)] = np.nan
+    return correlation
+
+
+class PnlStore():
+    def __init__(self, path, capacity = 1024):
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok = True)
+        self.index_path = os.path.join(path, 'index.json')
+        self.data_path = os.path.join(path, 'pnl.f32')
+        self.ids = []
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.ids = json.load(f)['ids']
+        self.rows = {alpha_id: row for row, alpha_id in enumerate(self.ids)}
+        self.matrix = None
+        self._open(max(capacity, len(self.ids)))
+
+
+    def _open(self, capacity):
+        """map the data file with room for `capacity` rows, the file grows by doubling"""
+        if self.matrix is not None:
+            self.matrix.flush()
+            del self.matrix
+        size = os.path.getsize(self.data_path) // (4 * DAYS) if os.path.exists(self.data_path) else 0
+        if size < capacity:
+            with open(self.data_path, 'ab') as f:
+                f.write(np.full((capacity - size, DAYS), np.nan, dtype = np.float32).tobytes())
+            size = capacity
+        self.matrix = np.memmap(self.data_path, dtype = np.float32, mode = 'r+', shape = (size, DAYS))
+
+
+    def __contains__(self, alpha_id):
+        return alpha_id in self.rows
+
+
+    def __len__(self):
+        return len(self.ids)
+
+
+    def put(self, alpha_id, dates, cumulative_pnl):
+        """store the daily pnl of an alpha from its cumulative pnl series"""
+        if not dates:
+            return
+        days = day_index(dates)
+        keep = (days >= 0) & (days < DAYS)
+        daily = np.diff(np.asarray(cumulative_pnl, dtype = np.float64), prepend = 0)
+        daily[0] = np.nan  # the first record has no previous day
+        row_values = np.full(DAYS, np.nan, dtype = np.float32)
+        row_values[days[keep]] = daily[keep]
+        with self.lock:
+            row = self.rows.get(alpha_id)
+            if row is None:
+                row = len(self.ids)
+                if row >= self.matrix.shape[0]:
+                    self._open(self.matrix.shape[0] * 2)
+                self.ids.append(alpha_id)
+                self.rows[alpha_id] = row
+            self.matrix[row] = row_values
+            self.matrix.flush()
+            with open(self.index_path + '.tmp', 'w') as f:
+                json.dump({'base': str(BASE_DATE), 'days': DAYS, 'ids': self.ids}, f)
+            os.replace(self.index_path + '.tmp', self.index_path)
+
+
+    def get(self, alpha_id):
+        row = self.rows.get(alpha_id)
+        return None if row is None else np.array(self.matrix[row])
+
+
+    def max_correlation(self, alpha_id, reference_ids, window_days = 1000, min_overlap = 200):
+        """
+        the highest correlation of an alpha with the stored alphas of `reference_ids`, over the last
+        `window_days` business days of the alpha. returns (correlation, alpha id), (None, None) when
+        nothing overlaps enough.
+        """
+        candidate = self.get(alpha_id)
+        if candidate is None:
+            return None, None
+        defined = np.flatnonzero(~np.isnan(candidate))
+        if not len(defined):
+            return None, None
+        end = defined[-1] + 1
+        start = max(end - window_days, 0)
+        with self.lock:
+            references = [reference for reference in reference_ids if reference in self.rows and reference != alpha_id]
+            if not references:
+                return None, None
+            matrix = self.matrix[[self.rows[reference] for reference in references], start:end]
+        correlation = max_correlation(candidate[start:end], matrix, min_overlap)
+        if np.all(np.isnan(correlation)):
+            return None, None
+        best = int(np.nanargmax(correlation))
+        logger.debug(f'alpha {alpha_id} max correlation {correlation[best]:.4f} with {references[best]} of {len(references)} alphas')
+        return float(correlation[best]), references[best]
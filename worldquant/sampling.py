@@ -0,0 +1,130 @@
+"""
+index addressable cross product of template parameters and samplers over it.
+
+a combination is a mixed-radix number, one digit per parameter with the number of values of the
+parameter as its radix, in the order of itertools.product, so the i-th combination is computed
+without materializing the product. the samplers yield indices, in O(n) time and memory for n samples
+whatever the size of the product.
+"""
+from math import prod
+
+import random
+import sys
+
+
+class ParameterSpace():
+    def __init__(self, parameters):
+        self.keys = list(parameters)
+        self.values = [list(values) for values in parameters.values()]
+        self.radices = [len(values) for values in self.values]
+        self.size = prod(self.radices)
+
+
+    def __len__(self):
+        return self.size
+
+
+    def digits(self, index):
+        digits = []
+        for radix in reversed(self.radices):
+            index, digit = divmod(index, radix)
+            digits.append(digit)
+        return digits[::-1]
+
+
+    def index(self, digits):
+        index = 0
+        for digit, radix in zip(digits, self.radices):
+            index = index * radix + digit
+        return index
+
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.size:
+            raise IndexError(f'combination {index} out of {self.size}')
+        return tuple(values[digit] for values, digit in zip(self.values, self.digits(index)))
+
+
+def _distinct(rng, size, k):
+    """k distinct numbers below `size` in random order"""
+    if size <= sys.maxsize:
+        # sampling a range keeps a set of the drawn numbers, not the population
+        return rng.sample(range(size), k)
+    # range() has no len() past sys.maxsize, k is then a tiny share of size and draws rarely collide
+    drawn = {}
+    while len(drawn) < k:
+        drawn.setdefault(rng.randrange(size), None)
+    return list(drawn)
+
+
+def sample_uniform(space, n, seed = None):
+    """n distinct combinations drawn uniformly"""
+    rng = random.Random(seed)
+    yield from _distinct(rng, space.size, min(n, space.size))
+
+
+def sample_stratified(space, n, key = None, seed = None):
+    """
+    n combinations split evenly between the values of the parameter `key`, by default the one with the
+    most values, drawn uniformly within each value. the strata take turns so any prefix is balanced too.
+    """
+    rng = random.Random(seed)
+    if key is None:
+        key = space.keys[max(range(len(space.keys)), key = lambda axis: space.radices[axis])]
+    axis = space.keys.index(key)
+    radix = space.radices[axis]
+    inner = prod(space.radices[axis + 1:])
+    stratum_size = space.size // radix
+    n = min(n, space.size)
+    # the values getting one more sample than the others are drawn at random
+    extra = set(rng.sample(range(radix), n % radix))
+    strata = [
+        _distinct(rng, stratum_size, min(n // radix + (value in extra), stratum_size)) for value in range(radix)
+    ]
+    for position in range(max(len(stratum) for stratum in strata)):
+        for value, stratum in enumerate(strata):
+            if position < len(stratum):
+                # put the digit of `key` back into the index of the combination within its stratum
+                high, low = divmod(stratum[position], inner)
+                yield (high * radix + value) * inner + low
+
+
+def sample_latin_hypercube(space, n, seed = None):
+    """
+    n distinct combinations in which every value of every parameter appears equally often, up to
+    rounding. the rare duplicate combination is replaced by a uniform draw.
+    """
+    rng = random.Random(seed)
+    n = min(n, space.size)
+    columns = []
+    for radix in space.radices:
+        column = [j * radix // n for j in range(n)] if n else []
+        rng.shuffle(column)
+        columns.append(column)
+    seen = set()
+    for digits in zip(*columns):
+        index = space.index(digits)
+        if index not in seen:
+            seen.add(index)
+            yield index
+    while len(seen) < n:
+        index = rng.randrange(space.size)
+        if index not in seen:
+            seen.add(index)
+            yield index
+
+
+SAMPLERS = {
+    'uniform': sample_uniform,
+    'stratified': sample_stratified,
+    'lhs': sample_latin_hypercube,
+}
+
+
+def sample(space, n, mode = 'uniform', seed = None, **kwargs):
+    """indices of n combinations of `space` drawn by the sampler `mode`"""
+    if mode not in SAMPLERS:
+        raise ValueError(f'unknown sampling mode {mode}, expected one of {", ".join(SAMPLERS)}')
+    if not space.size:
+        return iter(())
+    return SAMPLERS[mode](space, n, seed = seed, **kwargs)
@@ -0,0 +1,88 @@
+from worldquant.alpha import load_templates
+from db.crud.simulation_queue import claim_queue, get_queued_template_ids
+
+from collections import deque
+from loguru import logger
+
+import os
+
+
+class FairShareScheduler():
+    """
+    claims the queued rows of every template in turn with deficit round robin, so that a big template
+    queued first does not starve the others. a template gets `quantum * weight` rows of credit per
+    turn, a drained template loses its credit. the templates of the lowest `priority` are served first,
+    the others only once they run dry. weight and priority come from the template yaml:
+
+        scheduling:
+          weight: 2
+          priority: 0
+    """
+    def __init__(self, quantum = 1):
+        self.quantum = quantum
+        self.deficits = {}
+        self.order = deque()
+        # the template being served, its credit of the turn already added
+        self.current = None
+
+
+    def _scheduling(self):
+        templates = load_templates() if os.path.isdir('templates') else {}
+        scheduling = {
+            template_id: template.get('scheduling') or {} for template_id, (_, template) in templates.items()
+        }
+
+        def get(template_id):
+            settings = scheduling.get(str(template_id), {})
+            return max(float(settings.get('weight', 1)), 0.01), settings.get('priority', 0)
+        return get
+
+
+    def _sync_order(self, template_ids):
+        """keep the turn order of the known templates, the new ones join at the end"""
+        present = set(template_ids)
+        self.order = deque(template_id for template_id in self.order if template_id in present)
+        known = set(self.order)
+        self.order.extend(template_id for template_id in template_ids if template_id not in known)
+        if self.current not in present:
+            self.current = None
+
+
+    def claim(self, db, worker_id, limit, lease_seconds, shuffle = False):
+        template_ids = get_queued_template_ids(db)
+        if not template_ids:
+            # rows without a template
+            return claim_queue(db, worker_id, limit, lease_seconds, None, shuffle)
+        scheduling = self._scheduling()
+        claimed = []
+        for priority in sorted({scheduling(template_id)[1] for template_id in template_ids}):
+            self._sync_order([template_id for template_id in template_ids if scheduling(template_id)[1] == priority])
+            while self.order and len(claimed) < limit:
+                if self.current is None:
+                    self.current = self.order[0]
+                    self.order.rotate(-1)
+                    self.deficits[self.current] = self.deficits.get(self.current, 0) + self.quantum * scheduling(self.current)[0]
+                template_id = self.current
+                count = min(int(self.deficits[template_id]), limit - len(claimed))
+                if count > 0:
+                    rows = claim_queue(db, worker_id, count, lease_seconds, template_id, shuffle)
+                    claimed += rows
+                    self.deficits[template_id] -= len(rows)
+                    if len(rows) < count:
+                        logger.debug(f'template {template_id} drained')
+                        self.order.remove(template_id)
+                        self.deficits.pop(template_id, None)
+                        self.current = None
+                        continue
+                if self.deficits[template_id] < 1:
+                    self.current = None
+            if len(claimed) >= limit:
+                break
+        return claimed
+
+
+    def refund(self, rows):
+        """give back the credit of claimed rows put back to the queue unsimulated"""
+        for row in rows:
+            if row.template_id in self.deficits:
+                self.deficits[row.template_id] += 1
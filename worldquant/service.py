@@ -1,41 +1,113 @@
 from worldquant.api import WorldQuantSession
 from worldquant.constants import CHECK_METRIC_MAPPING, Status
-from worldquant.utils import load_config, dict_to_namespace
+from worldquant.utils import (
+    load_config, dict_to_namespace, max_timestamp, simulation_hash, canonical_settings
+)
+from worldquant.pnl import PnlStore, parse_pnl_recordset
+from worldquant.scheduler import FairShareScheduler
+from worldquant.validator import get_validator
+from worldquant.backtest import Backtester, Dataset, BacktestError
+from worldquant.metrics import (
+    API_RESPONSES, SIMULATION_SUBMIT_SECONDS, SIMULATION_PROGRESS_SECONDS, CHECK_SECONDS,
+    SIMULATIONS, SIMULATIONS_INFLIGHT, CHECKS_INFLIGHT, CHECKS, QUEUE_DEPTH, EXPRESSION_REJECTIONS
+)
 
-from db.database import SessionLocal
-from db.crud.data_field import upsert_data_field
-from db.crud.alpha import upsert_alpha, get_alphas, delete_alpha
-from db.crud.simulation_queue import delete_queue_by_id
-from db.schema.data_field import DataFieldBase
-from db.schema.alpha import AlphaBase
+from db.database import SessionLocal, init_db
+from db.crud.data_field import upsert_data_fields
+from db.crud.alpha import upsert_alphas, get_alpha_ids, iter_alpha_ids, delete_alpha, exists_expression_hash, get_alpha_by_alpha_id
+from db.crud.simulation_queue import (
+    delete_queue_by_id, delete_queue_by_ids, claim_queue, renew_lease, release_queue, prune_queue, count_queue_by_status,
+    iter_queued_rows, push_back_queue, release_queue_by_ids
+)
+from db.crud.parameter_stat import record_parameter_outcome, mark_parameter_pruned
+from db.crud.simulation_run import (
+    create_simulation_run, update_simulation_run, update_simulation_run_by_alpha_id, get_simulation_run_stats, utc_now
+)
+from db.crud.sync_state import get_watermark, set_watermark
+from db.schema.data_field import DataFieldBaseList
+from db.schema.alpha import AlphaBase, AlphaBaseList
 
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pydantic import ValidationError
 from loguru import logger
 from sqlalchemy import text
 from contextlib import contextmanager
+from datetime import timedelta
+from collections import deque, Counter
 
+import heapq
+import itertools
+import math
 import time
 import json
-import random
+import os
+import socket
 import threading
+import uuid
+
+
+class CheckBackoff():
+    """
+    wait before the next poll of a PENDING check. polls aim at the expected check time, a moving
+    average of the observed time from the first check call to the final result, once that is over
+    the wait doubles from `min_wait`, always capped by `max_wait`.
+    """
+    def __init__(self, min_wait = 10, max_wait = 240, expected = 60, smoothing = 0.2):
+        self.min_wait = min_wait
+        self.max_wait = max_wait
+        self.expected = expected
+        self.smoothing = smoothing
+        self.lock = threading.Lock()
+
+
+    def observe(self, seconds):
+        with self.lock:
+            self.expected += self.smoothing * (seconds - self.expected)
+
+
+    def next_wait(self, elapsed, overdue_polls):
+        """`overdue_polls` is the number of polls already made past the expected check time"""
+        with self.lock:
+            remaining = self.expected - elapsed
+        if remaining >= self.min_wait:
+            wait = remaining
+        else:
+            wait = self.min_wait * 2 ** overdue_polls
+        return min(max(wait, self.min_wait), self.max_wait)
 
 
 class WorldQuantService():
     def __init__(self):
         self.session = WorldQuantSession()
         self.session_time = time.time()
+        init_db()
         self.db = SessionLocal()
         self.db.execute(text('PRAGMA journal_mode=WAL;'))
         self.config = dict_to_namespace(load_config('simulation'))
+        # identifies the queue rows leased by this process
+        self.worker_id = f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}'
         
         self.simulation_cnt = 0
         self.pass_cnt = 0
         self.fail_cnt = 0
         self.avg_sharpe = 0
         self.avg_fitness = 0
+        self.skip_cnt = 0
+        self.stats_lock = threading.Lock()
+        scheduler = self.config.check_scheduler
+        # shared by every check path so that all of them learn from the observed check times
+        self.check_backoff = CheckBackoff(scheduler.min_wait, scheduler.max_wait, scheduler.expected)
+        self._pnl_store = None
+        self.scheduler = FairShareScheduler(self.config.fair_share.quantum)
+        QUEUE_DEPTH.set_function(self._queue_depth)
         
 
+    def _queue_depth(self):
+        # read at scrape time from any thread, a private session leaves the thread local ones alone
+        with SessionLocal.session_factory() as db:
+            return [({'status': status}, count) for status, count in count_queue_by_status(db).items()]
+
+
     @contextmanager
     def session_scope(self):
         db = SessionLocal()
@@ -49,30 +121,17 @@ class WorldQuantService():
             SessionLocal.remove()
 
     def get_all_datafields(self, params):
-        res = self.session.get_datafields(params).json()
-        count = res.get('count')
-        logger.info(f'found {count} datafields')
-        result = []
-        for i in range(0, count, 50):
-            res = self.session.get_datafields(params, 50, i).json()
-            result += res['results']
-        return result
+        return self.session.get_pages(
+            lambda limit, offset: self.session.get_datafields(params, limit, offset),
+            limit = 50, fan_out = self.config.fetch_fan_out
+        )
     
 
-    def get_all_alphas(self, params):
-        res = self.session.search_alpha(params)
-        if res.status_code != 200:
-            logger.error(f'fail to fetch alphas {res.code} {res.text}')
-            return None
-        count = res.json()['count']
-        logger.debug(f'search_alpha api found {count} alphas')
-        result = []
-        batch_size = 100
-        for i in range(0, count, batch_size):
-            res = self.session.search_alpha(params, limit = batch_size, offset = i).json()
-            result += res['results']
-            logger.debug(f'search_alpha api fetched {len(result)}')
-        return result
+    def get_all_alphas(self, params, failed_offsets = None):
+        return self.session.get_pages(
+            lambda limit, offset: self.session.search_alpha(params, limit, offset),
+            limit = 100, fan_out = self.config.fetch_fan_out, failed_offsets = failed_offsets
+        )
 
 
     def refresh_datafields(self, params = {
@@ -81,29 +140,39 @@ class WorldQuantService():
         'universe': 'TOP3000',
         'instrumentType': 'EQUITY'
     }):
-        data_fields = self.get_all_datafields(params)
-        for data_field in data_fields:
+        count = 0
+        for page in self.get_all_datafields(params):
             try:
-                df = DataFieldBase.model_validate({
-                    "field_name": data_field["id"],
-                    **{k: v for k, v in data_field.items() if k != "id"},
-                    "dataset_id": data_field.get("dataset", {}).get("id"),
-                    "dataset_name" : data_field.get('dataset', {}).get('name'),
-                    "category_id" : data_field.get('category', {}).get('id'),
-                    "category_name" : data_field.get('category', {}).get('name'),
-                    "subcategory_id" : data_field.get('subcategory', {}).get('id'),
-                    "subcategory_name" : data_field.get('subcategory', {}).get('name'),
-                    "user_count" : data_field.get('userCount'),
-                    "alpha_count" : data_field.get('alphaCount')
-                })
-                upsert_data_field(self.db, df)
+                data_fields = DataFieldBaseList.validate_python([
+                    {
+                        "field_name": data_field["id"],
+                        **{k: v for k, v in data_field.items() if k != "id"},
+                        "dataset_id": data_field.get("dataset", {}).get("id"),
+                        "dataset_name" : data_field.get('dataset', {}).get('name'),
+                        "category_id" : data_field.get('category', {}).get('id'),
+                        "category_name" : data_field.get('category', {}).get('name'),
+                        "subcategory_id" : data_field.get('subcategory', {}).get('id'),
+                        "subcategory_name" : data_field.get('subcategory', {}).get('name'),
+                        "user_count" : data_field.get('userCount'),
+                        "alpha_count" : data_field.get('alphaCount')
+                    }
+                    for data_field in page
+                ])
             except ValidationError as e:
                 logger.error(f"Validation failed: {e.errors()}")
                 return
+            count += upsert_data_fields(self.db, data_fields)
+            logger.debug(f'refreshed {count} datafields')
+        logger.info(f'refreshed {count} datafields')
         logger.info("All data fields are refreshed to local db!")
 
 
-    def refresh_alphas(self, start_date = None, end_date = None, status = None):
+    def refresh_alphas(self, start_date = None, end_date = None, status = None, full = False):
+        """
+        sync the alphas matching the sharpe/fitness filters to local db. unless `full` or an explicit date
+        range is given, only the alphas modified after the watermark of the previous sync are fetched,
+        a watermark is kept per filter set on the max dateModified seen.
+        """
         positive_params = {
             'is.sharpe>': f'{self.config.sharpe_low}',
             'is.fitness>': f'{self.config.fitness_low}'
@@ -124,75 +193,97 @@ class WorldQuantService():
         else:
             status_param = { 'status': 'UNSUBMITTEDIS-FAIL' }
             
-        alphas = []
+        incremental = not (start_date or end_date)
+        count = 0
         for params in (positive_params, negative_params):
-            alphas += self.get_all_alphas({
+            filter_params = {
                 'is.turnover>': f'{self.config.turnover_low}',
                 'is.turnover<': f'{self.config.turnover_high}',
                 'hidden': 'false',
                 **params,
-                **date_params,
                 **status_param
-            })
-        logger.info(f'found {len(alphas)} alphas')
-        
-        for alpha in alphas:
-            try:
-                settings = alpha.get('settings', {})
-                metrics = alpha.get('is', {})
-                data = AlphaBase.model_validate({
-                    'alpha_id': alpha.get('id'),
-                    'expression': alpha.get('regular', {}).get('code'),
-                    'type': alpha.get('type'),
-                    'instrument_type': settings.get('instrumentType'),
-                    'region': settings.get('region'),
-                    'universe': settings.get('universe'),
-                    'delay': settings.get('delay'),
-                    'decay': settings.get('decay'),
-                    'neutralization': settings.get('neutralization'),
-                    'truncation': settings.get('truncation'),
-                    'pasteurization': settings.get('pasteurization'),
-                    'unit_handling': settings.get('unitHandling'),
-                    'nan_handling': settings.get('nanHandling'),
-                    'max_trade': settings.get('maxTrade'),
-                    'language': settings.get('language'),
-                    'visualization': settings.get('visualization'),
-                    'status': alpha.get('status'),
-                    'sharpe': metrics.get('sharpe'),
-                    'fitness': metrics.get('fitness'),
-                    'turnover': metrics.get('turnover'),
-                    'drawdown': metrics.get('drawdown'),
-                    'long_count': metrics.get('longCount'),
-                    'short_count': metrics.get('shortCount'),
-                    'returns': metrics.get('returns'),
-                    'margin': metrics.get('margin'),
-                    'pnl': metrics.get('pnl')
-                })
-                upsert_alpha(self.db, data, False)
-            except ValidationError as e:
-                logger.error(f"Validation failed: {e.errors()}")
+            }
+            sync_key = f'alphas:{json.dumps(filter_params, sort_keys=True)}'
+            watermark = get_watermark(self.db, sync_key) if incremental and not full else None
+            sync_params = date_params
+            if watermark:
+                logger.info(f'fetch alphas modified after {watermark}')
+                sync_params = { 'dateModified>': watermark }
+
+            failed_offsets = []
+            new_watermark = watermark
+            for page in self.get_all_alphas({**filter_params, **sync_params}, failed_offsets):
+                rows = [self._search_result_to_alpha(alpha) for alpha in page]
+                try:
+                    data = AlphaBaseList.validate_python(rows)
+                except ValidationError as e:
+                    logger.error(f"Validation failed: {e.errors()}")
+                    invalid = {error['loc'][0] for error in e.errors()}
+                    data = AlphaBaseList.validate_python([row for i, row in enumerate(rows) if i not in invalid])
+                count += upsert_alphas(self.db, data, refresh_status = False)
+                logger.debug(f'refreshed {count} alphas')
+                for alpha in page:
+                    new_watermark = max_timestamp(new_watermark, alpha.get('dateModified'))
+
+            if not incremental:
+                continue
+            if failed_offsets:
+                logger.warning(f'{len(failed_offsets)} pages failed, keep the watermark {watermark}')
+            elif new_watermark and new_watermark != watermark:
+                set_watermark(self.db, sync_key, new_watermark)
+        logger.info(f'found {count} alphas')
         logger.info("All alphas are refreshed to local db!")
 
 
-    def _check_alpha(self, alpha_id):
-        try:
-            ac_response = self.session.check_alpha(alpha_id)
-            if ac_response.status_code == 200:
-                if not ac_response.text:
-                    return Status.PENDING.value
-            elif ac_response.status_code == 429:
-                return Status.WAITING.value
-            elif ac_response.status_code == 401:
-                self.session._sign_in()
-                return Status.EXPIRED.value
-            else:
-                logger.error(f'alpha_id, {alpha_id}, error {ac_response.status_code}, {ac_response.text}')
-                return Status.ERROR.value
-            alpha_check_list = ac_response.json().get('is').get('checks')
-        except Exception as e:
-            logger.error(f'fail to check alpha {e}')
+    def _search_result_to_alpha(self, alpha):
+        settings = alpha.get('settings', {})
+        metrics = alpha.get('is', {})
+        return {
+            'alpha_id': alpha.get('id'),
+            'expression': alpha.get('regular', {}).get('code'),
+            'type': alpha.get('type'),
+            'instrument_type': settings.get('instrumentType'),
+            'region': settings.get('region'),
+            'universe': settings.get('universe'),
+            'delay': settings.get('delay'),
+            'decay': settings.get('decay'),
+            'neutralization': settings.get('neutralization'),
+            'truncation': settings.get('truncation'),
+            'pasteurization': settings.get('pasteurization'),
+            'unit_handling': settings.get('unitHandling'),
+            'nan_handling': settings.get('nanHandling'),
+            'max_trade': settings.get('maxTrade'),
+            'language': settings.get('language'),
+            'visualization': settings.get('visualization'),
+            'status': alpha.get('status'),
+            'sharpe': metrics.get('sharpe'),
+            'fitness': metrics.get('fitness'),
+            'turnover': metrics.get('turnover'),
+            'drawdown': metrics.get('drawdown'),
+            'long_count': metrics.get('longCount'),
+            'short_count': metrics.get('shortCount'),
+            'returns': metrics.get('returns'),
+            'margin': metrics.get('margin'),
+            'pnl': metrics.get('pnl'),
+            'expression_hash': simulation_hash(alpha.get('regular', {}).get('code'), settings)
+        }
+
+
+    def _check_response_status(self, alpha_id, ac_response):
+        # None means the check result is ready to be parsed
+        if ac_response.status_code == 200:
+            if not ac_response.text:
+                return Status.PENDING.value
+            return None
+        elif ac_response.status_code == 401:
+            return Status.EXPIRED.value
+        else:
+            logger.error(f'alpha_id, {alpha_id}, error {ac_response.status_code}, {ac_response.text}')
             return Status.ERROR.value
-        
+
+
+    def _parse_alpha_checks(self, alpha_id, check_result):
+        alpha_check_list = check_result.get('is').get('checks')
         alpha_check_dict = {'alpha_id': alpha_id}
         check_status = Status.PASS.value
         for check in alpha_check_list:
@@ -207,36 +298,35 @@ class WorldQuantService():
                 check_status = Status.FAIL.value
 
         alpha_check_dict['status'] = check_status
+        return check_status, alpha_check_dict
 
-        while True:
-            alpha_response = self.session.get_alpha(alpha_id)
-            if alpha_response.status_code == 200:
-                break
-            else:
-                logger.warning(
-                    f'fail to call get_alpha api, {alpha_response.status_code}, wait for 5 s and try again')
-                time.sleep(5)
 
-        alpha_metrics = alpha_response.json().get('is')
-        self.simulation_cnt += 1
+    def _save_alpha_check(self, db, alpha_id, check_status, alpha_check_dict, alpha_detail):
+        alpha_metrics = alpha_detail.get('is')
         sharpe = alpha_metrics.get("sharpe") or 0
         fitness = alpha_metrics.get("fitness") or 0
-        if self.avg_sharpe == 0:
-            self.avg_sharpe = abs(sharpe)
-        else:
-            self.avg_sharpe = (self.avg_sharpe * (self.simulation_cnt - 1) + abs(sharpe) ) / self.simulation_cnt
-        
-        if self.avg_fitness == 0:
-            self.avg_fitness = abs(fitness) 
-        else:
-            self.avg_fitness = (self.avg_fitness * (self.simulation_cnt - 1) + abs(fitness) ) / self.simulation_cnt
-        
-        if check_status == Status.PASS.value:
-            self.pass_cnt += 1
-        else:
-            self.fail_cnt += 1
+        # the check stage saves from several threads
+        with self.stats_lock:
+            self.simulation_cnt += 1
+            if self.avg_sharpe == 0:
+                self.avg_sharpe = abs(sharpe)
+            else:
+                self.avg_sharpe = (self.avg_sharpe * (self.simulation_cnt - 1) + abs(sharpe) ) / self.simulation_cnt
+            
+            if self.avg_fitness == 0:
+                self.avg_fitness = abs(fitness) 
+            else:
+                self.avg_fitness = (self.avg_fitness * (self.simulation_cnt - 1) + abs(fitness) ) / self.simulation_cnt
+            
+            if check_status == Status.PASS.value:
+                self.pass_cnt += 1
+            else:
+                self.fail_cnt += 1
         
-        logger.debug(f'alpha_id {alpha_id}, expression: {alpha_response.json().get("regular").get("code")}')
+        update_simulation_run_by_alpha_id(db, alpha_id, check_status = check_status, checked_at = utc_now())
+        rows = get_alpha_by_alpha_id(db, alpha_id)
+        CHECKS.inc(template_id = rows[0].template_id if rows and rows[0].template_id is not None else '', status = check_status)
+        logger.debug(f'alpha_id {alpha_id}, expression: {alpha_detail.get("regular").get("code")}')
         logger.info(f'alpha_id {alpha_id}, sharpe: {sharpe}, fitness: {fitness}')
         if alpha_metrics:
             alpha_check_dict['drawdown'] = alpha_metrics.get('drawdown')
@@ -245,148 +335,471 @@ class WorldQuantService():
             alpha_check_dict['pnl'] = alpha_metrics.get('pnl')
             alpha_check_dict['returns'] = alpha_metrics.get('returns')
             alpha_check_dict['short_count'] = alpha_metrics.get('shortCount')
+        if rows:
+            self._record_parameter_outcome(db, rows[0], sharpe, fitness)
         alpha = AlphaBase.model_validate(alpha_check_dict)
         if check_status ==  Status.PASS.value or \
             (sharpe >= self.config.sharpe_low and fitness >= self.config.fitness_low) or \
             (sharpe <=  -self.config.sharpe_low and fitness <= -self.config.fitness_low):
             logger.debug(f"alpha_id {alpha_id}, keep this alpha in local db")
-            upsert_alpha(self.db, alpha)
+            upsert_alphas(db, [alpha])
         else:
+            # the discarded alpha is kept so that its expression is never simulated again
             logger.debug(f"alpha_id {alpha_id}, discard this alpha")
-            delete_alpha(self.db, alpha_id)
+            alpha.status = Status.DISCARDED.value
+            upsert_alphas(db, [alpha])
+
+
+    def _record_parameter_outcome(self, db, alpha, sharpe, fitness):
+        """
+        add the result of a template alpha to the stats of its parameter values, a value whose best
+        |sharpe| and |fitness| stay below the `pruning` thresholds after `min_trials` simulations
+        is pruned: its queued combinations are dropped or pushed back.
+        """
+        pruning = self.config.pruning
+        # only the first check of a template alpha counts, a re-check before submission does not
+        if not pruning.enabled or alpha.status != Status.UNSUBMITTED.value or not alpha.params:
+            return
+        template_id = alpha.template_id
+        for stat in record_parameter_outcome(db, template_id, alpha.params, abs(sharpe), abs(fitness)):
+            if stat.pruned or stat.trials < pruning.min_trials:
+                continue
+            if stat.best_sharpe >= pruning.sharpe_below or stat.best_fitness >= pruning.fitness_below:
+                continue
+            if not mark_parameter_pruned(db, template_id, stat.param_name, stat.param_value):
+                continue
+            drop = pruning.action == 'drop'
+            count = prune_queue(db, template_id, stat.param_name, stat.param_value, drop)
+            logger.info(
+                f'prune {stat.param_name}={stat.param_value} of template {template_id} after {stat.trials} trials, '
+                f'best sharpe {stat.best_sharpe}, best fitness {stat.best_fitness}, '
+                f'{count} queued alphas {"dropped" if drop else "pushed back"}'
+            )
+
+
+    def _check_alpha(self, alpha_id):
+        try:
+            ac_response = self.session.check_alpha(alpha_id)
+            status = self._check_response_status(alpha_id, ac_response)
+            if status == Status.EXPIRED.value:
+                self.session._sign_in(ac_response.generation)
+            if status:
+                return status
+            check_status, alpha_check_dict = self._parse_alpha_checks(alpha_id, ac_response.json())
+        except Exception as e:
+            logger.error(f'fail to check alpha {e}')
+            return Status.ERROR.value
 
+        while True:
+            alpha_response = self.session.get_alpha(alpha_id)
+            if alpha_response.status_code == 200:
+                break
+            else:
+                logger.warning(
+                    f'fail to call get_alpha api, {alpha_response.status_code}, wait for 5 s and try again')
+                time.sleep(5)
+
+        # thread local session, the check stage runs _check_alpha from its own worker threads
+        self._save_alpha_check(SessionLocal(), alpha_id, check_status, alpha_check_dict, alpha_response.json())
         return check_status
 
 
     def check_all_alphas(self):
-        result = get_alphas(self.db, status= [Status.UNSUBMITTED.value])
-        alphas = []
-        for row in result:
-            alphas.append(row.alpha_id)
-        buffer = []
-        buffer_size = 2
-
-        while len(alphas) > 0 or len(buffer) > 0:
-            current_time = time.time()
-            if len(buffer) < buffer_size and len(alphas) > 0:
-                alpha = {
-                    'alpha_id' : alphas.pop(),
-                    'wait_sec': 0,
-                    'wait_until': current_time
-                }
-                buffer.append(alpha)
-            buffer.sort(key = lambda x: x.get('wait_until'))
-            
-            alpha = buffer[0]
-            wait_sec = alpha.get('wait_sec')
-            wait_until = alpha.get('wait_until')
-            alpha_id = alpha.get('alpha_id')
-            if wait_until <= current_time:
-                buffer.pop(0)
+        """
+        check every UNSUBMITTED alpha with `check_scheduler.concurrency` worker threads. the alphas wait
+        in a heap keyed on the time of their next poll, at most `buffer_size` of them at once, topped up
+        from a stream of the alpha ids.
+        """
+        scheduler = self.config.check_scheduler
+        alpha_ids = iter_alpha_ids(self.db, status = [Status.UNSUBMITTED.value])
+        logger.info(f'start to check all unsubmitted alphas, concurrency {scheduler.concurrency}, buffer size {scheduler.buffer_size}')
+        # (due time, sequence, alpha_id, start time, overdue polls), the sequence breaks the ties, the
+        # start time is the first dispatch, not the push, the wait in the buffer is no check time
+        heap = []
+        sequence = itertools.count()
+        futures = {}
+        exhausted = False
+        checked = 0
+
+        def check(alpha_id):
+            try:
+                return self._check_alpha(alpha_id)
+            except Exception as e:
+                logger.error(f'check task failed: {e}')
+                return Status.ERROR.value
+            finally:
+                SessionLocal.remove()
+
+        with ThreadPoolExecutor(max_workers = scheduler.concurrency) as executor:
+            while True:
+                now = time.time()
+                while not exhausted and len(heap) + len(futures) < scheduler.buffer_size:
+                    alpha_id = next(alpha_ids, None)
+                    if alpha_id is None:
+                        exhausted = True
+                        break
+                    heapq.heappush(heap, (now, next(sequence), alpha_id, None, 0))
+                while heap and heap[0][0] <= now and len(futures) < scheduler.concurrency:
+                    due, order, alpha_id, start_time, overdue_polls = heapq.heappop(heap)
+                    entry = (due, order, alpha_id, time.time() if start_time is None else start_time, overdue_polls)
+                    futures[executor.submit(check, alpha_id)] = entry
+                    CHECKS_INFLIGHT.inc()
+                if not heap and not futures:
+                    break
+
+                timeout = None
+                if heap and len(futures) < scheduler.concurrency:
+                    timeout = max(heap[0][0] - now, 0)
+                if not futures:
+                    time.sleep(timeout)
+                    continue
+                done, _ = wait(futures, timeout = timeout, return_when = FIRST_COMPLETED)
+
+                for future in done:
+                    CHECKS_INFLIGHT.dec()
+                    _, _, alpha_id, start_time, overdue_polls = futures.pop(future)
+                    status = future.result()
+                    elapsed = time.time() - start_time
+                    logger.info(f'alpha_id {alpha_id}, check status {status}')
+                    if status == Status.PENDING.value:
+                        wait_sec = self.check_backoff.next_wait(elapsed, overdue_polls)
+                        if elapsed >= self.check_backoff.expected:
+                            overdue_polls += 1
+                    elif status in (Status.WAITING.value, Status.ERROR.value, Status.EXPIRED.value):
+                        wait_sec = scheduler.retry_wait
+                    else:
+                        self.check_backoff.observe(elapsed)
+                        CHECK_SECONDS.observe(elapsed)
+                        checked += 1
+                        continue
+                    logger.debug(f'alpha_id {alpha_id} wait for {wait_sec:.0f} s')
+                    heapq.heappush(heap, (time.time() + wait_sec, next(sequence), alpha_id, start_time, overdue_polls))
+        logger.info(f'checked {checked} alphas')
+
+
+    def check_one_alpha(self, alpha_id, stop_event = None):
+        """check an alpha until its result is final, returns None if `stop_event` is set meanwhile"""
+        start_time = time.time()
+        overdue_polls = 0
+        with CHECKS_INFLIGHT.track_inprogress():
+            while True:
                 status = self._check_alpha(alpha_id)
                 logger.info(f'alpha_id {alpha_id}, check status {status}')
+                elapsed = time.time() - start_time
                 if status == Status.PENDING.value:
-                    wait_sec = 30 if wait_sec == 0 else wait_sec * 2
+                    wait_sec = self.check_backoff.next_wait(elapsed, overdue_polls)
+                    if elapsed >= self.check_backoff.expected:
+                        overdue_polls += 1
                 elif status in (Status.WAITING.value, Status.ERROR.value, Status.EXPIRED.value):
-                    wait_sec = 30
+                    wait_sec = self.config.check_scheduler.retry_wait
                 else:
-                    continue
-                new_alpha = {
-                    'wait_sec': wait_sec,
-                    'wait_until': current_time + wait_sec,
-                    'alpha_id': alpha_id
-                }
-                buffer.append(new_alpha)
-            else:
-                wait_time = round(wait_until - current_time + 1)
-                logger.info(f'alpha {alpha_id} wait for {wait_time} s')
-                time.sleep(wait_time)
+                    self.check_backoff.observe(elapsed)
+                    CHECK_SECONDS.observe(elapsed)
+                    return status
+                logger.info(f'alpha_id {alpha_id} wait for {wait_sec:.0f} s')
+                if stop_event is None:
+                    time.sleep(wait_sec)
+                elif stop_event.wait(wait_sec):
+                    logger.info(f'alpha_id {alpha_id} check cancelled')
+                    return None
+
+
+    def check_from_alpha_queue(self, stop_event: threading.Event):
+        """
+        check stage of the simulation pipeline, checks the UNSUBMITTED alphas written by the
+        simulation stage with its own `check_parallelism` workers, so that a slow check never
+        holds a simulation slot.
+        """
+        logger.info(f'start to check simulated alphas, parallelism {self.config.check_parallelism}')
+        inflight = set()
+        lock = threading.Lock()
+
+        def process_alpha(alpha_id):
+            try:
+                self.check_one_alpha(alpha_id)
+            except Exception as e:
+                logger.error(f"check task failed: {e}")
+            finally:
+                SessionLocal.remove()
+                with lock:
+                    inflight.discard(alpha_id)
+
+        with ThreadPoolExecutor(max_workers = self.config.check_parallelism) as executor:
+            while not stop_event.is_set():
+                with lock:
+                    running = set(inflight)
+                for alpha_id in self._alpha_ids_to_check(running):
+                    with lock:
+                        inflight.add(alpha_id)
+                    executor.submit(process_alpha, alpha_id)
+                stop_event.wait(10)
+
+
+    def _alpha_ids_to_check(self, running):
+        """the UNSUBMITTED alphas to check next, as many as the check slots left free by the `running` ones"""
+        free = self.config.check_parallelism - len(running)
+        if free <= 0:
+            return []
+        with self.session_scope() as db:
+            return get_alpha_ids(db, status = [Status.UNSUBMITTED.value], exclude = running, limit = free)
 
 
-    def check_one_alpha(self, alpha_id):
-        wait_sec = 0
+    def simulate_one(self, simulation, origin = None, run_id = None):
+        logger.debug(f'start to simulate alpha: {simulation.get("regular")}')
+        with self.session_scope() as db, SIMULATIONS_INFLIGHT.track_inprogress():
+            alpha_ids = self._run_steps(self._simulation_steps(db, [simulation], [origin], [run_id], multi = False))
+            return alpha_ids[0] if alpha_ids else None
+
+
+    def simulate_batch(self, simulations, origins, run_ids):
+        """
+        simulate up to `multi_simulation_size` simulations sharing their settings with one multi simulation
+        request, only the parent progress url is polled, then the result of every child is saved like
+        the one of simulate_one. returns the alpha ids.
+        """
+        logger.debug(f'start to simulate {len(simulations)} alphas in one multi simulation')
+        with self.session_scope() as db, SIMULATIONS_INFLIGHT.track_inprogress(len(simulations)):
+            return self._run_steps(self._simulation_steps(db, simulations, origins, run_ids, multi = True))
+
+
+    def _run_steps(self, steps):
+        """do the I/O of the steps of `_simulation_steps` with the blocking session, returns their result"""
+        response = None
         while True:
-            status = self._check_alpha(alpha_id)
-            logger.info(f'alpha_id {alpha_id}, check status {status}')
-            if status == Status.PENDING.value:
-                wait_sec = 30 if wait_sec == 0 else (wait_sec * 2 if wait_sec < 240 else 240)
-            elif status in (Status.WAITING.value, Status.ERROR.value):
-                wait_sec = 30
+            try:
+                action, argument = steps.send(response)
+            except StopIteration as stop:
+                return stop.value
+            response = None
+            if action == 'post':
+                response = self.session.post_simulation(argument)
+            elif action == 'poll':
+                response = self.session.get_simulation_status(argument)
+            elif action == 'sign_in':
+                self.session._sign_in(argument.generation)
             else:
-                return status
-            logger.info(f'alpha_id {alpha_id} wait for {wait_sec} s')
-            time.sleep(wait_sec)
-        
+                time.sleep(argument)
 
-    def simulate_one(self, simulation):
-        logger.debug(f'start to simulate alpha: {simulation.get("regular")}')
-        with self.session_scope() as db:
-            while True:
-                response = self.session.post_simulation(simulation)
-                if response.status_code < 300:
-                    sim_progress_url = response.headers['Location']
-                    simulate_id = sim_progress_url.split('/')[-1]
-                    logger.debug(f'simulation submitted, simulate_id {simulate_id}')
-                    break
-                elif response.status_code in (429, ):
-                    reason = response.json().get('detail')
-                    if reason == 'DAILY_SIMULATION_LIMIT_EXCEEDED':
-                        wait_sec = 10 * 60
-                    else:
-                        wait_sec = 30
-                    logger.warning(f'{response.status_code}, {response.text}, wait for {wait_sec} s')
-                    time.sleep(wait_sec)
-                    continue
-                elif response.status_code in (401,):
-                    self.session._sign_in()
-                    logger.info(f'{response.status_code}, {response.text}, sign in again, wait for 30s')
-                    continue
-                else:
-                    logger.error(f'{response.status_code}, {response.text}')
-                    return
-            
-            while True:
-                res = self.session.get_simulation_status(simulate_id).json()
-                if res.get('progress'):
-                    time.sleep(10)
-                else:
-                    break
 
-            if res.get('status') in (Status.COMPLETE.value, Status.WARNING.value):
-                if res.get('status') == Status.WARNING.value:
-                    logger.warning(f'{res.get("message")}')
-                alpha_id = res.get('alpha')
-                logger.debug(f'simulation completed, alpha_id {alpha_id}')
-                # upsert simulation
-                alpha = AlphaBase.model_validate({
-                    'type': res.get('type'),
-                    'instrument_type': res.get('settings').get('instrumentType'),
-                    'region': res.get('settings').get('region'),
-                    'universe': res.get('settings').get('universe'),
-                    'delay': res.get('settings').get('delay'),
-                    'decay': res.get('settings').get('decay'),
-                    'neutralization': res.get('settings').get('neutralization'),
-                    'truncation': res.get('settings').get('truncation'),
-                    'pasteurization': res.get('settings').get('pasteurization'),
-                    'unit_handling': res.get('settings').get('unitHandling'),
-                    'nan_handling': res.get('settings').get('nanHandling'),
-                    'max_trade': res.get('settings').get('maxTrade'),
-                    'language': res.get('settings').get('language'),
-                    'visualization': res.get('settings').get('visualization'),
-                    'expression': res.get('regular'),
-                    'alpha_id': alpha_id,
-                    'status': Status.UNSUBMITTED.value
-                })
-                upsert_alpha(db, alpha)
-                logger.debug(f'simulation table updated, alpha_id {alpha_id}')
-
-                # update alpha check and status for simulation table
-                self.check_one_alpha(alpha_id)
+    def _simulation_steps(self, db, simulations, origins, run_ids, multi):
+        """
+        the request and response handling of a simulation, shared by the thread and the async engine which only
+        do the I/O. a generator of the steps ('post', payload), ('poll', simulate_id), ('sign_in', response of
+        the 401) and ('sleep', seconds), sent the response of each request, that returns the alpha ids.
+        """
+        simulate_id, submit_time = yield from self._post_steps(db, simulations if multi else simulations[0], run_ids)
+        if simulate_id is None:
+            return []
+        res = yield from self._poll_steps(simulate_id)
+        if not multi:
+            return [self._finish_simulation(db, res, simulations[0], origins[0], run_ids[0], submit_time, simulate_id)]
+        children = res.get('children') or []
+        alpha_ids = []
+        for i, (simulation, origin, run_id) in enumerate(zip(simulations, origins, run_ids)):
+            child_id = children[i] if i < len(children) else None
+            if child_id:
+                child = yield from self._poll_steps(child_id)
             else:
-                logger.error(f'Fail to complete simulation for {simulate_id}, status is {res.get("status")}')
-                logger.error(res)
+                child = {'status': res.get('status') or Status.ERROR.value, 'message': res.get('message') or 'missing child simulation'}
+            alpha_ids.append(self._finish_simulation(db, child, simulation, origin, run_id, submit_time, child_id))
+        return alpha_ids
+
+
+    def _post_steps(self, db, payload, run_ids):
+        """post one simulation or a list of them, returns the simulate_id of the progress url and the submit time"""
+        start_time = time.time()
+        while True:
+            response = yield 'post', payload
+            if response.status_code < 300:
+                sim_progress_url = response.headers['Location']
+                simulate_id = sim_progress_url.split('/')[-1]
+                logger.debug(f'simulation submitted, simulate_id {simulate_id}')
+                submit_time = time.time()
+                for run_id in run_ids:
+                    self._update_run(db, run_id, simulate_id = simulate_id, submitted_at = utc_now(), status = 'RUNNING')
+                SIMULATION_SUBMIT_SECONDS.observe(submit_time - start_time)
+                return simulate_id, submit_time
+            elif response.status_code in (401,):
+                logger.info(f'{response.status_code}, {response.text}, sign in again')
+                yield 'sign_in', response
+                continue
+            else:
+                logger.error(f'{response.status_code}, {response.text}')
+                SIMULATIONS.inc(len(run_ids), status = 'REJECTED')
+                for run_id in run_ids:
+                    self._update_run(
+                        db, run_id, status = 'REJECTED', error = f'{response.status_code}, {response.text}', completed_at = utc_now()
+                    )
+                return None, None
+
+
+    def _poll_steps(self, simulate_id):
+        """poll the progress url until the simulation is done, returns its result"""
+        failures = 0
+        while True:
+            response = yield 'poll', simulate_id
+            if response.status_code == 401:
+                logger.info(f'{response.status_code}, {response.text}, sign in again')
+                yield 'sign_in', response
+                continue
+            if response.status_code >= 300:
+                # back off on a failed poll, honoring Retry-After, 5 s doubling up to 60 s otherwise
+                failures += 1
+                wait_sec = float(response.headers.get('Retry-After') or min(5 * 2 ** (failures - 1), 60))
+                logger.warning(f'fail to poll simulation {simulate_id}, {response.status_code}, {response.text}, wait for {wait_sec:.0f} s')
+                yield 'sleep', wait_sec
+                continue
+            failures = 0
+            res = response.json()
+            # a simulation just started reports a progress of 0
+            if res.get('progress') is None:
+                return res
+            yield 'sleep', float(response.headers.get('Retry-After', 10))
+
+
+    def _finish_simulation(self, db, res, simulation, origin, run_id, submit_time, simulate_id = None):
+        """save the result of a finished simulation, returns the alpha_id"""
+        SIMULATION_PROGRESS_SECONDS.observe(time.time() - submit_time)
+        SIMULATIONS.inc(status = res.get('status'))
+        fields = {'simulate_id': simulate_id} if simulate_id else {}
+        self._update_run(
+            db, run_id, status = res.get('status'), alpha_id = res.get('alpha'), error = res.get('message'),
+            completed_at = utc_now(), **fields
+        )
+
+        if res.get('status') in (Status.COMPLETE.value, Status.WARNING.value):
+            if res.get('status') == Status.WARNING.value:
+                logger.warning(f'{res.get("message")}')
+            alpha_id = res.get('alpha')
+            logger.debug(f'simulation completed, alpha_id {alpha_id}')
+            # upsert simulation
+            alpha = self._simulation_to_alpha(res, simulation_hash(simulation['regular'], simulation['settings']), origin)
+            upsert_alphas(db, [alpha])
+            logger.debug(f'simulation table updated, alpha_id {alpha_id}')
+            # the UNSUBMITTED alpha row is picked up by the check stage
+            return alpha_id
+        else:
+            logger.error(f'Fail to complete simulation for {simulate_id}, status is {res.get("status")}')
+            logger.error(res)
             
     
+    def _is_simulated(self, db, expression_hash):
+        if expression_hash and exists_expression_hash(db, expression_hash):
+            with self.stats_lock:
+                self.skip_cnt += 1
+            return True
+        return False
+
+
+    def _is_invalid(self, db, simulation, expression_hash, origin):
+        """
+        validate the expression of a claimed row before it takes a simulation slot, the data field
+        catalog may have changed since it was queued. a rejected row is recorded as an INVALID run.
+        """
+        if not self.config.validation.enabled or simulation.get('type') != 'REGULAR':
+            return False
+        validator = get_validator(db, simulation['settings'], self.config.validation.catalog_ttl)
+        error = validator.validate(simulation['regular'])
+        if error is None:
+            return False
+        reason, message = error
+        logger.warning(f'skip {simulation["regular"]}, {message}')
+        EXPRESSION_REJECTIONS.inc(template_id = origin.get('template_id') or '', reason = reason, stage = 'dispatch')
+        run_id = self._start_run(db, simulation, expression_hash, origin)
+        self._update_run(db, run_id, status = 'INVALID', error = message, completed_at = utc_now())
+        return True
+
+
+    def _start_run(self, db, simulation, expression_hash, origin):
+        """record a simulation attempt in simulation_run, returns its id"""
+        return create_simulation_run(
+            db, template_id = origin.get('template_id'), expression_hash = expression_hash,
+            regular = simulation.get('regular'), worker_id = self.worker_id, status = 'SUBMITTING'
+        )
+
+
+    def _update_run(self, db, run_id, **fields):
+        if run_id is not None:
+            update_simulation_run(db, run_id, **fields)
+
+
+    @property
+    def batch_size(self):
+        """simulations per multi simulation request, 1 posts them one by one"""
+        return max(getattr(self.config, 'multi_simulation_size', 1), 1)
+
+
+    def _claim(self, db, limit, template_id = None, shuffle = False):
+        """lease up to `limit` queued rows, shared fairly between the templates unless one is given"""
+        if template_id is None and self.config.fair_share.enabled:
+            return self.scheduler.claim(db, self.worker_id, limit, self.config.lease_seconds, shuffle)
+        return claim_queue(db, self.worker_id, limit, self.config.lease_seconds, template_id, shuffle)
+
+
+    def _claim_batches(self, db, free, template_id = None, shuffle = False):
+        """
+        lease the rows of at most `free` multi simulation batches. the rows are claimed `batch_size` per slot,
+        but with mixed types or settings they split into more batches than that, the rows of the extra
+        batches are put back to the queue rather than leased while they wait for a slot.
+        """
+        batches = self._group_batches(self._claim(db, free * self.batch_size, template_id, shuffle))
+        extra = [row for rows in batches[free:] for row in rows]
+        if extra:
+            release_queue_by_ids(db, self.worker_id, [row.id for row in extra])
+            if template_id is None and self.config.fair_share.enabled:
+                self.scheduler.refund(extra)
+        return batches[:free]
+
+
+    def _group_batches(self, rows):
+        """split claimed queue rows into multi simulation batches of rows sharing their type and settings"""
+        groups = {}
+        for row in rows:
+            key = (row.type, canonical_settings(json.loads(row.settings)))
+            groups.setdefault(key, []).append(row)
+        return [
+            group[i:i + self.batch_size] for group in groups.values() for i in range(0, len(group), self.batch_size)
+        ]
+
+
+    def _queue_row_to_simulation(self, row):
+        """split a claimed queue row into its id, hash, the simulation request body and its template origin"""
+        simulation = row._asdict()
+        queue_id = simulation.pop('id')
+        expression_hash = simulation.pop('expression_hash')
+        origin = {
+            'template_id': simulation.pop('template_id'),
+            'params': json.loads(simulation.pop('params') or 'null')
+        }
+        simulation['settings'] = json.loads(simulation['settings'])
+        return queue_id, expression_hash, simulation, origin
+
+
+    def _simulation_to_alpha(self, res, expression_hash = None, origin = None):
+        settings = res.get('settings')
+        return AlphaBase.model_validate({
+            **(origin or {}),
+            'expression_hash': expression_hash,
+            'type': res.get('type'),
+            'instrument_type': settings.get('instrumentType'),
+            'region': settings.get('region'),
+            'universe': settings.get('universe'),
+            'delay': settings.get('delay'),
+            'decay': settings.get('decay'),
+            'neutralization': settings.get('neutralization'),
+            'truncation': settings.get('truncation'),
+            'pasteurization': settings.get('pasteurization'),
+            'unit_handling': settings.get('unitHandling'),
+            'nan_handling': settings.get('nanHandling'),
+            'max_trade': settings.get('maxTrade'),
+            'language': settings.get('language'),
+            'visualization': settings.get('visualization'),
+            'expression': res.get('regular'),
+            'alpha_id': res.get('alpha'),
+            'status': Status.UNSUBMITTED.value
+        })
+
+
     def print_simulation_status(self, template_id = None):
         where_condition = ''
         if template_id != None:
@@ -396,31 +809,103 @@ class WorldQuantService():
             logger.info(f'{result.cnt} alphas for template_id {template_id} in the queue')
         else:
             logger.info(f'{result.cnt} alphas in the queue')
+        result = self.db.execute(text(
+            "select count(*) as cnt, count(distinct worker_id) as workers from simulation_queue \
+            where status = 'CLAIMED' and lease_expires_at >= datetime('now')"
+        )).first()
+        logger.info(f'{result.cnt} alphas leased by {result.workers} workers')
             
         result = self.db.execute(text(f"select count(*) as cnt, status from alpha group by status"))
         for row in result:
             logger.info(f'{row.cnt} {row.status}')
 
+        for row in get_simulation_run_stats(self.db, utc_now() - timedelta(days = 1), template_id = template_id):
+            logger.info(
+                f'last 24h template {row.template_id}: {row.runs} runs, {row.completed} completed, {row.failed} failed, '
+                f'{row.invalid} invalid, {row.passed} passed, {round(row.submit_seconds or 0, 1)} s to submit, '
+                f'{round(row.progress_seconds or 0, 1)} s to complete'
+            )
+
     
     def periodic_print(self, stop_event: threading.Event):
         while not stop_event.is_set():
+            with self.stats_lock:
+                pass_cnt, fail_cnt, avg_sharpe, avg_fitness = self.pass_cnt, self.fail_cnt, self.avg_sharpe, self.avg_fitness
             logger.info('--- statistics for this session ---')
-            logger.info(f'- pass count {self.pass_cnt}')
-            logger.info(f'- fail count {self.fail_cnt}')
-            logger.info(f'- average sharpe {round(self.avg_sharpe, 2)}') 
-            logger.info(f'- average fitness {round(self.avg_fitness, 2)}')
+            logger.info(f'- pass count {pass_cnt}')
+            logger.info(f'- fail count {fail_cnt}')
+            logger.info(f'- average sharpe {round(avg_sharpe, 2)}') 
+            logger.info(f'- average fitness {round(avg_fitness, 2)}')
+            logger.info(f'- skipped duplicates {self.skip_cnt}')
+            logger.info(f'- in flight simulations {SIMULATIONS_INFLIGHT.get()}, checks {CHECKS_INFLIGHT.get()}')
+            logger.info(f'- throttled responses {API_RESPONSES.sum(code = 429)}, expired sessions {API_RESPONSES.sum(code = 401)}')
             logger.info('-----------------------------------')
             time.sleep(self.config.print_interval)
 
 
-    def simulate_from_alpha_queue(self, template_id = None, shuffle = False, stats = False):
+    def prescreen_queue(self, template_id = None):
+        """
+        backtest the queued alphas on the local dataset of `backtest.dataset_path` before they cost
+        simulations. an alpha whose local |sharpe| and |fitness| are below the `backtest` thresholds is
+        dropped (`"action": "drop"`) or claimed last (`"action": "deprioritize"`), `"action": "order"`
+        pushes every alpha back by the tenths of local |sharpe| it misses to `sharpe_pass`, so the
+        queue is claimed best first. the alphas the local backtest cannot evaluate are left as they are.
+        """
+        backtest = self.config.backtest
+        try:
+            backtester = Backtester(Dataset(backtest.dataset_path))
+        except BacktestError as e:
+            logger.warning(f'no local backtest, {e}')
+            return
+
+        def screen(row):
+            if row.type != 'REGULAR':
+                return row, None
+            try:
+                return row, backtester.simulate(row.regular, json.loads(row.settings))
+            except BacktestError as e:
+                logger.debug(f'{row.regular} not screened, {e}')
+                return row, None
+
+        # (template_id, screened | unsupported | hopeless) -> count
+        counts = Counter()
+        with ThreadPoolExecutor(max_workers = backtest.concurrency) as executor:
+            for rows in iter_queued_rows(self.db, template_id, backtest.batch_size):
+                hopeless = []
+                priorities = {}
+                for row, result in executor.map(screen, rows):
+                    if result is None:
+                        counts[row.template_id, 'unsupported'] += 1
+                        continue
+                    counts[row.template_id, 'screened'] += 1
+                    sharpe, fitness = abs(result['sharpe']), abs(result['fitness'])
+                    if sharpe < backtest.sharpe_below and fitness < backtest.fitness_below:
+                        counts[row.template_id, 'hopeless'] += 1
+                        hopeless.append(row.id)
+                    if backtest.action == 'order':
+                        priorities[row.id] = math.ceil(max(self.config.sharpe_pass - sharpe, 0) * 10)
+                if backtest.action == 'drop':
+                    delete_queue_by_ids(self.db, hopeless)
+                elif backtest.action == 'deprioritize':
+                    push_back_queue(self.db, {id: 1 for id in hopeless})
+                else:
+                    push_back_queue(self.db, priorities)
+                logger.info(f'{sum(count for (_, outcome), count in counts.items() if outcome == "screened")} alphas screened')
+
+        outcome = {'drop': 'dropped', 'deprioritize': 'pushed back'}.get(backtest.action, 'ordered by local sharpe')
+        for template in sorted({template for template, _ in counts}, key = str):
+            logger.info(
+                f'template {template}: {counts[template, "screened"]} screened, {counts[template, "hopeless"]} hopeless, '
+                f'{outcome}, {counts[template, "unsupported"]} not supported locally'
+            )
+
+
+    def simulate_from_alpha_queue(self, template_id = None, shuffle = False, stats = False, until_empty = False):
         if template_id != None:
-            where_condition = f'where template_id = {template_id}'
             template_info = f'template {template_id}'
         else:
-            where_condition  = ''
             template_info = 'all alphas from the queue'
-        logger.info(f"start to simulate {template_info}, parallelism {self.config.parallelism}, shuffle {shuffle}")
+        logger.info(f"start to simulate {template_info}, parallelism {self.config.parallelism}, batch size {self.batch_size}, shuffle {shuffle}, worker {self.worker_id}")
         
         if stats:
             stop_event = threading.Event()
@@ -428,56 +913,88 @@ class WorldQuantService():
             t.daemon = True
             t.start()
 
-        while True:
-            if time.time() - 3600 > self.session_time:
-                self.session._sign_in()
-                self.session_time = time.time()
-            time.sleep(1)
-            
-            result = self.db.execute(
-                text(f"select id, regular, settings, type \
-                     from simulation_queue {where_condition} order by id limit {1000}")
-            ).all()
-            if not result:
-                logger.info("no alpha found in the queue, wait for 1 min")
-                time.sleep(60)
-                continue
+        if self.config.check_parallelism > 0:
+            check_stop_event = threading.Event()
+            check_thread = threading.Thread(target = self.check_from_alpha_queue, args = (check_stop_event, ))
+            check_thread.daemon = True
+            check_thread.start()
 
-            if shuffle:
-                result = list(result)
-                random.shuffle(result)
-
-            def process_row(row):
-                simulation = row._asdict()
-                queue_id = simulation.get('id')
-                simulation.pop('id')
-                simulation['settings'] = json.loads(simulation['settings'])
-                self.simulate_one(simulation)
-                delete_queue_by_id(self.db, queue_id)
-                self.db.commit()
-            
+        def process_rows(rows):
+            # queue_id, simulation, origin and run_id of the rows to simulate
+            pending = []
+            try:
+                for row in rows:
+                    queue_id, expression_hash, simulation, origin = self._queue_row_to_simulation(row)
+                    if self._is_simulated(SessionLocal(), expression_hash):
+                        logger.info(f'skip {simulation["regular"]}, already simulated')
+                        delete_queue_by_id(SessionLocal(), queue_id)
+                        continue
+                    if self._is_invalid(SessionLocal(), simulation, expression_hash, origin):
+                        delete_queue_by_id(SessionLocal(), queue_id)
+                        continue
+                    run_id = self._start_run(SessionLocal(), simulation, expression_hash, origin)
+                    pending.append((queue_id, simulation, origin, run_id))
+                if len(pending) == 1:
+                    _, simulation, origin, run_id = pending[0]
+                    self.simulate_one(simulation, origin, run_id)
+                elif pending:
+                    _, simulations, origins, run_ids = zip(*pending)
+                    self.simulate_batch(list(simulations), list(origins), list(run_ids))
+                for queue_id, *_ in pending:
+                    delete_queue_by_id(SessionLocal(), queue_id)
+            except Exception as e:
+                for queue_id, _, _, run_id in pending:
+                    self._update_run(SessionLocal(), run_id, status = Status.ERROR.value, error = str(e), completed_at = utc_now())
+                    release_queue(SessionLocal(), self.worker_id, queue_id)
+                raise
+            finally:
+                SessionLocal.remove()
 
+        lease_time = time.time()
+        try:
             with ThreadPoolExecutor(max_workers = self.config.parallelism) as executor:
-                futures = [executor.submit(process_row, row) for row in result]
-                if shuffle:
-                    random.shuffle(futures)
-                for future in as_completed(futures):
-                    try:
-                        future.result()
-                    except Exception as e:
-                        logger.error(f"task failed: {e}")
-                # executor.map(process_row, result)
-
-            # single thread test
-            # for row in result:
-            #     process_row(row)
-
-            time.sleep(1)
-
-
-    def submit_alpha(self, alpha_id):
-        check_result = self.check_one_alpha(alpha_id)
-        if check_result != Status.PASS.value:
+                futures = set()
+                while True:
+                    if time.time() - 3600 > self.session_time:
+                        self.session._sign_in()
+                        self.session_time = time.time()
+                    if time.time() - self.config.lease_seconds / 3 > lease_time:
+                        renew_lease(self.db, self.worker_id, self.config.lease_seconds)
+                        lease_time = time.time()
+
+                    free = self.config.parallelism - len(futures)
+                    if free > 0:
+                        # claim only what can start now, so other workers get the rest of the queue
+                        futures |= {
+                            executor.submit(process_rows, rows) for rows in self._claim_batches(self.db, free, template_id, shuffle)
+                        }
+                    if not futures:
+                        if until_empty:
+                            logger.info("no alpha found in the queue, stop")
+                            break
+                        logger.info("no alpha found in the queue, wait for 1 min")
+                        time.sleep(60)
+                        continue
+
+                    done, futures = wait(futures, timeout = 60, return_when = FIRST_COMPLETED)
+                    for future in done:
+                        try:
+                            future.result()
+                        except Exception as e:
+                            logger.error(f"task failed: {e}")
+        finally:
+            release_queue(self.db, self.worker_id)
+            if stats:
+                stop_event.set()
+            if self.config.check_parallelism > 0:
+                check_stop_event.set()
+        if self.config.check_parallelism > 0:
+            # the queue is empty, the checks in progress are finished, the remaining UNSUBMITTED alphas are left to `-c`
+            check_thread.join()
+
+
+    def submit_alpha(self, alpha_id, check = True):
+        if check and self.check_one_alpha(alpha_id) != Status.PASS.value:
             return False
 
         status = Status.FAIL.value
@@ -495,10 +1012,6 @@ class WorldQuantService():
                 else:
                     status = Status.FAIL.value
                 break
-            elif response.status_code == 429:
-                logger.warning(f"{response.status_code}, {response.text}, wait for 30 s and try again")
-                time.sleep(30)
-                continue
             else:
                 logger.warning(f"unkown status {response.status_code}, {response.text}")
                 return False
@@ -508,29 +1021,133 @@ class WorldQuantService():
             "status": status
         }
         alpha = AlphaBase.model_validate(data)
-        upsert_alpha(self.db, alpha)
+        upsert_alphas(self.db, [alpha])
         logger.info(f"simulation status updated")
         return True if response.status_code < 300 else False
 
 
+    @property
+    def pnl_store(self):
+        if self._pnl_store is None:
+            self._pnl_store = PnlStore(self.config.self_correlation.store_path)
+        return self._pnl_store
+
+
+    def fetch_pnl(self, alpha_id):
+        """
+        add the daily pnl of an alpha to the pnl store, returns False if it is not available, or not
+        ready after `self_correlation.max_wait` seconds
+        """
+        if alpha_id in self.pnl_store:
+            return True
+        deadline = time.time() + self.config.self_correlation.max_wait
+        while time.time() < deadline:
+            response = self.session.get_pnl(alpha_id)
+            if response.status_code == 200 and response.text:
+                dates, pnl = parse_pnl_recordset(response.json())
+                self.pnl_store.put(alpha_id, dates, pnl)
+                return True
+            elif response.status_code == 200:
+                time.sleep(min(float(response.headers.get('Retry-After', 5)), max(deadline - time.time(), 0)))
+            elif response.status_code == 401:
+                self.session._sign_in(response.generation)
+            else:
+                logger.warning(f'fail to get the pnl of alpha {alpha_id}, {response.status_code}, {response.text}')
+                return False
+        logger.warning(f'the pnl of alpha {alpha_id} is not ready after {self.config.self_correlation.max_wait} s')
+        return False
+
+
+    def screen_self_correlation(self, alpha_id, active_ids):
+        """
+        the local estimate of the self correlation of an alpha, its highest pnl correlation with
+        the ACTIVE alphas, returns (correlation, alpha_id of the closest one), (None, None) if unknown.
+        """
+        screening = self.config.self_correlation
+        if not self.fetch_pnl(alpha_id):
+            return None, None
+        return self.pnl_store.max_correlation(alpha_id, active_ids, screening.window_days, screening.min_overlap)
+
+
+    def _is_self_correlated(self, alpha_id, active_ids):
+        correlation, closest = self.screen_self_correlation(alpha_id, active_ids)
+        if correlation is not None and correlation >= self.config.self_correlation.limit:
+            logger.info(f'skip alpha {alpha_id}, pnl correlation {correlation:.4f} with active alpha {closest}')
+            return True
+        return False
+
+
     def find_and_sumbit_alpha(self):
+        """
+        submit up to `submition.count` PASS alphas. the candidates are checked again concurrently by
+        `submition.check_concurrency` workers, and submitted in the `submition` order as soon as the
+        check of every candidate before them is known. the checks still running are cancelled once
+        enough alphas are submitted.
+        """
+        submition = self.config.submition
         result = self.db.execute(
             text(f"select alpha_id from alpha where status  = '{Status.PASS.value}' \
-                order by {self.config.submition.order_by} {self.config.submition.direction}")
+                order by {submition.order_by} {submition.direction}")
         ).all()
+        screening = self.config.self_correlation
+        active_ids = []
+        if screening.enabled:
+            active_ids = [alpha_id for alpha_id in iter_alpha_ids(self.db, status = [Status.ACTIVE.value]) if self.fetch_pnl(alpha_id)]
+            logger.info(f'{len(active_ids)} active alphas in the pnl store')
+        candidates = iter(row.alpha_id for row in result)
+        stop_event = threading.Event()
+
+        def precheck(alpha_id):
+            # skip the check of an alpha which obviously fails SELF_CORRELATION
+            try:
+                if screening.enabled and self._is_self_correlated(alpha_id, list(active_ids)):
+                    return None
+                return self.check_one_alpha(alpha_id, stop_event)
+            except Exception as e:
+                logger.error(f'fail to check alpha {alpha_id}, {e}')
+                return Status.ERROR.value
+            finally:
+                SessionLocal.remove()
+
+        # (alpha_id, future) in the submission order
+        pending = deque()
         submitted_count = 0
-        for row in result:
-            logger.info(f'found a submittable alpha {row.alpha_id}')
-            res = self.submit_alpha(row.alpha_id)
-            if res:
-                logger.info(f'alpha {row.alpha_id} submitted')
-                submitted_count += 1
-            else:
-                logger.info(f'fail to submit alpha {row.alpha_id}')
+        with ThreadPoolExecutor(max_workers = submition.check_concurrency) as executor:
+            def fill():
+                # the finished checks waiting behind a slow head count in the lookahead as well, so a
+                # candidate still PENDING does not pull the check of every other PASS alpha
+                lookahead = submition.count - submitted_count + submition.check_concurrency
+                while sum(not future.done() for _, future in pending) < submition.check_concurrency and len(pending) < lookahead:
+                    alpha_id = next(candidates, None)
+                    if alpha_id is None:
+                        return
+                    logger.info(f'found a submittable alpha {alpha_id}')
+                    pending.append((alpha_id, executor.submit(precheck, alpha_id)))
 
-            if submitted_count >= self.config.submition.count:
-                logger.info(f'Submitted {self.config.submition.count} alphas')
-                break
+            try:
+                fill()
+                while pending and submitted_count < submition.count:
+                    wait([future for _, future in pending if not future.done()], return_when = FIRST_COMPLETED)
+                    while pending and pending[0][1].done() and submitted_count < submition.count:
+                        alpha_id, future = pending.popleft()
+                        if future.result() != Status.PASS.value:
+                            continue
+                        # the alphas submitted since the check started count as well
+                        if screening.enabled and self._is_self_correlated(alpha_id, active_ids):
+                            continue
+                        if self.submit_alpha(alpha_id, check = False):
+                            logger.info(f'alpha {alpha_id} submitted')
+                            submitted_count += 1
+                            active_ids.append(alpha_id)
+                        else:
+                            logger.info(f'fail to submit alpha {alpha_id}')
+                    fill()
+            finally:
+                stop_event.set()
+                for _, future in pending:
+                    future.cancel()
+        if submitted_count >= submition.count:
+            logger.info(f'Submitted {submition.count} alphas')
 
 
     def check_negative_direction(self):
@@ -1,6 +1,13 @@
 from urllib.parse import urlencode, urlparse, urlunparse, quote, parse_qs
 from types import SimpleNamespace
+from datetime import datetime
+from decimal import Decimal
+from worldquant.constants import SETTINGS_COLUMN_MAPPING, SETTINGS_DEFAULTS
+from worldquant.expression import canonicalize, ExpressionError
+import hashlib
 import json
+import os
+import re
 
 def add_params_to_url(base_url: str, params: dict) -> str:
     parsed = urlparse(base_url)
@@ -17,6 +24,15 @@ def load_config(config_name):
     with open(f'config/{config_name}.json') as f:
         return json.load(f)
 
+def get_base_url():
+    """the platform url, WORLDQUANT_BASE_URL points the client to another server, e.g. benchmark/fake_brain.py"""
+    return os.environ.get('WORLDQUANT_BASE_URL') or load_config('simulation').get('base_url', 'https://api.worldquantbrain.com')
+
+def load_credential():
+    if os.environ.get('WORLDQUANT_USERNAME'):
+        return {'username': os.environ['WORLDQUANT_USERNAME'], 'password': os.environ.get('WORLDQUANT_PASSWORD', '')}
+    return load_config('credential')
+
 def dict_to_namespace(d):
     if isinstance(d, dict):
         return SimpleNamespace(**{k: dict_to_namespace(v) for k, v in d.items()})
@@ -24,3 +40,50 @@ def dict_to_namespace(d):
         return [dict_to_namespace(v) for v in d]
     else:
         return d
+
+
+def max_timestamp(a, b):
+    """the later one of two ISO 8601 timestamps, either may be None"""
+    if not a or not b:
+        return a or b
+    return a if datetime.fromisoformat(a) >= datetime.fromisoformat(b) else b
+
+
+# a change of the canonical form needs a migration hashing the stored expressions again,
+# see rehash_expressions in db/migrations.py
+def normalize_expression(expression):
+    """canonical form of an expression, whitespace stripped if it does not parse"""
+    try:
+        return canonicalize(expression or '')
+    except ExpressionError:
+        return re.sub(r'\s+', '', expression or '')
+
+def canonical_settings(settings):
+    """the settings that change a simulation result, as a canonical json string"""
+    canonical = {}
+    for key in SETTINGS_COLUMN_MAPPING:
+        value = settings.get(key)
+        if value is None:
+            value = SETTINGS_DEFAULTS.get(key)
+        if value is None:
+            continue
+        if key == 'visualization':
+            value = bool(value)
+        canonical[key] = float(value) if isinstance(value, (float, Decimal)) else value
+    return json.dumps(canonical, sort_keys=True, separators=(',', ':'))
+
+def simulation_hash(expression, settings):
+    """content address of a simulation, identical expression + settings always hash the same"""
+    return content_hash(expression, canonical_settings(settings))
+
+def content_hash(expression, canonical):
+    """simulation_hash with the canonical settings computed once by the caller"""
+    return canonical_hash(normalize_expression(expression), canonical)
+
+def canonical_hash(canonical_expression, canonical):
+    """content_hash of an expression already in its canonical form, e.g. from ExpressionTemplate.expand"""
+    return hashlib.sha1(f'{canonical_expression}\n{canonical}'.encode()).hexdigest()
+
+def settings_from_columns(row):
+    """simulation settings of an alpha table row"""
+    return {key: getattr(row, column) for key, column in SETTINGS_COLUMN_MAPPING.items()}
@@ -0,0 +1,111 @@
+"""
+static validation of FASTEXPR expressions against config/operators.json and the local data_field
+catalog, so that an expression the platform would reject never takes a queue slot or a simulation.
+
+the data fields are checked only when the catalog holds fields for the region, delay and universe
+of the simulation, refresh it with `python main.py -d`.
+"""
+from worldquant.expression import parse, get_operators, ExpressionError
+
+from sqlalchemy import text
+
+import threading
+import time
+
+
+# group fields accepted even when the catalog was refreshed without the GROUP fields
+GROUP_FIELDS = {'market', 'sector', 'industry', 'subindustry', 'exchange', 'country'}
+# constants spelled as names, in any case
+LITERALS = {'true', 'false', 'nan', 'inf'}
+# bare words taken by the keyword arguments of some operators, e.g. quantile(x, driver = gaussian)
+OPTION_WORDS = {'gaussian', 'uniform', 'cauchy'}
+
+
+class ExpressionValidator():
+    def __init__(self, fields = None, vector_fields = ()):
+        """`fields` is the set of the known data fields, None to skip the field checks"""
+        self.operators = get_operators()
+        self.vector_fields = set(vector_fields)
+        self.fields = None if fields is None else set(fields) | self.vector_fields
+
+
+    def validate(self, expression):
+        """None if the expression is valid, else (reason, message)"""
+        try:
+            tree = parse(expression)
+        except ExpressionError as e:
+            return 'syntax', str(e)
+        return self.validate_tree(tree)
+
+
+    def validate_tree(self, tree):
+        """`validate` of an expression already parsed"""
+        local_names = set()
+        for statement in tree[1]:
+            if statement[0] == 'assign':
+                error = self._check(statement[2], local_names, False)
+                local_names.add(statement[1])
+            else:
+                error = self._check(statement, local_names, False)
+            if error:
+                return error
+        return None
+
+
+    def _check(self, node, local_names, vector_allowed, option = False):
+        kind = node[0]
+        if kind == 'var':
+            name = node[1]
+            if name in local_names or name.lower() in LITERALS or (option and name in OPTION_WORDS):
+                return None
+            if name in self.vector_fields and not vector_allowed:
+                return 'vector_field', f'VECTOR field {name} used outside of a vec_ operator'
+            if self.fields is not None and name not in self.fields and name not in GROUP_FIELDS:
+                return 'unknown_field', f'unknown data field {name}'
+            return None
+        if kind != 'call':
+            return None
+
+        _, name, args, kwargs = node
+        operator = self.operators.get(name)
+        if operator is None:
+            return 'unknown_operator', f'unknown operator {name}'
+        # parameters given by name count as positional ones, the other keyword arguments are options
+        given = len(args) + sum(1 for key, _ in kwargs if key in operator.params)
+        if given < operator.min_args or (not operator.variadic and given > len(operator.params) + len(operator.defaults)):
+            return 'arity', f'{name} takes {len(operator.params)} inputs, got {given}'
+        vector = name.startswith('vec_')
+        for arg in args:
+            error = self._check(arg, local_names, vector)
+            if error:
+                return error
+        for _, value in kwargs:
+            error = self._check(value, local_names, False, option = True)
+            if error:
+                return error
+        return None
+
+
+def load_catalog(db, settings):
+    """(field names, VECTOR field names) of the data_field catalog for the scope of the settings"""
+    rows = db.execute(text("select field_name, type from data_field \
+        where region = :region and delay = :delay and universe = :universe"), {
+        'region': settings.get('region'), 'delay': settings.get('delay'), 'universe': settings.get('universe')
+    }).all()
+    return {row.field_name for row in rows}, {row.field_name for row in rows if row.type == 'VECTOR'}
+
+
+# (region, delay, universe) -> (loaded at, validator)
+_VALIDATORS = {}
+_VALIDATORS_LOCK = threading.Lock()
+
+def get_validator(db, settings, ttl = 300):
+    """the validator of the scope of the settings, its catalog is loaded again after `ttl` seconds"""
+    scope = (settings.get('region'), str(settings.get('delay')), settings.get('universe'))
+    with _VALIDATORS_LOCK:
+        loaded = _VALIDATORS.get(scope)
+        if loaded is None or time.time() - loaded[0] > ttl:
+            fields, vector_fields = load_catalog(db, settings)
+            loaded = (time.time(), ExpressionValidator(fields or None, vector_fields))
+            _VALIDATORS[scope] = loaded
+        return loaded[1]